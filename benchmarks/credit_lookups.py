@@ -0,0 +1,121 @@
+"""Lookups in the credit tables with and without their indexes.
+
+Creates a SQLite database with --rows credit values (--values per user,
+one project per --members users) and times the lookups of the credit
+service: the credits of one user as loaded at login and by the API, one
+credit value by user and name, and the members of a project. Then drops
+the indexes of credits_user_values and times the same lookups again.
+
+    python benchmarks/credit_lookups.py --rows 50000
+"""
+
+import argparse
+import os
+import tempfile
+import timeit
+from datetime import datetime
+
+from sqlalchemy import create_engine, insert
+from sqlalchemy.orm import sessionmaker
+
+from jupyterhub_credit_service.orm import (
+    Base,
+    CreditsProject,
+    CreditsUser,
+    CreditsUserValues,
+)
+
+
+def create_database(db_url, rows, values, members):
+    engine = create_engine(db_url)
+    Base.metadata.create_all(engine)
+    users = rows // values
+    now = datetime.now()
+    with engine.begin() as connection:
+        connection.execute(
+            insert(CreditsProject),
+            [
+                {
+                    "name": f"project-{i}",
+                    "balance": 1000,
+                    "cap": 1000,
+                    "grant_value": 10,
+                    "grant_interval": 300,
+                    "grant_last_update": now,
+                }
+                for i in range(users // members + 1)
+            ],
+        )
+        connection.execute(
+            insert(CreditsUser), [{"name": f"user-{i}"} for i in range(users)]
+        )
+        connection.execute(
+            insert(CreditsUserValues),
+            [
+                {
+                    "name": f"values-{j}",
+                    "user_name": f"user-{i}",
+                    "project_name": f"project-{i // members}" if j == 0 else None,
+                    "balance": 100,
+                    "cap": 100,
+                    "grant_value": 10,
+                    "grant_interval": 300,
+                    "grant_last_update": now,
+                }
+                for j in range(values)
+                for i in range(users)
+            ],
+        )
+    return engine, users
+
+
+def run_lookups(engine, users, values, members, number):
+    db = sessionmaker(bind=engine)()
+    user_name = f"user-{users // 2}"
+    project_name = f"project-{users // 2 // members}"
+    lookups = {
+        "user with values": lambda: CreditsUser.get_user(db, user_name, refresh=True),
+        "value by user, name": lambda: db.query(CreditsUserValues)
+        .filter(
+            CreditsUserValues.user_name == user_name,
+            CreditsUserValues.name == f"values-{values - 1}",
+        )
+        .one(),
+        "project members": lambda: db.query(CreditsUserValues)
+        .filter(CreditsUserValues.project_name == project_name)
+        .all(),
+    }
+    results = {}
+    for label, lookup in lookups.items():
+        total = min(timeit.repeat(lookup, number=number, repeat=3))
+        results[label] = total / number * 1e6
+    db.close()
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--rows", type=int, default=50000)
+    parser.add_argument("--values", type=int, default=2)
+    parser.add_argument("--members", type=int, default=50)
+    parser.add_argument("--number", type=int, default=200)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        db_url = f"sqlite:///{os.path.join(tmp, 'credits.sqlite')}"
+        engine, users = create_database(db_url, args.rows, args.values, args.members)
+        indexed = run_lookups(engine, users, args.values, args.members, args.number)
+        with engine.begin() as connection:
+            for index in CreditsUserValues.__table__.indexes:
+                connection.exec_driver_sql(f"DROP INDEX {index.name}")
+        unindexed = run_lookups(engine, users, args.values, args.members, args.number)
+        engine.dispose()
+
+    print(f"{users * args.values} credit values of {users} users")
+    print(f"{'lookup':<22}{'no index (us)':>16}{'index (us)':>14}")
+    for label in indexed:
+        print(f"{label:<22}{unindexed[label]:>16.1f}{indexed[label]:>14.1f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,127 @@
+"""Event loop lag during a credit task run with many users.
+
+Creates a SQLite database with --users users, each with one running
+server that is due for billing and credits that are due for a grant.
+Then it runs one credit task run on the event loop and one in the
+credit database thread, while a second coroutine measures how late its
+timers fire.
+
+    python benchmarks/loop_lag.py --users 10000
+"""
+
+import argparse
+import asyncio
+import os
+import statistics
+import tempfile
+import time
+from datetime import timedelta
+from types import SimpleNamespace
+
+from jupyterhub.utils import utcnow
+from sqlalchemy import create_engine
+from sqlalchemy.orm import sessionmaker
+from traitlets.config import Configurable
+
+from jupyterhub_credit_service import CreditsAuthenticator
+from jupyterhub_credit_service.orm import Base, CreditsUser, CreditsUserValues
+from jupyterhub_credit_service.scheduler import CREDITS_GRANTS
+
+
+class BenchmarkHub(Configurable):
+    db = None
+    db_url = None
+
+
+def create_database(path, users, now):
+    db_url = f"sqlite:///{path}"
+    engine = create_engine(db_url)
+    Base.metadata.create_all(engine)
+    db = sessionmaker(bind=engine, expire_on_commit=False)()
+    for i in range(users):
+        name = f"user-{i}"
+        db.add(CreditsUser(name=name))
+        db.add(
+            CreditsUserValues(
+                name="default",
+                user_name=name,
+                balance=500,
+                cap=1000,
+                grant_value=10,
+                grant_interval=300,
+                grant_last_update=now - timedelta(seconds=600),
+            )
+        )
+    db.commit()
+    return db_url, db
+
+
+def fake_spawner(i, now):
+    user = SimpleNamespace(name=f"user-{i}", id=i)
+    return SimpleNamespace(
+        user=user,
+        name="",
+        _log_name=f"user-{i}:",
+        orm_spawner=SimpleNamespace(id=i, started=now - timedelta(seconds=60)),
+        active=True,
+        ready=True,
+        _billing_interval=600,
+        _billing_value=10,
+        user_options={},
+    )
+
+
+async def measure_lag(stop, lags, interval=0.005):
+    while not stop.is_set():
+        tic = time.perf_counter()
+        await asyncio.sleep(interval)
+        lags.append(time.perf_counter() - tic - interval)
+
+
+async def run(users, threads):
+    now = utcnow(with_tz=False)
+    with tempfile.TemporaryDirectory() as tmp:
+        db_url, db = create_database(os.path.join(tmp, "credits.sqlite"), users, now)
+        hub = BenchmarkHub()
+        hub.db = db
+        hub.db_url = db_url
+        # Disabled credits don't start the background task, it's run by hand
+        authenticator = CreditsAuthenticator(
+            parent=hub, credits_enabled=False, credits_db_threads=threads
+        )
+        for i in range(users):
+            authenticator.credits_billable.add(fake_spawner(i, now))
+        authenticator.credits_scheduler.schedule(CREDITS_GRANTS, now)
+
+        stop = asyncio.Event()
+        lags = []
+        monitor = asyncio.create_task(measure_lag(stop, lags))
+        await asyncio.sleep(0.05)
+        tic = time.perf_counter()
+        await authenticator.credits_reconcile(utcnow(with_tz=False))
+        duration = time.perf_counter() - tic
+        await asyncio.sleep(0.05)
+        stop.set()
+        await monitor
+        db.close()
+    return duration, lags
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--users", type=int, default=10000)
+    args = parser.parse_args()
+    print(f"{args.users} users, one due server each")
+    print(f"{'mode':<16}{'run (s)':>10}{'max lag (ms)':>16}{'p99 lag (ms)':>16}")
+    for label, threads in (("event loop", 0), ("db thread", 1)):
+        duration, lags = asyncio.run(run(args.users, threads))
+        lags_ms = sorted(x * 1000 for x in lags)
+        p99 = lags_ms[int(len(lags_ms) * 0.99) - 1] if len(lags_ms) > 1 else 0.0
+        print(
+            f"{label:<16}{duration:>10.2f}{max(lags_ms):>16.1f}{p99:>16.1f}"
+            f"  (median {statistics.median(lags_ms):.1f} ms)"
+        )
+
+
+if __name__ == "__main__":
+    main()
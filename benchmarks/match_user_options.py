@@ -0,0 +1,98 @@
+"""Matching spawner user_options against configured user_options.
+
+Matches spawner user_options against configurations with --keys keys,
+mixing exact values, lists, regular expressions, glob patterns and
+nested dicts. Compares compiling the configuration for every match with
+the cached matchers of CreditsAuthenticator.match_user_options().
+
+Then resolves the configuration of a spawner from --configs credit
+configurations (one per system, the last ones patterns), once with a
+linear scan and once with a UserOptionsIndex.
+
+    python benchmarks/match_user_options.py --keys 20 --configs 50
+"""
+
+import argparse
+import timeit
+
+from jupyterhub_credit_service import CreditsAuthenticator
+from jupyterhub_credit_service.matching import UserOptionsIndex, compile_user_options
+
+
+def make_config(keys):
+    configured = {}
+    user_options = {}
+    for i in range(keys):
+        kind = i % 5
+        key = f"option{i}"
+        if kind == 0:
+            configured[key] = f"value{i}"
+            user_options[key] = f"value{i}"
+        elif kind == 1:
+            configured[key] = [f"value{j}" for j in range(10)]
+            user_options[key] = ["value7"]
+        elif kind == 2:
+            configured[key] = r"node-\d+\.cluster"
+            user_options[key] = f"node-{i}.cluster"
+        elif kind == 3:
+            configured[key] = "*.example.org"
+            user_options[key] = f"host{i}.example.org"
+        else:
+            configured[key] = {"version": "4.*", "gpus": 2}
+            user_options[key] = {"version": "4.2", "gpus": 2}
+    return configured, user_options
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--keys", type=int, default=20)
+    parser.add_argument("--configs", type=int, default=50)
+    parser.add_argument("--number", type=int, default=20000)
+    args = parser.parse_args()
+
+    authenticator = CreditsAuthenticator(credits_enabled=False)
+    configured, user_options = make_config(args.keys)
+    assert authenticator.match_user_options(user_options, configured)
+
+    runs = {
+        "compile per match": lambda: compile_user_options(configured).match(
+            user_options
+        ),
+        "cached matcher": lambda: authenticator.match_user_options(
+            user_options, configured
+        ),
+    }
+    print(f"{args.keys} configured keys, {args.number} matches")
+    print(f"{'mode':<20}{'total (s)':>12}{'per match (us)':>18}")
+    for label, run in runs.items():
+        total = min(timeit.repeat(run, number=args.number, repeat=3))
+        print(f"{label:<20}{total:>12.3f}{total / args.number * 1e6:>18.1f}")
+
+    configs = [
+        {"system": f"system{i}", "partition": ["batch", "gpus"]}
+        for i in range(args.configs - 5)
+    ] + [{"system": f"pattern{i}-.*"} for i in range(5)]
+    # Worst case for a linear scan, the last exact configuration
+    user_options = {"system": f"system{args.configs - 6}", "partition": "gpus"}
+
+    def linear():
+        for position, configured in enumerate(configs):
+            if authenticator.match_user_options(user_options, configured):
+                return position
+
+    index = UserOptionsIndex(configs, authenticator.user_options_matcher)
+    assert index.resolve(user_options) == linear()
+    runs = {
+        "linear scan": linear,
+        "index": lambda: index.resolve(user_options),
+    }
+    print()
+    print(f"{args.configs} credit configurations, {args.number} resolutions")
+    print(f"{'mode':<20}{'total (s)':>12}{'per spawner (us)':>18}")
+    for label, run in runs.items():
+        total = min(timeit.repeat(run, number=args.number, repeat=3))
+        print(f"{label:<20}{total:>12.3f}{total / args.number * 1e6:>18.1f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -5,19 +5,26 @@ from jupyterhub.handlers import default_handlers
 from .apihandlers import (
     CreditsAPIHandler,
     CreditsAPIHealthHandler,
+    CreditsBatchAPIHandler,
     CreditsProjectAPIHandler,
+    CreditsProjectsListAPIHandler,
     CreditsSSEAPIHandler,
     CreditsSSEServerAPIHandler,
     CreditsStopServerAPIHandler,
     CreditsUserAPIHandler,
+    CreditsValuesListAPIHandler,
 )
 from .authenticator import CreditsAuthenticator  # noqa: F401
+from .cli import main  # noqa: F401
 from .spawner import CreditsSpawner  # noqa: F401
 
 template_paths = [str(Path(__path__[0]) / "templates")]
 
 default_handlers.append((r"/api/credits", CreditsAPIHandler))
 default_handlers.append((r"/api/credits/health", CreditsAPIHealthHandler))
+default_handlers.append((r"/api/credits/batch", CreditsBatchAPIHandler))
+default_handlers.append((r"/api/credits/values", CreditsValuesListAPIHandler))
+default_handlers.append((r"/api/credits/projects", CreditsProjectsListAPIHandler))
 default_handlers.append((r"/api/credits/sse", CreditsSSEAPIHandler))
 default_handlers.append((r"/api/credits/sseserver/([^/]+)", CreditsSSEServerAPIHandler))
 default_handlers.append(
@@ -1,5 +1,7 @@
 import asyncio
+import base64
 import sys
+from datetime import datetime, timedelta
 
 if sys.version_info >= (3, 10):
     from contextlib import aclosing
@@ -8,40 +10,72 @@ else:
 
 from jupyterhub.apihandlers.base import APIHandler
 from jupyterhub.scopes import needs_scope
-from jupyterhub.utils import iterate_until
+from jupyterhub.utils import iterate_until, utcnow
+from sqlalchemy import select, tuple_, update
 from tornado import web
 from tornado.iostream import StreamClosedError
 from tornado.web import HTTPError, authenticated
 
-from .orm import CreditsProject, CreditsUser
+from .metrics import CREDITS_SSE_CONNECTIONS
+from .orm import CreditsProject, CreditsUser, CreditsUserValues
 
 background_task = None
 import json
 
 
-def get_model(credits_user):
+def get_balance_time(authenticator):
+    """Time to compute the effective balances at.
+
+    With lazy grants the stored balances don't contain the grants since
+    the last update. Otherwise None, to report the stored balances.
+    """
+    if authenticator.credits_lazy_grants:
+        return utcnow(with_tz=False)
+    return None
+
+
+def get_balance(credits, now=None):
+    if now is None:
+        return credits.balance, credits.grant_last_update
+    return credits.effective_grant(now)
+
+
+def get_user_model(authenticator, user_name, refresh=False):
+    """Model of the credits of a user, None if there's no entry.
+
+    Runs through credits_run(), so it only returns plain values.
+    """
+    credits_user = authenticator.credits_get_user(user_name, refresh=refresh)
+    if not credits_user:
+        return None
+    return get_model(credits_user, get_balance_time(authenticator))
+
+
+def get_model(credits_user, now=None):
     model = []
     for cuv in credits_user.credits_user_values:
+        balance, grant_last_update = get_balance(cuv, now)
         model.append(
             {
                 "name": cuv.name,
-                "balance": cuv.balance,
+                "balance": balance,
                 "cap": cuv.cap,
                 "grant_value": cuv.grant_value,
                 "grant_interval": cuv.grant_interval,
-                "grant_last_update": cuv.grant_last_update.isoformat(),
+                "grant_last_update": grant_last_update.isoformat(),
             }
         )
         if cuv.project:
+            proj_balance, proj_grant_last_update = get_balance(cuv.project, now)
             model[-1].update(
                 {
                     "project": {
                         "name": cuv.project.name,
-                        "balance": cuv.project.balance,
+                        "balance": proj_balance,
                         "cap": cuv.project.cap,
                         "grant_value": cuv.project.grant_value,
                         "grant_interval": cuv.project.grant_interval,
-                        "grant_last_update": cuv.project.grant_last_update.isoformat(),
+                        "grant_last_update": proj_grant_last_update.isoformat(),
                     }
                 }
             )
@@ -91,21 +125,48 @@ class CreditsSSEAPIHandler(APIHandler):
 
             await asyncio.wait([self._finish_future], timeout=self.keepalive_interval)
 
-    async def event_handler(self, user):
-        user_credits = CreditsUser.get_user(user.authenticator.parent.db, user.name)
+    async def wait_for_change(self, user, project_names, stamp, spawner=None):
+        """Wait for a credit task run that changed the credits of `user`.
+
+        The task runs at every bill deadline of any server. Runs that
+        didn't touch the user or `project_names` after `stamp` (see
+        VersionStamps) are skipped without a database query. With lazy
+        grants balances change without writes, so every run counts.
+        """
+        authenticator = user.authenticator
+        while True:
+            await authenticator.credits_task_event.wait()
+            await asyncio.sleep(0)
+            if self._finish_future.done():
+                return
+            if spawner is not None and not spawner.ready:
+                return
+            if authenticator.credits_lazy_grants:
+                return
+            if authenticator.credits_versions.changed_since(
+                user.name, project_names, stamp
+            ):
+                return
 
+    async def event_handler(self, user):
         while (
             type(self._finish_future) is asyncio.Future
             and not self._finish_future.done()
         ):
-            user.authenticator.parent.db.refresh(user_credits)
-            model_credits = get_model(user_credits)
+            stamp = user.authenticator.credits_versions.stamp()
+            model_credits = await user.authenticator.credits_run(
+                get_user_model, user.authenticator, user.name, True
+            )
             try:
                 yield model_credits
             except GeneratorExit as e:
                 raise e
-            await user.authenticator.credits_task_event.wait()
-            await asyncio.sleep(0)
+            project_names = [
+                cuv["project"]["name"]
+                for cuv in model_credits or []
+                if "project" in cuv
+            ]
+            await self.wait_for_change(user, project_names, stamp)
 
     @authenticated
     async def get(self):
@@ -116,41 +177,49 @@ class CreditsSSEAPIHandler(APIHandler):
         # This task will be finished / done, once the tab in the browser is closed
         self.keepalive_task = asyncio.create_task(self.keepalive())
 
-        try:
-            async with aclosing(
-                iterate_until(self.keepalive_task, self.event_handler(user))
-            ) as events:
-                async for event in events:
-                    if event:
-                        await self.send_event(event)
-                    else:
-                        break
-        except RuntimeError:
-            pass
-        except asyncio.exceptions.CancelledError:
-            pass
+        with CREDITS_SSE_CONNECTIONS.labels(handler="user").track_inprogress():
+            try:
+                async with aclosing(
+                    iterate_until(self.keepalive_task, self.event_handler(user))
+                ) as events:
+                    async for event in events:
+                        if event:
+                            await self.send_event(event)
+                        else:
+                            break
+            except RuntimeError:
+                pass
+            except asyncio.exceptions.CancelledError:
+                pass
 
 
 class CreditsSSEServerAPIHandler(CreditsSSEAPIHandler):
     """EventStream handler to update UserCredits in Frontend for one specific server"""
 
+    def get_server_model(self, authenticator, user_name, user_options):
+        user_credits = authenticator.credits_get_user(user_name, refresh=True)
+        if not user_credits:
+            return None
+        credits_user_values = authenticator.credits_user_values_for(
+            user_credits, user_options
+        )
+        if not credits_user_values:
+            return None
+        now = get_balance_time(authenticator)
+        model_credits = {
+            "balance": get_balance(credits_user_values, now)[0],
+            "cap": credits_user_values.cap,
+        }
+        if credits_user_values.project:
+            model_credits["project"] = {
+                "name": credits_user_values.project.name,
+                "balance": get_balance(credits_user_values.project, now)[0],
+                "cap": credits_user_values.project.cap,
+            }
+        return model_credits
+
     async def event_handler(self, user, spawner):
         user_options = spawner.user_options
-        user_credits = CreditsUser.get_user(user.authenticator.parent.db, user.name)
-        credits_user_values = None
-        default_cuv = None
-        for cuv in user_credits.credits_user_values:
-            if not cuv.user_options:
-                default_cuv = cuv
-                continue
-            match = user.authenticator.match_user_options(
-                user_options, cuv.user_options or {}
-            )
-            if match:
-                credits_user_values = cuv
-                break
-        if credits_user_values is None:
-            credits_user_values = default_cuv
         while (
             type(self._finish_future) is asyncio.Future
             and not self._finish_future.done()
@@ -163,25 +232,20 @@ class CreditsSSEServerAPIHandler(CreditsSSEAPIHandler):
                     return
                 except GeneratorExit as e:
                     raise e
-            elif credits_user_values:
-                user.authenticator.parent.db.refresh(credits_user_values)
-                model_credits = {
-                    "balance": credits_user_values.balance,
-                    "cap": credits_user_values.cap,
-                }
-                if credits_user_values.project:
-                    user.authenticator.parent.db.refresh(credits_user_values.project)
-                    model_credits["project"] = {
-                        "name": credits_user_values.project.name,
-                        "balance": credits_user_values.project.balance,
-                        "cap": credits_user_values.project.cap,
-                    }
-                try:
-                    yield model_credits
-                except GeneratorExit as e:
-                    raise e
-            await user.authenticator.credits_task_event.wait()
-            await asyncio.sleep(0)
+            else:
+                stamp = user.authenticator.credits_versions.stamp()
+                model_credits = await user.authenticator.credits_run(
+                    self.get_server_model, user.authenticator, user.name, user_options
+                )
+                if model_credits:
+                    try:
+                        yield model_credits
+                    except GeneratorExit as e:
+                        raise e
+                project_names = []
+                if model_credits and "project" in model_credits:
+                    project_names.append(model_credits["project"]["name"])
+                await self.wait_for_change(user, project_names, stamp, spawner)
 
     @needs_scope("read:servers")
     async def get(self, user_name, server_name=None):
@@ -203,19 +267,22 @@ class CreditsSSEServerAPIHandler(CreditsSSEAPIHandler):
         # This task will be finished / done, once the tab in the browser is closed
         self.keepalive_task = asyncio.create_task(self.keepalive())
 
-        try:
-            async with aclosing(
-                iterate_until(self.keepalive_task, self.event_handler(user, spawner))
-            ) as events:
-                async for event in events:
-                    if event:
-                        await self.send_event(event)
-                    else:
-                        break
-        except RuntimeError:
-            pass
-        except asyncio.exceptions.CancelledError:
-            pass
+        with CREDITS_SSE_CONNECTIONS.labels(handler="server").track_inprogress():
+            try:
+                async with aclosing(
+                    iterate_until(
+                        self.keepalive_task, self.event_handler(user, spawner)
+                    )
+                ) as events:
+                    async for event in events:
+                        if event:
+                            await self.send_event(event)
+                        else:
+                            break
+            except RuntimeError:
+                pass
+            except asyncio.exceptions.CancelledError:
+                pass
 
 
 from jupyterhub.apihandlers.users import UserServerAPIHandler
@@ -283,49 +350,277 @@ class CreditsAPIHandler(APIHandler):
         if not user.authenticator.credits_enabled:
             raise HTTPError(404, "Credits function is currently disabled")
 
-        credits_user = CreditsUser.get_user(user.authenticator.parent.db, user.name)
+        versions = user.authenticator.credits_versions
+        etags = self.request.headers.get("If-None-Match", None)
+        etag = None
+        if etags:
+            etag = versions.unchanged(user.name, etags, utcnow(with_tz=False))
+        if etag:
+            # Nothing changed since the client's response, no database query
+            self.set_header("ETag", etag)
+            self.set_status(304)
+            return
 
-        if not credits_user:
+        # Taken before reading, so changes committed meanwhile get newer stamps
+        stamp = versions.stamp()
+        model = await user.authenticator.credits_run(
+            get_user_model, user.authenticator, user.name
+        )
+
+        if model is None:
             # Create entry for user with default values
             raise HTTPError(404, "No credit entry found for user")
 
-        model = get_model(credits_user)
-
+        versions.remember(
+            user.name, [cuv["project"]["name"] for cuv in model if "project" in cuv]
+        )
+        expires = None
+        if user.authenticator.credits_lazy_grants:
+            expires = get_model_expires(model)
+        self.set_header("ETag", versions.etag(stamp, expires))
         self.write(json.dumps(model))
 
 
-class CreditsUserAPIHandler(APIHandler):
+def get_model_expires(model):
+    """Time of the next lazy grant of a model, which changes it, or None"""
+    expires = []
+    for credits in model + [cuv["project"] for cuv in model if "project" in cuv]:
+        if credits["grant_interval"] and credits["grant_interval"] > 0:
+            expires.append(
+                datetime.fromisoformat(credits["grant_last_update"])
+                + timedelta(seconds=credits["grant_interval"])
+            )
+    return min(expires, default=None)
+
+
+def encode_cursor(values):
+    """Opaque cursor of the keyset values of the last listed row"""
+    dumped = json.dumps(values).encode("utf8")
+    return base64.urlsafe_b64encode(dumped).decode("ascii").rstrip("=")
+
+
+def decode_cursor(cursor):
+    padded = cursor + "=" * (-len(cursor) % 4)
+    return json.loads(base64.urlsafe_b64decode(padded.encode("ascii")))
+
+
+class CreditsListAPIHandler(APIHandler):
+    """Listing of the credits of all users or projects, for admins.
+
+    Query arguments:
+    - sort: one of `sort_keys`, with a leading "-" for descending order
+    - min_balance, max_balance: only stored balances in this range
+    - the arguments of `filters`, compared for equality
+    - limit: number of items, at most `max_limit`
+    - after: `next` of the previous page
+
+    Pages are selected by keyset, not by offset, so each one is a range
+    scan on an index. The response {"items": [...], "next": ...} is
+    written in chunks of `chunk_size` items, each loaded by its own query,
+    so large pages aren't kept in memory. `next` is null after the last page.
+
+    With lazy grants, the balance filters and sort use the effective
+    balances the items show, computed in SQL (no index scan then). On
+    databases without set-based grants they use the stored balances.
+    """
+
+    chunk_size = 500
+    default_limit = 100
+    max_limit = 10000
+
+    # ORM class of the listed rows
+    table = None
+    # sort name -> columns ordering the rows, unique together
+    sort_keys = {}
+    default_sort = None
+    # query argument -> column
+    filters = {}
+    # key of the items -> column, besides the current balance and
+    # grant_last_update, which include the grants since the last update
+    fields = {}
+
+    def get_int_argument(self, name, default=None):
+        value = self.get_argument(name, None)
+        if value is None:
+            return default
+        try:
+            return int(value)
+        except ValueError:
+            raise HTTPError(400, f"'{name}' must be an integer")
+
+    def load_chunk(
+        self, authenticator, keys, descending, filters, balances, after, limit
+    ):
+        """Models of the next `limit` rows and the keyset of the last one"""
+        cls = self.table
+        db = authenticator.credits_db
+        now = get_balance_time(authenticator)
+        balance = cls.balance
+        in_sql = now is not None and cls.supports_set_based_grants(db)
+        if in_sql:
+            # Filter and sort by the balances the items show
+            balance = cls.effective_balance_clause(now)
+        columns = [balance if key == "balance" else getattr(cls, key) for key in keys]
+        query = db.query(cls, balance)
+        for name, value in filters.items():
+            query = query.filter(getattr(cls, self.filters[name]) == value)
+        min_balance, max_balance = balances
+        if min_balance is not None:
+            query = query.filter(balance >= min_balance)
+        if max_balance is not None:
+            query = query.filter(balance <= max_balance)
+        if after is not None:
+            if descending:
+                query = query.filter(tuple_(*columns) < tuple_(*after))
+            else:
+                query = query.filter(tuple_(*columns) > tuple_(*after))
+        if descending:
+            columns = [column.desc() for column in columns]
+        rows = query.order_by(*columns).limit(limit).all()
+        if not rows:
+            return [], None
+        row, balance = rows[-1]
+        last = [balance if key == "balance" else getattr(row, key) for key in keys]
+        items = []
+        for row, balance in rows:
+            item = {key: getattr(row, column) for key, column in self.fields.items()}
+            effective_balance, grant_last_update = get_balance(row, now)
+            item["balance"] = balance if in_sql else effective_balance
+            item["grant_last_update"] = grant_last_update.isoformat()
+            items.append(item)
+        return items, last
+
     @needs_scope("admin:users")
-    async def post(self, user_name, credit_name):
-        user = self.find_user(user_name)
-        if not user:
-            raise HTTPError(404, "User not found")
-        data = self.get_json_body()
-        credits_user = CreditsUser.get_user(user.authenticator.parent.db, user.name)
+    async def get(self):
+        authenticator = self.current_user.authenticator
+        if not authenticator.credits_enabled:
+            raise HTTPError(404, "Credits function is currently disabled")
+
+        sort = self.get_argument("sort", self.default_sort)
+        descending = sort.startswith("-")
+        keys = self.sort_keys.get(sort.lstrip("-"), None)
+        if keys is None:
+            raise HTTPError(
+                400, f"'sort' must be one of {', '.join(sorted(self.sort_keys))}"
+            )
+        limit = self.get_int_argument("limit", self.default_limit)
+        if not 0 < limit <= self.max_limit:
+            raise HTTPError(400, f"'limit' must be between 1 and {self.max_limit}")
+        filters = {}
+        for name in self.filters:
+            value = self.get_argument(name, None)
+            if value is not None:
+                filters[name] = value
+        balances = (
+            self.get_int_argument("min_balance"),
+            self.get_int_argument("max_balance"),
+        )
+        after = self.get_argument("after", None)
+        if after is not None:
+            try:
+                after = decode_cursor(after)
+            except ValueError:
+                after = None
+            if (
+                not isinstance(after, list)
+                or len(after) != len(keys)
+                or not all(isinstance(value, (int, str)) for value in after)
+            ):
+                raise HTTPError(400, "Invalid 'after' cursor")
+
+        self.set_header("Content-Type", "application/json")
+        self.write('{"items": [')
+        count = 0
+        while count < limit:
+            chunk = min(self.chunk_size, limit - count)
+            # credits_write() writes the balance cache first, so the
+            # listing sees the current balances
+            items, last = await authenticator.credits_run(
+                authenticator.credits_write,
+                None,
+                None,
+                self.load_chunk,
+                authenticator,
+                keys,
+                descending,
+                filters,
+                balances,
+                after,
+                chunk,
+            )
+            for item in items:
+                self.write(("," if count else "") + json.dumps(item))
+                count += 1
+            if len(items) < chunk:
+                after = None
+                break
+            after = last
+            await self.flush()
+        next_cursor = encode_cursor(after) if after is not None else None
+        self.write(f'], "next": {json.dumps(next_cursor)}}}')
+
+
+class CreditsValuesListAPIHandler(CreditsListAPIHandler):
+    table = CreditsUserValues
+    sort_keys = {"user_name": ("user_name", "name"), "balance": ("balance", "id")}
+    default_sort = "user_name"
+    filters = {"project": "project_name", "name": "name"}
+    fields = {
+        "user_name": "user_name",
+        "name": "name",
+        "cap": "cap",
+        "grant_value": "grant_value",
+        "grant_interval": "grant_interval",
+        "project": "project_name",
+    }
+
+
+class CreditsProjectsListAPIHandler(CreditsListAPIHandler):
+    table = CreditsProject
+    sort_keys = {"name": ("name",), "balance": ("balance", "name")}
+    default_sort = "name"
+    fields = {
+        "name": "name",
+        "display_name": "display_name",
+        "cap": "cap",
+        "grant_value": "grant_value",
+        "grant_interval": "grant_interval",
+    }
+
+
+class CreditsAdminAPIHandler(APIHandler):
+    """Changes of credits by admins, shared by the single and batch endpoints.
+
+    check_credits() and check_project() validate a change against the
+    current values and raise HTTPError, apply_credits() and apply_project()
+    make it without commit.
+    """
+
+    def touched_projects(self, credits_user_values):
+        if credits_user_values.project_name:
+            return {credits_user_values.project_name}
+        return set()
+
+    def touch_versions(self, authenticator, user_names, project_names):
+        """New versions for the ETags of the changed credits, after commit"""
+        for user_name in user_names:
+            authenticator.credits_versions.touch_user(user_name)
+        for project_name in project_names:
+            authenticator.credits_versions.touch_project(project_name)
+
+    def check_credits(self, credits_user, credit_name, data):
+        """The credit entry `credit_name` of `credits_user` to change"""
         if not credits_user:
             # Create entry for user with default values
             raise HTTPError(404, "No credit entry found for user")
-        balance = cap = grant_value = grant_interval = None
-        project_balance = project_cap = project_grant_value = project_grant_interval = (
-            None
-        )
-        credits_user_values = None
         for cuv in credits_user.credits_user_values:
             if cuv.name == credit_name:
                 credits_user_values = cuv
-                balance = data.get("balance", None)
-                cap = data.get("cap", None)
-                grant_value = data.get("grant_value", None)
-                grant_interval = data.get("grant_interval", None)
-                project = data.get("project", None)
-                if project:
-                    project_balance = project.get("balance", None)
-                    project_cap = project.get("cap", None)
-                    project_grant_value = project.get("grant_value", None)
-                    project_grant_interval = project.get("grant_interval", None)
                 break
-        if not credits_user_values:
+        else:
             raise HTTPError(404, f"Credit entry '{credit_name}' not found for user")
+        balance = data.get("balance", None)
+        cap = data.get("cap", None)
         if balance and cap and balance > cap:
             raise HTTPError(
                 400, f"Balance can't be bigger than cap ({balance} / {cap})"
@@ -337,6 +632,38 @@ class CreditsUserAPIHandler(APIHandler):
             )
         if balance and balance < 0:
             raise HTTPError(400, "Balance can't be negative")
+        return credits_user_values
+
+    def apply_credits(self, authenticator, credits_user, credits_user_values, data):
+        """Apply the changes to one credit entry of a user, without commit.
+
+        Returns the times of the next grants.
+        """
+        db = authenticator.credits_db
+        deadlines = []
+        balance = data.get("balance", None)
+        cap = data.get("cap", None)
+        grant_value = data.get("grant_value", None)
+        grant_interval = data.get("grant_interval", None)
+        project = data.get("project", None)
+        project_balance = project_cap = project_grant_value = project_grant_interval = (
+            None
+        )
+        if project:
+            project_balance = project.get("balance", None)
+            project_cap = project.get("cap", None)
+            project_grant_value = project.get("grant_value", None)
+            project_grant_interval = project.get("grant_interval", None)
+        now = get_balance_time(authenticator)
+        if now:
+            # Keep the credits granted until now, before values change
+            authenticator.credits_ledger_materialize(credits_user_values, now)
+            if project and credits_user_values.project:
+                authenticator.credits_ledger_materialize(
+                    credits_user_values.project, now
+                )
+        now = utcnow(with_tz=False)
+        prev_balance = credits_user_values.balance
         if balance:
             credits_user_values.balance = balance
         if cap:
@@ -368,50 +695,56 @@ class CreditsUserAPIHandler(APIHandler):
             ):
                 proj_updated = True
                 credits_user_values.project.grant_interval = project_grant_interval
+            authenticator.credits_ledger_record(
+                "admin",
+                credits_user_values.project,
+                credits_user_values.project.balance - prev_project_balance,
+                now,
+            )
             if proj_updated:
-                user.authenticator.parent.db.add(credits_user_values.project)
-                user.authenticator.parent.db.commit()
+                db.add(credits_user_values.project)
+                db.flush()
+                deadlines.append(
+                    authenticator.credits_grant_deadline(credits_user_values.project)
+                )
         elif project and not credits_user_values.project:
-            _project = user.authenticator.credits_validate_and_update_project(
+            _project = authenticator.credits_validate_and_update_project(
                 credits_user_values
             )
             if not _project:
                 self.log.error(
                     f"Failed to validate and update project: {credits_user_values}"
                 )
-                self.set_status(400)
-                return
+                raise HTTPError(400, "Invalid project")
             else:
                 _project["balance"] = _project["cap"]
                 orm_project = CreditsProject(**_project)
-                user.authenticator.parent.db.add(orm_project)
+                db.add(orm_project)
                 credits_user_values.project = orm_project
-                user.authenticator.parent.db.commit()
-        elif not project and credits_user_values.project:
-            user.authenticator.parent.db.delete(credits_user_values.project)
+                db.flush()
+        elif "project" in data and credits_user_values.project:
+            # Only an explicit "project": null removes it, items without
+            # "project" (e.g. top-ups) must leave shared projects alone
+            db.delete(credits_user_values.project)
             credits_user_values.project = None
 
-        user.authenticator.parent.db.add(credits_user)
-        user.authenticator.parent.db.commit()
-        self.set_status(200)
-
-
-class CreditsProjectAPIHandler(APIHandler):
-    @needs_scope("admin:users")
-    async def post(self, project_name):
-        data = self.get_json_body()
-        balance = data.get("balance", None)
-        cap = data.get("cap", None)
-        grant_value = data.get("grant_value", None)
-        grant_interval = data.get("grant_interval", None)
-
-        project = CreditsProject.get_project(
-            self.current_user.authenticator.parent.db, project_name
+        authenticator.credits_ledger_record(
+            "admin",
+            credits_user_values,
+            credits_user_values.balance - prev_balance,
+            now,
         )
+        # Apply the configuration at the next login again
+        credits_user.config_fingerprint = None
+        db.add(credits_user)
+        deadlines.append(authenticator.credits_grant_deadline(credits_user_values))
+        return deadlines
 
+    def check_project(self, project, project_name, data):
         if not project:
             raise HTTPError(404, f"Unknown project {project_name}.")
-
+        balance = data.get("balance", None)
+        cap = data.get("cap", None)
         if balance and cap and balance > cap:
             raise HTTPError(
                 400, f"Balance can't be bigger than cap ({balance} / {cap})"
@@ -422,6 +755,22 @@ class CreditsProjectAPIHandler(APIHandler):
             )
         if balance and balance < 0:
             raise HTTPError(400, "Balance can't be negative")
+
+    def apply_project(self, authenticator, project, data):
+        """Apply the changes to a project, without commit.
+
+        Returns the time of its next grant.
+        """
+        db = authenticator.credits_db
+        balance = data.get("balance", None)
+        cap = data.get("cap", None)
+        grant_value = data.get("grant_value", None)
+        grant_interval = data.get("grant_interval", None)
+        now = get_balance_time(authenticator)
+        if now:
+            # Keep the credits granted until now, before values change
+            authenticator.credits_ledger_materialize(project, now)
+        prev_balance = project.balance
         if balance:
             project.balance = balance
         if cap:
@@ -430,5 +779,252 @@ class CreditsProjectAPIHandler(APIHandler):
             project.grant_value = grant_value
         if grant_interval:
             project.grant_interval = grant_interval
-        self.current_user.authenticator.parent.db.commit()
+        authenticator.credits_ledger_record(
+            "admin", project, project.balance - prev_balance, utcnow(with_tz=False)
+        )
+        # Apply the configuration of the members at their next login again
+        db.execute(
+            update(CreditsUser)
+            .where(
+                CreditsUser.name.in_(
+                    select(CreditsUserValues.user_name).where(
+                        CreditsUserValues.project_name == project.name
+                    )
+                )
+            )
+            .values(config_fingerprint=None)
+            .execution_options(synchronize_session=False)
+        )
+        return authenticator.credits_grant_deadline(project)
+
+
+class CreditsUserAPIHandler(CreditsAdminAPIHandler):
+    @needs_scope("admin:users")
+    async def post(self, user_name, credit_name):
+        user = self.find_user(user_name)
+        if not user:
+            raise HTTPError(404, "User not found")
+        data = self.get_json_body()
+        authenticator = user.authenticator
+        deadlines = await authenticator.credits_run(
+            authenticator.credits_write,
+            user.name,
+            None,
+            self.update_credits,
+            authenticator,
+            user.name,
+            credit_name,
+            data,
+        )
+        for when in deadlines:
+            authenticator.credits_schedule_grant(when)
         self.set_status(200)
+
+    def update_credits(self, authenticator, user_name, credit_name, data):
+        """Change one credit entry of a user.
+
+        Returns the times of the next grants.
+        """
+        db = authenticator.credits_db
+        credits_user = CreditsUser.get_user(db, user_name)
+        credits_user_values = self.check_credits(credits_user, credit_name, data)
+        touched = self.touched_projects(credits_user_values)
+        deadlines = self.apply_credits(
+            authenticator, credits_user, credits_user_values, data
+        )
+        touched |= self.touched_projects(credits_user_values)
+        db.commit()
+        self.touch_versions(authenticator, [user_name], touched)
+        return deadlines
+
+
+class CreditsProjectAPIHandler(CreditsAdminAPIHandler):
+    @needs_scope("admin:users")
+    async def post(self, project_name):
+        data = self.get_json_body()
+        authenticator = self.current_user.authenticator
+        when = await authenticator.credits_run(
+            authenticator.credits_write,
+            None,
+            project_name,
+            self.update_project,
+            authenticator,
+            project_name,
+            data,
+        )
+        authenticator.credits_schedule_grant(when)
+        self.set_status(200)
+
+    def update_project(self, authenticator, project_name, data):
+        """Change a project. Returns the time of its next grant"""
+        db = authenticator.credits_db
+        project = CreditsProject.get_project(db, project_name)
+        self.check_project(project, project_name, data)
+        when = self.apply_project(authenticator, project, data)
+        db.commit()
+        self.touch_versions(authenticator, [], [project_name])
+        return when
+
+
+class CreditsBatchAPIHandler(CreditsAdminAPIHandler):
+    """Many changes of credits and projects in one transaction.
+
+    The body is a list of changes. A change of a credit entry has the
+    `user_name` and `credit_name` and the values of
+    POST /api/credits/user/<user_name>/<credit_name>, a change of a project
+    has the `project_name` and the values of
+    POST /api/credits/project/<project_name>.
+
+    All changes are validated first. Either all are applied or none. The
+    response has the status of each change in `results`, in the order of
+    the request.
+    """
+
+    numbers = ("balance", "cap", "grant_value", "grant_interval")
+
+    def check_numbers(self, data):
+        for key in self.numbers:
+            value = data.get(key, None)
+            # not isinstance(), bool is a subclass of int
+            if value is not None and type(value) is not int:
+                raise HTTPError(400, f"'{key}' must be an integer")
+
+    def batch_key(self, item):
+        """Check the format of a change. Returns what it changes"""
+        if not isinstance(item, dict):
+            raise HTTPError(400, "Change must be an object")
+        if "user_name" in item:
+            user_name = item["user_name"]
+            credit_name = item.get("credit_name", None)
+            if not isinstance(user_name, str) or not isinstance(credit_name, str):
+                raise HTTPError(400, "'user_name' and 'credit_name' are required")
+            project = item.get("project", None)
+            if project is not None:
+                if not isinstance(project, dict):
+                    raise HTTPError(400, "'project' must be an object")
+                self.check_numbers(project)
+            key = ("user", user_name, credit_name)
+        elif isinstance(item.get("project_name", None), str):
+            key = ("project", item["project_name"])
+        else:
+            raise HTTPError(400, "'user_name' or 'project_name' is required")
+        self.check_numbers(item)
+        return key
+
+    @needs_scope("admin:users")
+    async def post(self):
+        items = self.get_json_body()
+        if not isinstance(items, list):
+            raise HTTPError(400, "Expected a list of changes")
+        authenticator = self.current_user.authenticator
+        limit = authenticator.credits_api_batch_limit
+        if limit and len(items) > limit:
+            raise HTTPError(413, f"Too many changes ({len(items)} > {limit})")
+
+        results = [None] * len(items)
+        keys = set()
+        user_names = set()
+        project_names = set()
+        for i, item in enumerate(items):
+            try:
+                key = self.batch_key(item)
+                if key in keys:
+                    raise HTTPError(400, "Duplicate change")
+                keys.add(key)
+                if key[0] == "user":
+                    user = self.find_user(key[1])
+                    if not user:
+                        raise HTTPError(404, "User not found")
+                    user_names.add(user.name)
+                else:
+                    project_names.add(key[1])
+            except HTTPError as e:
+                results[i] = {"status": e.status_code, "message": e.log_message}
+
+        applied, results, deadlines = await authenticator.credits_run(
+            authenticator.credits_write,
+            sorted(user_names),
+            sorted(project_names),
+            self.update_batch,
+            authenticator,
+            items,
+            results,
+            user_names,
+            project_names,
+        )
+        for when in deadlines:
+            authenticator.credits_schedule_grant(when)
+        self.set_status(200 if applied else 400)
+        self.write(json.dumps({"applied": applied, "results": results}))
+
+    def update_batch(self, authenticator, items, results, user_names, project_names):
+        """Validate and apply all changes, without those already failed.
+
+        Returns whether they're applied, the results and the times of the
+        next grants.
+        """
+        db = authenticator.credits_db
+        credits_users = {}
+        for offset in range(0, len(user_names), 500):
+            names = sorted(user_names)[offset : offset + 500]
+            query = CreditsUser.query_with_values(db).filter(
+                CreditsUser.name.in_(names)
+            )
+            credits_users.update(
+                {credits_user.name: credits_user for credits_user in query}
+            )
+        projects = {}
+        for offset in range(0, len(project_names), 500):
+            names = sorted(project_names)[offset : offset + 500]
+            query = db.query(CreditsProject).filter(CreditsProject.name.in_(names))
+            projects.update({project.name: project for project in query})
+
+        changes = []
+        for i, item in enumerate(items):
+            if results[i] is not None:
+                continue
+            try:
+                if "user_name" in item:
+                    credits_user = credits_users.get(item["user_name"], None)
+                    cuv = self.check_credits(credits_user, item["credit_name"], item)
+                    changes.append((i, credits_user, cuv))
+                else:
+                    project = projects.get(item["project_name"], None)
+                    self.check_project(project, item["project_name"], item)
+                    changes.append((i, project, None))
+            except HTTPError as e:
+                results[i] = {"status": e.status_code, "message": e.log_message}
+
+        deadlines = []
+        if len(changes) == len(items):
+            touched = set(project_names)
+            try:
+                for i, target, cuv in changes:
+                    if cuv is None:
+                        deadlines.append(
+                            self.apply_project(authenticator, target, items[i])
+                        )
+                    else:
+                        touched |= self.touched_projects(cuv)
+                        deadlines += self.apply_credits(
+                            authenticator, target, cuv, items[i]
+                        )
+                        touched |= self.touched_projects(cuv)
+                    results[i] = {"status": 200}
+                db.commit()
+                self.touch_versions(authenticator, user_names, touched)
+                return True, results, deadlines
+            except HTTPError as e:
+                db.rollback()
+                results[i] = {"status": e.status_code, "message": e.log_message}
+            except:
+                db.rollback()
+                raise
+
+        for i, _, _ in changes:
+            if results[i] is None or results[i]["status"] == 200:
+                results[i] = {
+                    "status": 424,
+                    "message": "Not applied, other changes of the batch failed",
+                }
+        return False, results, []
@@ -1,24 +1,98 @@
 import asyncio
-import fnmatch
+import atexit
+import copy
+import hashlib
 import inspect
+import json
 import os
-import re
 import time
-from datetime import datetime, timedelta
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from datetime import timedelta
 
 from jupyterhub.auth import Authenticator
 from jupyterhub.orm import User as ORMUser
 from jupyterhub.utils import utcnow
-from sqlalchemy import inspect as sqlinspect
-from traitlets import Any, Bool, Callable, Dict, Integer, List, Union
+from sqlalchemy import create_engine, event
+from sqlalchemy.orm import scoped_session, selectinload, sessionmaker
+from traitlets import Any, Bool, Callable, Dict, Integer, List, Unicode, Union
 
-from .orm import Base, CreditsProject, CreditsUser, CreditsUserValues
+from .balances import CreditsBalanceCache
+from .billing import BillableSpawners, BillingResult
+from .cache import TTLCache, VersionStamps, auth_state_hash
+from .ledger import CreditsLedgerBuffer
+from .matching import (
+    UserOptionsIndex,
+    compile_user_options,
+    user_options_fingerprint,
+)
+from .metrics import (
+    CREDITS_SERVERS_STOPPED,
+    CREDITS_SPAWNERS_BILLED,
+    CREDITS_TASK_PHASE_DURATION_SECONDS,
+    CREDITS_TASK_ROWS,
+    CreditsPhaseTimer,
+    CreditsTaskPhase,
+)
+from .orm import (
+    Base,
+    CreditsProject,
+    CreditsUser,
+    CreditsUserValues,
+    upgrade_tables,
+)
+from .scheduler import CREDITS_GRANTS, DeadlineScheduler
+
+_NOT_CACHED = object()
+
+# Configured keys stored by credits_store_user_values()
+GRANT_CONFIG_KEYS = ("cap", "grant_value", "grant_interval")
+CREDITS_CONFIG_KEYS = GRANT_CONFIG_KEYS + ("user_options",)
+PROJECT_CONFIG_KEYS = ("name",) + GRANT_CONFIG_KEYS
+
+
+def _sqlite_wal(dbapi_connection, connection_record):
+    cursor = dbapi_connection.cursor()
+    cursor.execute("PRAGMA journal_mode=WAL")
+    # Durable at checkpoints, which is enough with the write-ahead log
+    cursor.execute("PRAGMA synchronous=NORMAL")
+    cursor.close()
 
 
 class CreditsAuthenticator(Authenticator):
     credits_task = None
+    credits_refresh_task = None
     user_credits_dict = {}
+    # Spawners with running servers, billed by the credit task
+    credits_billable = None
+    # Deadlines of the bills and grants of the credit task
+    credits_scheduler = None
+    # Thread pool, if credits_db_threads is set
+    _credits_executor = None
+    # Engine and scoped sessions of the credit tables, see credits_own_sessions
+    _credits_engine = None
+    _credits_sessions = None
     credits_task_event = None
+    # time.monotonic() of the last run of the post hook
+    _credits_task_notified = None
+    # Rows written by each commit of the last credit task run
+    credits_flush_rows = []
+    _credits_rows_pending = 0
+    # Ledger entries written in the next credit task run
+    credits_ledger_buffer = None
+    # CreditsBalanceCache, if credits_balance_cache is enabled
+    credits_balances = None
+    # Phase durations of the running credit task run
+    _credits_phases = None
+    # Compiled user_options matchers by configuration fingerprint
+    _credits_matchers = None
+    # User name -> (value ids, UserOptionsIndex) of their credit values
+    _credits_indexes = None
+    credits_matcher_cache_size = 1024
+    # Results of the credits_user callable, if credits_user_cache_ttl is set
+    _credits_user_cache = None
+    # User name -> (credits_auth_key(), task) of the running update_user_credit()
+    _credits_user_updates = None
 
     credits_enabled = Bool(
         default_value=os.environ.get("JUPYTERHUB_CREDITS_ENABLED", "1").lower()
@@ -36,15 +110,242 @@ class CreditsAuthenticator(Authenticator):
     credits_task_interval = Integer(
         default_value=int(os.environ.get("JUPYTERHUB_CREDITS_TASK_INTERVAL", "60")),
         help="""
-        Interval, in seconds, at which the background credit task runs.
+        Maximum interval, in seconds, between two runs of the background
+        credit task.
 
         This task is responsible for billing running servers and granting
-        credits to users periodically.
+        credits to users periodically. It keeps the time of the next bill
+        of each running server and of the next grant, and wakes up when
+        one of them is due, at least every `credits_task_interval` seconds.
+        The auth of the users is refreshed separately, see
+        `credits_refresh_concurrency`.
 
         Default: 60 seconds.
         """,
     ).tag(config=True)
 
+    credits_batch_commit = Bool(
+        default_value=os.environ.get("JUPYTERHUB_CREDITS_BATCH_COMMIT", "0").lower()
+        in ["1", "true"],
+        help="""
+        Commit all grants and bills of a credit task run in one transaction.
+
+        By default every grant and every bill is committed on its own.
+        With batched commits enabled, all changes are collected and committed
+        once per run (or once per `credits_batch_commit_size` users).
+        Changes of each user are wrapped in a savepoint, so an error for
+        one user only rolls back the changes of this user.
+
+        The number of rows written by each commit of the last run is
+        available in `CreditsAuthenticator.credits_flush_rows`.
+
+        Default: disabled.
+        """,
+    ).tag(config=True)
+
+    credits_batch_commit_size = Integer(
+        default_value=int(os.environ.get("JUPYTERHUB_CREDITS_BATCH_COMMIT_SIZE", "0")),
+        help="""
+        Number of users whose changes are committed together, if
+        `credits_batch_commit` is enabled.
+
+        0 commits all changes of a credit task run at once.
+
+        Default: 0
+        """,
+    ).tag(config=True)
+
+    credits_lazy_grants = Bool(
+        default_value=os.environ.get("JUPYTERHUB_CREDITS_LAZY_GRANTS", "0").lower()
+        in ["1", "true"],
+        help="""
+        Compute granted credits when they're read instead of writing them
+        in every credit task run.
+
+        The balance at any time follows from the stored `balance`, `cap`,
+        `grant_value`, `grant_interval` and `grant_last_update`. With lazy
+        grants enabled the credit task no longer updates these rows. The API
+        reports the effective balance, and the stored balance is only
+        updated when a server is billed, an admin changes the credits or
+        the configured cap or grants change.
+
+        Default: disabled.
+        """,
+    ).tag(config=True)
+
+    credits_db_threads = Integer(
+        default_value=int(os.environ.get("JUPYTERHUB_CREDITS_DB_THREADS", "0")),
+        help="""
+        Number of threads running the database work of the credits.
+
+        By default the credit task, the credit updates at login and the
+        credits API use the Hub's database session on the event loop. A
+        slow credit task run then delays all other requests of the Hub.
+        With threads, this work runs in a thread pool with its own database
+        engine and one session per thread, and the event loop only waits
+        for the results.
+
+        Use 1 to keep all credit changes in order, like on the event loop.
+
+        Default: 0 (use the event loop)
+        """,
+    ).tag(config=True)
+
+    credits_db_url = Unicode(
+        default_value=os.environ.get("JUPYTERHUB_CREDITS_DB_URL", ""),
+        help="""
+        URL of the database with the credit tables.
+
+        If set, the credits use their own engine, connection pool and
+        sessions, also without `credits_db_threads`, instead of the Hub's
+        session. A slow or failing credit transaction then doesn't affect
+        the Hub's own database work. This may be the Hub's `db_url`, to
+        only separate the connections, or another database, e.g. a local
+        SQLite file with `credits_db_sqlite_wal`. The tables are created
+        there at startup.
+
+        Default: "" (the Hub's database and, without `credits_db_threads`,
+        the Hub's session)
+        """,
+    ).tag(config=True)
+
+    credits_db_kwargs = Dict(
+        help="""
+        Additional keyword arguments for `create_engine()` of the credits
+        engine, like the Hub's `db_kwargs`.
+
+        Used with `credits_db_url` or `credits_db_threads`, e.g. to size
+        the connection pool::
+
+            c.CreditsAuthenticator.credits_db_kwargs = {
+                "pool_size": 10,
+                "max_overflow": 5,
+            }
+        """,
+    ).tag(config=True)
+
+    credits_db_sqlite_wal = Bool(
+        default_value=os.environ.get("JUPYTERHUB_CREDITS_DB_SQLITE_WAL", "0").lower()
+        in ["1", "true"],
+        help="""
+        Use the write-ahead log for SQLite databases of the credits engine.
+
+        Readers then don't block the credit task's writes and vice versa.
+        The journal mode is stored in the database file, so it stays in WAL
+        mode for all connections, also the Hub's, if it's the same file.
+
+        Default: disabled.
+        """,
+    ).tag(config=True)
+
+    credits_ledger = Bool(
+        default_value=os.environ.get("JUPYTERHUB_CREDITS_LEDGER", "0").lower()
+        in ["1", "true"],
+        help="""
+        Record every change of a balance in the `credits_ledger` table.
+
+        Grants, bills, reductions to the cap and changes by admins are
+        recorded with the amount, the resulting balance, the billed server
+        (if any) and the time. Entries are collected in memory and written
+        with one bulk INSERT per credit task run. Set-based grants are
+        copied with one INSERT ... SELECT per table.
+
+        The table grows with every grant of every user value, consider
+        longer grant intervals or removing old entries regularly.
+
+        Default: disabled.
+        """,
+    ).tag(config=True)
+
+    credits_balance_cache = Bool(
+        default_value=os.environ.get("JUPYTERHUB_CREDITS_BALANCE_CACHE", "0").lower()
+        in ["1", "true"],
+        help="""
+        Keep the balances of all users and projects in memory.
+
+        The balances are loaded at startup. The credit task then grants and
+        bills in memory, and the credits API, the event streams and the
+        balance check before a spawn read from memory. Changes are written
+        to the database in batches, see
+        `credits_balance_cache_flush_interval` and
+        `credits_balance_cache_max_changes`, and when the Hub stops.
+        Configuration changes at login and changes by admins are written
+        to the database right away.
+
+        Balances are written together with the bill timestamps and grant
+        times. If the Hub crashes, the changes since the last flush are
+        lost, but the servers are billed and the credits granted again for
+        this time after the restart.
+
+        Grants are applied one row at a time in memory, set-based grants
+        are not used. Only one Hub may use the credit tables with this
+        enabled.
+
+        Default: disabled.
+        """,
+    ).tag(config=True)
+
+    credits_balance_cache_flush_interval = Integer(
+        default_value=int(
+            os.environ.get("JUPYTERHUB_CREDITS_BALANCE_CACHE_FLUSH_INTERVAL", "300")
+        ),
+        help="""
+        Maximum time, in seconds, changes of the balance cache stay in memory.
+
+        The changes are written after the credit task run in which they
+        became older than this. At most this much billing and granting is
+        lost (and repeated after a restart) if the Hub crashes.
+
+        Default: 300 seconds.
+        """,
+    ).tag(config=True)
+
+    credits_balance_cache_max_changes = Integer(
+        default_value=int(
+            os.environ.get("JUPYTERHUB_CREDITS_BALANCE_CACHE_MAX_CHANGES", "10000")
+        ),
+        help="""
+        Maximum number of grants and bills kept in the balance cache before
+        they're written to the database.
+
+        Checked after each credit task run. 0 disables the limit.
+
+        Default: 10000
+        """,
+    ).tag(config=True)
+
+    credits_refresh_concurrency = Integer(
+        default_value=int(
+            os.environ.get("JUPYTERHUB_CREDITS_REFRESH_CONCURRENCY", "10")
+        ),
+        help="""
+        Maximum number of users whose auth is refreshed at the same time
+        by the credit refresh task.
+
+        The refresh task calls `refresh_user()` for the users with servers
+        every `auth_refresh_age` seconds (or every `credits_task_interval`
+        seconds, if `auth_refresh_age` is 0). Users whose auth was refreshed
+        less than `auth_refresh_age` seconds ago, e.g. by a request, are
+        skipped. It runs separately from billing, so a slow identity
+        provider doesn't delay the credit task.
+
+        Default: 10
+        """,
+    ).tag(config=True)
+
+    credits_refresh_timeout = Integer(
+        default_value=int(os.environ.get("JUPYTERHUB_CREDITS_REFRESH_TIMEOUT", "30")),
+        help="""
+        Timeout, in seconds, for refreshing the auth of one user in the
+        credit refresh task.
+
+        The refresh is cancelled and retried in the next refresh run.
+        0 disables the timeout.
+
+        Default: 30 seconds.
+        """,
+    ).tag(config=True)
+
     credits_user = Union(
         [Dict(), List(), Callable()],
         default_value=None,
@@ -133,6 +434,47 @@ class CreditsAuthenticator(Authenticator):
         """,
     ).tag(config=True)
 
+    credits_user_cache_ttl = Integer(
+        default_value=int(os.environ.get("JUPYTERHUB_CREDITS_USER_CACHE_TTL", "0")),
+        help="""
+        Time, in seconds, to reuse the result of a `credits_user` callable.
+
+        Results are cached by user name, groups, admin flag and a hash of
+        the auth_state, so a changed auth_state or group membership calls
+        it again. Use this if `credits_user` asks slow systems (e.g. LDAP
+        or a project directory), which would otherwise be asked at every
+        login and auth refresh. Call `credits_user_cache_invalidate()` to
+        forget cached results, e.g. after a change upstream.
+
+        0 disables the cache.
+
+        Default: 0
+        """,
+    ).tag(config=True)
+
+    credits_user_cache_size = Integer(
+        default_value=int(os.environ.get("JUPYTERHUB_CREDITS_USER_CACHE_SIZE", "1024")),
+        help="""
+        Maximum number of cached `credits_user` results, see
+        `credits_user_cache_ttl`. The least recently used are dropped first.
+
+        Default: 1024
+        """,
+    ).tag(config=True)
+
+    credits_api_batch_limit = Integer(
+        default_value=int(os.environ.get("JUPYTERHUB_CREDITS_API_BATCH_LIMIT", "1000")),
+        help="""
+        Maximum number of items in one request to the batch endpoint
+        `/api/credits/batch`. Bigger batches are rejected with status 413.
+
+        All items of a batch are validated, loaded and written in one
+        transaction, so the limit bounds the time the database is locked.
+
+        Default: 1000
+        """,
+    ).tag(config=True)
+
     credits_task_post_hook = Any(
         default_value=None,
         help="""
@@ -189,358 +531,1034 @@ class CreditsAuthenticator(Authenticator):
             _project["display_name"] = project_name
         return _project
 
+    def user_options_matcher(self, user_options_configured):
+        """Compiled matcher of configured user_options.
+
+        Matchers are cached by the fingerprint of the configuration, so
+        patterns are compiled once and not for every spawner and bill.
+        """
+        key = user_options_fingerprint(user_options_configured)
+        matcher = self._credits_matchers.get(key, None)
+        if matcher is None:
+            if len(self._credits_matchers) >= self.credits_matcher_cache_size:
+                self._credits_matchers.clear()
+            matcher = compile_user_options(user_options_configured, self.log)
+            self._credits_matchers[key] = matcher
+        return matcher
+
+    def credits_user_values_index(self, credit_user):
+        """UserOptionsIndex of the credit values of a user.
+
+        Cached per user for the ids of their values. user_options are
+        only changed by update_user_credit(), which drops the cached index.
+        """
+        values = credit_user.credits_user_values
+        key = tuple([cuv.id for cuv in values])
+        cached = self._credits_indexes.get(credit_user.name, None)
+        if cached is not None and cached[0] == key:
+            return cached[1]
+        index = UserOptionsIndex(
+            [cuv.user_options for cuv in values], self.user_options_matcher
+        )
+        if len(self._credits_indexes) >= self.credits_matcher_cache_size:
+            self._credits_indexes.clear()
+        self._credits_indexes[credit_user.name] = (key, index)
+        return index
+
+    def credits_invalidate_user_values(self, user_name):
+        """Forget the cached UserOptionsIndex of a user"""
+        self._credits_indexes.pop(user_name, None)
+
+    def credits_user_values_for(self, credit_user, user_options, defaults_last=True):
+        """CreditsUserValues of a user to use for a spawner's user_options.
+
+        The first values whose configured user_options match are used.
+        With defaults_last values without user_options are only used if
+        nothing else matches (the last of them), otherwise they match any
+        user_options at their position. Returns None without a match.
+        """
+        position = self.credits_user_values_index(credit_user).resolve(
+            user_options, defaults_last
+        )
+        if position is None:
+            return None
+        return credit_user.credits_user_values[position]
+
     def match_user_options(self, user_options_spawner, user_options_configured):
         if not user_options_configured:
             return True
-        for key, value in user_options_configured.items():
-            uo_value = user_options_spawner[key]
-            if type(uo_value) == list and len(uo_value) == 1:
-                uo_value = uo_value[0]
-            if key not in user_options_spawner.keys():
-                self.log.debug(
-                    f"Key {key} not found in spawner user_options {user_options_spawner}. Return False."
+        return self.user_options_matcher(user_options_configured).match(
+            user_options_spawner
+        )
+
+    def _credits_count_flush(self, session, flush_context):
+        # Called after each flush of the hub session. The new, dirty and
+        # deleted collections still show the state from before the flush.
+        for obj in session.new:
+            if isinstance(obj, Base):
+                self._credits_rows_pending += 1
+        for obj in session.deleted:
+            if isinstance(obj, Base):
+                self._credits_rows_pending += 1
+        for obj in session.dirty:
+            if isinstance(obj, Base) and session.is_modified(obj):
+                self._credits_rows_pending += 1
+
+    @contextmanager
+    def credits_phase(self, phase):
+        """Count the time spent in `phase` of the running credit task run"""
+        if self._credits_phases is None:
+            yield
+            return
+        with self._credits_phases.phase(phase):
+            yield
+
+    def credits_ledger_flush(self):
+        """Write the buffered ledger entries, without commit"""
+        if not self.credits_ledger:
+            return 0
+        with self.credits_phase(CreditsTaskPhase.commit):
+            rows = self.credits_ledger_buffer.flush(self.credits_db)
+        self._credits_rows_pending += rows
+        return rows
+
+    def credits_flush(self):
+        """Commit all pending credit changes"""
+        with self.credits_phase(CreditsTaskPhase.commit):
+            self.credits_db.commit()
+        # Changes committed inside a savepoint() can't be undone anymore
+        self.credits_ledger_buffer.keep()
+        rows = self._credits_rows_pending
+        self._credits_rows_pending = 0
+        self.credits_flush_rows.append(rows)
+        if self.credits_batch_commit:
+            self.log.debug(f"Credit task committed {rows} rows")
+        return rows
+
+    def credits_commit(self):
+        """Commit credit changes, unless they're committed in batches"""
+        if self.credits_balances is not None:
+            # Written by the next flush of the balance cache
+            self.credits_balances.changes += 1
+        elif not self.credits_batch_commit:
+            self.credits_flush()
+
+    def credits_balances_flush(self):
+        """Write and commit the changes of the balance cache"""
+        with self.credits_phase(CreditsTaskPhase.commit):
+            rows = self.credits_balances.flush(self.credits_db)
+        self._credits_rows_pending += rows
+        self.credits_ledger_flush()
+        rows = self.credits_flush()
+        self.credits_balances.flushed()
+        self.log.debug(f"Wrote {rows} rows of the credits balance cache")
+        return rows
+
+    def credits_balances_load(self):
+        """Load the balance cache. Returns the number of users"""
+        return self.credits_balances.load(self.credits_db)
+
+    def credits_balances_shutdown(self):
+        """Write the balance cache when the Hub stops.
+
+        Called when the Hub cancels the credit task at shutdown, while its
+        event loop and database are still there. Returns False if the
+        changes couldn't be written.
+        """
+        if self.credits_balances is None:
+            return True
+        try:
+            with self.credits_balances.lock:
+                if self.credits_balances.dirty or len(self.credits_ledger_buffer):
+                    if self.credits_own_sessions:
+                        self._credits_run_in_session(self.credits_balances_flush, ())
+                    else:
+                        self.credits_balances_flush()
+        except:
+            self.log.exception("Error while writing the credits balance cache.")
+            return False
+        return True
+
+    def credits_balances_atexit(self):
+        """Fallback of credits_balances_shutdown() at interpreter exit.
+
+        Only writes something if the credit task didn't, e.g. because the
+        Hub exited without cancelling its tasks.
+        """
+        if not self.credits_balances_shutdown():
+            self.log.error(
+                "Changes of the credits balance cache since its last flush are lost."
+            )
+
+    def credits_locked(self, func, *args):
+        """Run `func(*args)` holding the lock of the balance cache, if it's used"""
+        if self.credits_balances is None:
+            return func(*args)
+        with self.credits_balances.lock:
+            return func(*args)
+
+    def credits_write(self, user_name, project_name, func, *args):
+        """Run `func(*args)`, which writes credits to the database.
+
+        With the balance cache, its changes are written before and the
+        credits of `user_name` and `project_name` are loaded again after.
+        Both may also be lists of names.
+        """
+        cache = self.credits_balances
+        if cache is None:
+            return func(*args)
+        user_names = [user_name] if isinstance(user_name, str) else user_name
+        project_names = (
+            [project_name] if isinstance(project_name, str) else project_name
+        )
+        with cache.lock:
+            if cache.dirty:
+                self.credits_balances_flush()
+            try:
+                return func(*args)
+            finally:
+                for name in project_names or []:
+                    cache.load_project(self.credits_db, name)
+                for name in user_names or []:
+                    cache.load_user(self.credits_db, name)
+
+    def credits_get_user(self, user_name, refresh=False):
+        """Credits of a user with their values and projects, or None.
+
+        From the balance cache, if it's used, otherwise the CreditsUser
+        from the database. Only for reading. Cached users are copied, so
+        credit task runs in other threads don't change them meanwhile.
+        """
+        if self.credits_balances is not None:
+            with self.credits_balances.lock:
+                return copy.deepcopy(self.credits_balances.users.get(user_name, None))
+        return CreditsUser.get_user(self.credits_db, user_name, refresh=refresh)
+
+    @contextmanager
+    def credits_savepoint(self, credit_user=None, project=None):
+        """Undo the changes of one user or project, if the block raises.
+
+        With the balance cache, the cached balances and bills of
+        `credit_user` (and their projects) or `project` are restored. If
+        commits are batched, the changes are rolled back to a savepoint.
+        Otherwise each change is committed right away, and only the
+        uncommitted ones are rolled back. The ledger entries of the undone
+        changes are dropped.
+        """
+        with self.credits_ledger_buffer.scope():
+            if self.credits_balances is not None:
+                snapshot = self.credits_balances.snapshot(credit_user, project)
+                try:
+                    yield
+                except:
+                    self.credits_balances.restore(snapshot)
+                    raise
+                return
+            if not self.credits_batch_commit:
+                try:
+                    yield
+                except:
+                    self.credits_db.rollback()
+                    raise
+                return
+            connection = self.credits_db.connection()
+            if connection.dialect.name == "sqlite":
+                # pysqlite starts a transaction right before the first
+                # INSERT/UPDATE/DELETE. Without an open transaction the
+                # SAVEPOINT would become the outermost one and RELEASE would
+                # commit it.
+                if not connection.connection.dbapi_connection.in_transaction:
+                    connection.exec_driver_sql("BEGIN")
+            with self.credits_db.begin_nested():
+                yield
+
+    def credits_grant(self, now):
+        """Grant credits to all projects and user values.
+
+        Runs as set-based UPDATE statements, so the costs don't depend
+        on the number of users loaded into memory.
+        """
+        ledger_rows = 0
+        with self.credits_phase(CreditsTaskPhase.project_grant):
+            if self.credits_ledger:
+                ledger_rows += CreditsProject.record_grants(self.credits_db, now)
+            rows = CreditsProject.grant_all(self.credits_db, now)
+        with self.credits_phase(CreditsTaskPhase.user_grant):
+            if self.credits_ledger:
+                ledger_rows += CreditsUserValues.record_grants(self.credits_db, now)
+            rows += CreditsUserValues.grant_all(self.credits_db, now)
+        self._credits_rows_pending += rows + ledger_rows
+        self.credits_commit()
+        if rows:
+            self.log.debug(
+                f"Granted credits to {rows} projects and user values",
+                extra={"action": "creditsgained"},
+            )
+        return rows
+
+    def credits_grant_projects(self, now):
+        """Grant credits to all projects, one row at a time.
+
+        Fallback for databases without support for the set-based grants.
+        Each project is granted once, no matter how many users share it.
+        """
+        if self.credits_balances is not None:
+            projects = list(self.credits_balances.projects.values())
+        else:
+            projects = self.credits_db.query(CreditsProject).populate_existing()
+        for project in projects:
+            try:
+                with self.credits_savepoint(project=project):
+                    self.credits_grant_project(project, now)
+                if self.credits_balances is not None:
+                    self.credits_balances.touch_project(project)
+            except:
+                self.log.exception(
+                    f"Error while updating project credits for {project.name}. Its uncommitted changes are rolled back."
                 )
-                return False
-            if type(value) == list:
-                self.log.debug(
-                    f"Check if spawner user_option {key} value {uo_value} is in configured list {value}"
+
+    def credits_ledger_record(self, kind, credits, amount, now, spawner=None):
+        """Add a change of a balance to the ledger, if it's enabled"""
+        if self.credits_ledger and amount:
+            self.credits_ledger_buffer.add(kind, credits, amount, now, spawner)
+
+    def credits_ledger_materialize(self, credits, now):
+        """materialize() the balance of credits, adding its grants to the ledger"""
+        prev_balance = credits.balance
+        if credits.materialize(now):
+            self.credits_ledger_record(
+                "grant", credits, credits.balance - prev_balance, now
+            )
+
+    def credits_grant_per_row(self, credit_user, now):
+        """Grant credits to the values of one user.
+
+        Fallback for databases without support for the set-based grants.
+        Their projects are granted before by credits_grant_projects().
+        """
+        for credits in credit_user.credits_user_values:
+            try:
+                with self.credits_phase(CreditsTaskPhase.user_grant):
+                    prev_balance = credits.balance
+                    cap = credits.cap
+                    updated = False
+                    if prev_balance > cap:
+                        credits.balance = cap
+                        updated = True
+                        self.credits_ledger_record(
+                            "cap", credits, cap - prev_balance, now
+                        )
+                    else:
+                        elapsed = (now - credits.grant_last_update).total_seconds()
+                        if elapsed >= credits.grant_interval:
+                            updated = True
+                            grants = int(elapsed // credits.grant_interval)
+                            gained = grants * credits.grant_value
+                            credits.balance = min(prev_balance + gained, cap)
+                            credits.grant_last_update += timedelta(
+                                seconds=grants * credits.grant_interval
+                            )
+                            self.credits_ledger_record(
+                                "grant", credits, credits.balance - prev_balance, now
+                            )
+                            self.log.debug(
+                                f"User {credit_user.name} ({credits.name}): {prev_balance} -> {credits.balance} "
+                                f"(+{gained}, cap {credits.cap})",
+                                extra={
+                                    "action": "creditsgained",
+                                    "username": credit_user.name,
+                                    "creditsname": credits.name,
+                                },
+                            )
+                    if updated:
+                        self.credits_commit()
+            except:
+                self.log.exception(f"Error while updating user credits for {credits}.")
+
+    def credits_grant_project(self, project, now):
+        """Grant credits to one project"""
+        proj_prev_balance = project.balance
+        proj_cap = project.cap
+        proj_updated = False
+        if proj_prev_balance > proj_cap:
+            project.balance = proj_cap
+            proj_updated = True
+            self.credits_ledger_record(
+                "cap", project, proj_cap - proj_prev_balance, now
+            )
+        elif proj_prev_balance < proj_cap:
+            elapsed = (now - project.grant_last_update).total_seconds()
+            if elapsed > project.grant_interval:
+                proj_updated = True
+                grants = int(elapsed // project.grant_interval)
+                gained = grants * project.grant_value
+                project.balance = min(proj_prev_balance + gained, proj_cap)
+                project.grant_last_update += timedelta(
+                    seconds=grants * project.grant_interval
+                )
+                self.credits_ledger_record(
+                    "grant", project, project.balance - proj_prev_balance, now
                 )
-                if uo_value not in value:
-                    return False
-            elif type(value) == str:
                 self.log.debug(
-                    f"Check if spawner user_option {key} value {uo_value} matches regex pattern {value}"
+                    f"Project {project.name}: {proj_prev_balance} -> {project.balance} "
+                    f"(+{gained}, cap {project.cap})",
+                    extra={
+                        "action": "creditsgained",
+                        "projectname": project.name,
+                    },
                 )
-                try:
-                    if re.fullmatch(value, str(uo_value)) is None:
+        if proj_updated:
+            self.credits_commit()
+
+    def credits_bill_user(self, credit_user, spawners, stopped, now, result):
+        """Bill the running servers of a user.
+
+        `spawners` are SpawnerSnapshots of the due spawners, `stopped` the
+        ids of stopped spawners whose bill timestamps are removed. The next
+        bill times and the servers without enough credits are collected in
+        the BillingResult `result`.
+        """
+        for spawner_id in stopped:
+            credit_user.spawner_bills.pop(spawner_id, None)
+        for spawner in spawners:
+            key = (spawner.user_name, spawner.name)
+            if not spawner.billing_interval:
+                continue
+            if not spawner.billing_value:
+                continue
+
+            try:
+                bill = credit_user.spawner_bills.get(spawner.orm_id, None)
+                if not spawner.active:
+                    if bill is not None:
+                        del credit_user.spawner_bills[spawner.orm_id]
+                    result.next_bills[key] = None
+                    continue
+                if not spawner.ready:
+                    result.next_bills[key] = now + timedelta(
+                        seconds=self.credits_task_interval
+                    )
+                    continue
+                last_billed = None
+                # When restarting the Hub the last bill timestamp
+                # will be stored in the database. Use this one.
+                force_bill = False
+                if bill is not None:
+                    last_billed = bill.last_billed
+                    # If the last bill timestamp is older than started, it's from
+                    # a previous running lab and should not be used.
+                    if last_billed < spawner.started:
+                        force_bill = True
+                        last_billed = now
+                else:
+                    # If no bill timestamp is available we'll use the current timestamp
+                    # Using started would be unfair, since we don't know how long it took
+                    # to actually be usable. Users should only "pay" for ready spawners.
+                    force_bill = True
+                    last_billed = now
+
+                elapsed = (now - last_billed).total_seconds()
+                # Without a bill this run, the spawner is due after the interval
+                result.next_bills[key] = last_billed + timedelta(
+                    seconds=spawner.billing_interval
+                )
+                if elapsed >= spawner.billing_interval or force_bill:
+                    user_options = spawner.user_options
+                    # Find the correct CreditsUserValues and Project entry for this spawner
+                    user_credits_for_spawner = None
+                    if spawner.values_id is not None:
+                        # Resolved by a previous bill of this server
+                        for cuv in credit_user.credits_user_values:
+                            if cuv.id == spawner.values_id:
+                                user_credits_for_spawner = cuv
+                                break
+                    if user_credits_for_spawner is None:
+                        user_credits_for_spawner = self.credits_user_values_for(
+                            credit_user, user_options
+                        )
+                        if user_credits_for_spawner:
+                            result.values_ids[key] = (
+                                user_credits_for_spawner.id,
+                                spawner.values_generation,
+                            )
+                    if not user_credits_for_spawner:
+                        self.log.warning(
+                            f"No matching CreditsUserValues found for spawner {spawner.log_name}. Stop Spawner."
+                        )
+                        if key not in result.to_stop:
+                            result.to_stop.append(key)
+                        # The bill time is in the past, check again after
+                        # the stop instead of right away
+                        result.next_bills[key] = now + timedelta(
+                            seconds=self.credits_task_interval
+                        )
+                        continue
+                    available_balance = 0
+                    project_credits_for_spawner = None
+                    self.log.debug(
+                        f"Using user credits '{user_credits_for_spawner.name}' for spawner {spawner.log_name}"
+                    )
+                    if user_credits_for_spawner.project:
+                        project_credits_for_spawner = user_credits_for_spawner.project
                         self.log.debug(
-                            f"Pattern {value} does not match value {uo_value}."
+                            f"Using project credits '{project_credits_for_spawner.name}' for spawner {spawner.log_name}"
+                        )
+                    if self.credits_lazy_grants:
+                        prev_balance = user_credits_for_spawner.effective_balance(now)
+                    else:
+                        prev_balance = user_credits_for_spawner.balance
+                    available_balance += prev_balance
+                    if project_credits_for_spawner:
+                        if self.credits_lazy_grants:
+                            proj_prev_balance = (
+                                project_credits_for_spawner.effective_balance(now)
+                            )
+                        else:
+                            proj_prev_balance = project_credits_for_spawner.balance
+                        available_balance += proj_prev_balance
+
+                    # When force_bill is true we have to make sure to bill the first
+                    # interval as well
+                    bills = max(
+                        int(elapsed // spawner.billing_interval),
+                        1,
+                    )
+                    cost = bills * spawner.billing_value
+                    if cost > available_balance:
+                        # Stop Server. Not enough credits left for next interval
+                        if key not in result.to_stop:
+                            result.to_stop.append(key)
+                        result.next_bills[key] = now + timedelta(
+                            seconds=self.credits_task_interval
+                        )
+                        self.log.info(
+                            f"User Credits exceeded. Stopping Server '{spawner.user_name}:{spawner.name}' (Credits available: {available_balance}, Cost: {cost})",
+                            extra={
+                                "action": "creditsexceeded",
+                                "userid": spawner.user_id,
+                                "username": spawner.user_name,
+                                "servername": spawner.name,
+                            },
                         )
-                        return False
-                except re.error:
-                    try:
-                        if (
-                            re.fullmatch(fnmatch.translate(value), str(uo_value))
-                            is None
-                        ):
+                    else:
+                        if self.credits_lazy_grants:
+                            # Store the granted credits before billing them
+                            self.credits_ledger_materialize(
+                                user_credits_for_spawner, now
+                            )
+                            if project_credits_for_spawner:
+                                self.credits_ledger_materialize(
+                                    project_credits_for_spawner, now
+                                )
+                        if project_credits_for_spawner:
+                            if cost > project_credits_for_spawner.balance:
+                                proj_cost = project_credits_for_spawner.balance
+                            else:
+                                proj_cost = cost
+                            project_credits_for_spawner.balance -= proj_cost
+                            result.billed_projects.add(project_credits_for_spawner.name)
+                            cost -= proj_cost
+                            self.credits_ledger_record(
+                                "bill",
+                                project_credits_for_spawner,
+                                -proj_cost,
+                                now,
+                                spawner,
+                            )
                             self.log.debug(
-                                f"Pattern {value} does not match value {uo_value}."
+                                f"Project {project_credits_for_spawner.name} credits recuded by {proj_cost} ({proj_prev_balance} -> {project_credits_for_spawner.balance}) for server '{spawner.log_name}' ({elapsed}s since last bill timestamp)",
+                                extra={
+                                    "action": "creditspaid",
+                                    "userid": spawner.user_id,
+                                    "username": spawner.user_name,
+                                    "servername": spawner.name,
+                                    "projectname": project_credits_for_spawner.name,
+                                },
                             )
-                            return False
-                    except re.error:
-                        self.log.warning(
-                            f"Invalid regex pattern {value} for user_option {key}. Check if strings are equal."
+
+                        user_credits_for_spawner.balance -= cost
+                        self.credits_ledger_record(
+                            "bill", user_credits_for_spawner, -cost, now, spawner
                         )
-                        if uo_value != value:
-                            return False
-            elif type(value) in [int, float, bool]:
-                self.log.debug(
-                    f"Check if spawner user_option {key} value {uo_value} equals configured value {value}"
+                        if not force_bill:
+                            last_billed += timedelta(
+                                seconds=bills * spawner.billing_interval
+                            )
+                        self.log.debug(
+                            f"User {spawner.user_name} credits recuded by {cost} ({prev_balance} -> {user_credits_for_spawner.balance}) for server '{spawner.log_name}' ({elapsed}s since last bill timestamp)",
+                            extra={
+                                "action": "creditspaid",
+                                "userid": spawner.user_id,
+                                "username": spawner.user_name,
+                                "servername": spawner.name,
+                            },
+                        )
+                        if bill is None:
+                            bill = credit_user.add_spawner_bill(spawner.orm_id)
+                        bill.last_billed = last_billed
+                        bill.billing_value = spawner.billing_value
+                        bill.billing_interval = spawner.billing_interval
+                        result.next_bills[key] = last_billed + timedelta(
+                            seconds=spawner.billing_interval
+                        )
+                        result.billed += 1
+                        self.credits_commit()
+            except:
+                self.log.exception(
+                    f"Error while updating user credits for {credit_user} in spawner {spawner.log_name}."
                 )
-                if uo_value != value:
-                    return False
-            elif type(value) == dict:
-                self.log.debug(
-                    f"Check if spawner user_option {key} value {uo_value} matches configured dict {value}"
+                result.next_bills[key] = now + timedelta(
+                    seconds=self.credits_task_interval
                 )
-                if not self.match_user_options(uo_value, value):
-                    return False
+
+    def credits_next_grant_time(self, now):
+        """Deadline of the next grant of any project or user value"""
+        if self.credits_lazy_grants:
+            return None
+        if self.credits_balances is not None or (
+            not CreditsUserValues.supports_set_based_grants(self.credits_db)
+        ):
+            # The per-row grants look at every user in each regular run
+            return now + timedelta(seconds=self.credits_task_interval)
+        deadlines = [
+            x
+            for x in (
+                CreditsProject.next_grant_time(self.credits_db),
+                CreditsUserValues.next_grant_time(self.credits_db),
+            )
+            if x is not None
+        ]
+        if not deadlines:
+            return None
+        # Grants that are already due were changed after this run's
+        # grants (e.g. a project billed below its cap). Don't run again
+        # right away, so a mismatch can't keep the task busy.
+        return max(min(deadlines), now + timedelta(seconds=1))
+
+    async def credits_schedule_grants(self, now):
+        """Set the deadline of the next grant of any project or user value"""
+        when = await self.credits_run(self.credits_next_grant_time, now)
+        self.credits_set_grant_deadline(when)
+
+    def credits_set_grant_deadline(self, when):
+        if when is None:
+            self.credits_scheduler.cancel(CREDITS_GRANTS)
+        else:
+            self.credits_scheduler.schedule(CREDITS_GRANTS, when)
+
+    def credits_grant_deadline(self, credits):
+        """Time of the next grant of a project or user value, or None"""
+        if self.credits_lazy_grants or not credits.grant_last_update:
+            return None
+        if not credits.grant_interval or credits.grant_interval <= 0:
+            return None
+        return credits.grant_last_update + timedelta(seconds=credits.grant_interval)
+
+    def credits_schedule_grant(self, when):
+        """Wake the credit task for the grant of a changed project or user value"""
+        if when is not None:
+            self.credits_scheduler.schedule(CREDITS_GRANTS, when, keep_earlier=True)
+
+    async def credits_reconcile(self, now, credit_users=None):
+        """Grant credits and bill running servers, if they're due at `now`.
+
+        Only users with due spawners are billed. Their credit values and
+        projects are loaded after the grants, together in a constant number
+        of queries. Databases without set-based grants have to load all
+        users to grant their credits one by one. With `credits_lazy_grants`
+        nothing is granted here, the grants of billed balances are stored
+        while billing.
+
+        The database work runs through credits_run(), so it may run in a
+        credit database thread. The spawners and the scheduler are only
+        used here, on the event loop.
+        """
+        due = self.credits_scheduler.pop_due(now)
+        due_spawners = {}
+        for key in due:
+            if key == CREDITS_GRANTS:
+                continue
+            _, user_name, spawner_name = key
+            spawner = self.credits_billable.get(user_name, spawner_name)
+            if spawner:
+                due_spawners.setdefault(user_name, []).append(
+                    self.credits_billable.snapshot(spawner)
+                )
+        # Stopped spawners leave bill timestamps behind, which are removed
+        stopped = {
+            user_name: self.credits_billable.pop_stopped(user_name)
+            for user_name in self.credits_billable.stopped_user_names()
+        }
+        phases = self._credits_phases = CreditsPhaseTimer()
+        try:
+            result = await self.credits_run(
+                self.credits_locked,
+                self._credits_reconcile,
+                now,
+                CREDITS_GRANTS in due,
+                due_spawners,
+                stopped,
+                credit_users,
+            )
+        except:
+            # Parts may have been committed
+            self.credits_versions.touch_all()
+            # Retry the work in the next regular run
+            retry = now + timedelta(seconds=self.credits_task_interval)
+            for key in due:
+                self.credits_scheduler.schedule(key, retry, keep_earlier=True)
+            raise
+        finally:
+            self._credits_phases = None
+            phases.observe()
+        CREDITS_TASK_ROWS.labels(operation="read").observe(result.rows_read)
+        CREDITS_TASK_ROWS.labels(operation="written").observe(result.rows_written)
+        CREDITS_SPAWNERS_BILLED.inc(result.billed)
+        if result.granted:
+            self.credits_versions.touch_all()
+        for user_name in due_spawners.keys() | stopped.keys():
+            self.credits_versions.touch_user(user_name)
+        for project_name in result.billed_projects:
+            self.credits_versions.touch_project(project_name)
+        self.credits_apply_billing(result)
+
+    def _credits_reconcile(self, now, grants_due, due_spawners, stopped, credit_users):
+        # There are no awaits in here, so no other coroutine can commit
+        # or rollback the changes while they are collected in a batch.
+        result = BillingResult()
+        self.credits_flush_rows = []
+        self._credits_rows_pending = 0
+        billed_user_names = set(due_spawners.keys()) | set(stopped.keys())
+
+        cache = self.credits_balances
+        grants_due = grants_due and not self.credits_lazy_grants
+        set_based_grants = (
+            cache is None
+            and CreditsUserValues.supports_set_based_grants(self.credits_db)
+        )
+        per_row_grants = grants_due and not set_based_grants
+        if grants_due and set_based_grants:
+            result.granted = self.credits_grant(now) > 0
+        if per_row_grants:
+            result.granted = True
+            with self.credits_phase(CreditsTaskPhase.project_grant):
+                self.credits_grant_projects(now)
+        if credit_users is None and cache is not None:
+            if per_row_grants:
+                credit_users = list(cache.users.values())
             else:
-                self.log.debug(
-                    f"Unsupported type {type(value)} for user_option {key}. Check if strings are equal."
+                credit_users = [
+                    cache.users[name]
+                    for name in billed_user_names
+                    if name in cache.users
+                ]
+        elif credit_users is None:
+            query = (
+                CreditsUser.query_with_values(self.credits_db)
+                .options(selectinload(CreditsUser.spawner_bills))
+                .populate_existing()
+            )
+            if per_row_grants:
+                credit_users = query.all()
+            elif billed_user_names:
+                credit_users = query.filter(
+                    CreditsUser.name.in_(billed_user_names)
+                ).all()
+            else:
+                credit_users = []
+        for i, credit_user in enumerate(credit_users, start=1):
+            try:
+                with self.credits_savepoint(credit_user):
+                    if per_row_grants:
+                        self.credits_grant_per_row(credit_user, now)
+                    # All projects and user credits are updated.
+                    # Now check running spawners and bill credits
+                    if credit_user.name in billed_user_names:
+                        with self.credits_phase(CreditsTaskPhase.billing):
+                            self.credits_bill_user(
+                                credit_user,
+                                due_spawners.get(credit_user.name, []),
+                                stopped.get(credit_user.name, set()),
+                                now,
+                                result,
+                            )
+                if cache is not None:
+                    cache.touch_user(credit_user)
+            except:
+                self.log.exception(
+                    f"Error while updating user credits for {credit_user.name}. Their uncommitted changes are rolled back."
                 )
-                if str(uo_value) != str(value):
-                    return False
-        return True
+            if (
+                self.credits_batch_commit
+                and self.credits_batch_commit_size
+                and i % self.credits_batch_commit_size == 0
+            ):
+                self.credits_flush()
+        if cache is not None and cache.dirty:
+            if cache.flush_due(
+                self.credits_balance_cache_flush_interval,
+                self.credits_balance_cache_max_changes,
+            ):
+                self.credits_balances_flush()
+        else:
+            ledger_rows = self.credits_ledger_flush()
+            if self.credits_batch_commit or ledger_rows:
+                self.credits_flush()
+        projects = set()
+        # Nothing was read from the database with the balance cache
+        for credit_user in credit_users if cache is None else []:
+            for credits in credit_user.credits_user_values:
+                result.rows_read += 1
+                if credits.project_name:
+                    projects.add(credits.project_name)
+        result.rows_read += len(credit_users) + len(projects)
+        result.rows_written = sum(self.credits_flush_rows)
+        result.next_grant = self.credits_next_grant_time(now)
+        return result
 
-    async def credit_reconciliation_task(self):
+    def credits_apply_billing(self, result):
+        """Schedule the next bills and stop the servers without enough credits"""
+        for (user_name, spawner_name), values in result.values_ids.items():
+            spawner = self.credits_billable.get(user_name, spawner_name)
+            if spawner is not None:
+                self.credits_billable.set_values_id(spawner, *values)
+        for (user_name, spawner_name), when in result.next_bills.items():
+            spawner = self.credits_billable.get(user_name, spawner_name)
+            if spawner is None:
+                continue
+            if when is None:
+                self.credits_billable.discard(spawner)
+            else:
+                self.credits_billable.schedule(spawner, when)
+        for user_name, spawner_name in result.to_stop:
+            spawner = self.credits_billable.get(user_name, spawner_name)
+            if spawner is None:
+                continue
+            self.log.info(
+                f"Stopping spawner {spawner_name} for user {user_name} due to insufficient credits."
+            )
+            CREDITS_SERVERS_STOPPED.inc()
+            asyncio.create_task(spawner.user.stop(spawner_name))
+        self.credits_set_grant_deadline(result.next_grant)
+
+    def credits_sleep_time(self):
+        """Seconds until the next bill or grant is due"""
+        sleep_time = self.credits_task_interval
+        next_deadline = self.credits_scheduler.next_deadline()
+        if next_deadline is not None:
+            now = utcnow(with_tz=False)
+            sleep_time = min(sleep_time, (next_deadline - now).total_seconds())
+        return sleep_time
+
+    def credits_refresh_interval(self):
+        """Seconds between two runs of the credit refresh task"""
+        return self.auth_refresh_age or self.credits_task_interval
+
+    def credits_refresh_due(self, user, now):
+        """Auth of a user is refreshed if it's older than `auth_refresh_age`"""
+        refreshed = getattr(user, "_auth_refreshed", None)
+        if not self.auth_refresh_age or not refreshed:
+            return True
+        return now - refreshed >= self.auth_refresh_age
+
+    async def credits_refresh_user(self, user, semaphore):
+        async with semaphore:
+            # Refreshed by a request while waiting for the semaphore
+            if not self.credits_refresh_due(user, time.monotonic()):
+                return
+            try:
+                auth_info = await asyncio.wait_for(
+                    self.refresh_user(user), self.credits_refresh_timeout or None
+                )
+            except asyncio.TimeoutError:
+                self.log.warning(
+                    f"Refreshing user {user.name} in credit task timed out after {self.credits_refresh_timeout}s."
+                )
+            except:
+                self.log.exception(
+                    f"Error while refreshing user {user.name} in credit task."
+                )
+            else:
+                await self.credits_apply_refresh(user, auth_info)
+
+    async def credits_apply_refresh(self, user, auth_info):
+        """Apply the result of refresh_user() like JupyterHub's request path.
+
+        False requires a new login: the refresh time is cleared, so the
+        next request refreshes the user again and sends them to the login.
+        A new auth_state is stored. Other changes (admin, groups) are left
+        to the next request, which applies them with auth_to_user().
+        """
+        if not auth_info:
+            user._auth_refreshed = None
+            return
+        if isinstance(auth_info, dict):
+            if "auth_state" in auth_info:
+                await user.save_auth_state(auth_info["auth_state"])
+            if auth_info.keys() - {"name", "auth_state"}:
+                return
+        user._auth_refreshed = time.monotonic()
+
+    async def credits_refresh_users(self):
+        """Refresh the auth of all known users with credits, concurrently"""
+        user_names = await self.credits_run(self.credits_user_names)
+        now = time.monotonic()
+        users = [
+            user
+            for user in map(self.user_credits_dict.get, user_names)
+            if user is not None and self.credits_refresh_due(user, now)
+        ]
+        if not users:
+            return
+        semaphore = asyncio.Semaphore(max(self.credits_refresh_concurrency, 1))
+        await asyncio.gather(
+            *(self.credits_refresh_user(user, semaphore) for user in users)
+        )
+
+    async def credit_refresh_task(self):
         while True:
             try:
                 tic = time.time()
-                now = utcnow(with_tz=False)
-                all_credit_users = self.parent.db.query(CreditsUser).all()
-                for credit_user in all_credit_users:
-                    mem_user = self.user_credits_dict.get(credit_user.name, None)
-                    try:
-                        if mem_user:
-                            # Refresh user auth
-                            await self.refresh_user(mem_user)
-                    except:
-                        self.log.exception(
-                            f"Error while refreshing user {credit_user.name} in credit task."
-                        )
-                    for credits in credit_user.credits_user_values:
-                        try:
-                            if credits.project:
-                                proj_prev_balance = credits.project.balance
-                                proj_cap = credits.project.cap
-                                proj_updated = False
-                                if proj_prev_balance > proj_cap:
-                                    credits.project.balance = proj_cap
-                                    proj_updated = True
-                                elif proj_prev_balance < proj_cap:
-                                    elapsed = (
-                                        now - credits.project.grant_last_update
-                                    ).total_seconds()
-                                    if elapsed > credits.project.grant_interval:
-                                        proj_updated = True
-                                        grants = int(
-                                            elapsed // credits.project.grant_interval
-                                        )
-                                        gained = grants * credits.project.grant_value
-                                        credits.project.balance = min(
-                                            proj_prev_balance + gained, proj_cap
-                                        )
-                                        credits.project.grant_last_update += timedelta(
-                                            seconds=grants
-                                            * credits.project.grant_interval
-                                        )
-                                        self.log.debug(
-                                            f"Project {credits.project_name}: {proj_prev_balance} -> {credits.project.balance} "
-                                            f"(+{gained}, cap {credits.project.cap})",
-                                            extra={
-                                                "action": "creditsgained",
-                                                "projectname": credits.project_name,
-                                            },
-                                        )
-                                if proj_updated:
-                                    self.parent.db.commit()
-                            prev_balance = credits.balance
-                            cap = credits.cap
-                            updated = False
-                            if prev_balance > cap:
-                                credits.balance = cap
-                                updated = True
-                            else:
-                                elapsed = (
-                                    now - credits.grant_last_update
-                                ).total_seconds()
-                                if elapsed >= credits.grant_interval:
-                                    updated = True
-                                    grants = int(elapsed // credits.grant_interval)
-                                    gained = grants * credits.grant_value
-                                    credits.balance = min(prev_balance + gained, cap)
-                                    credits.grant_last_update += timedelta(
-                                        seconds=grants * credits.grant_interval
-                                    )
-                                    self.log.debug(
-                                        f"User {credit_user.name} ({credits.name}): {prev_balance} -> {credits.balance} "
-                                        f"(+{gained}, cap {credits.cap})",
-                                        extra={
-                                            "action": "creditsgained",
-                                            "username": credit_user.name,
-                                            "creditsname": credits.name,
-                                        },
-                                    )
-                            if updated:
-                                self.parent.db.commit()
-
-                            # All projects and user credits are updated.
-                            # Now check running spawners and bill credits
-                            if mem_user:
-                                to_stop = []
-                                for spawner in mem_user.spawners.values():
-                                    if not getattr(spawner, "_billing_interval", None):
-                                        continue
-                                    if not getattr(spawner, "_billing_value", None):
-                                        continue
-
-                                    try:
-                                        spawner_id_str = str(spawner.orm_spawner.id)
-                                        if not spawner.active:
-                                            if (
-                                                spawner_id_str
-                                                in credit_user.spawner_bills.keys()
-                                            ):
-                                                del credit_user.spawner_bills[
-                                                    spawner_id_str
-                                                ]
-                                            continue
-                                        if not spawner.ready:
-                                            continue
-                                        last_billed = None
-                                        # When restarting the Hub the last bill timestamp
-                                        # will be stored in the database. Use this one.
-                                        force_bill = False
-                                        if (
-                                            spawner_id_str
-                                            in credit_user.spawner_bills.keys()
-                                        ):
-                                            last_billed = datetime.fromisoformat(
-                                                credit_user.spawner_bills[
-                                                    spawner_id_str
-                                                ]
-                                            )
-                                            # If the last bill timestamp is older than started, it's from
-                                            # a previous running lab and should not be used.
-                                            if (
-                                                last_billed
-                                                < spawner.orm_spawner.started
-                                            ):
-                                                force_bill = True
-                                                last_billed = now
-                                        else:
-                                            # If no bill timestamp is available we'll use the current timestamp
-                                            # Using started would be unfair, since we don't know how long it took
-                                            # to actually be usable. Users should only "pay" for ready spawners.
-                                            force_bill = True
-                                            last_billed = now
-
-                                        elapsed = (now - last_billed).total_seconds()
-                                        if (
-                                            elapsed >= spawner._billing_interval
-                                            or force_bill
-                                        ):
-                                            user_options = getattr(
-                                                spawner, "user_options", {}
-                                            )
-                                            # Find the correct CreditsUserValues and Project entry for this spawner
-                                            user_credits_for_spawner = None
-                                            default_cuv = None
-                                            for cuv in credit_user.credits_user_values:
-                                                if not cuv.user_options:
-                                                    default_cuv = cuv
-                                                    continue
-                                                if user_credits_for_spawner is None:
-                                                    match = self.match_user_options(
-                                                        user_options,
-                                                        cuv.user_options or {},
-                                                    )
-                                                    self.log.debug(
-                                                        f"Test if spawner user_options {user_options} match configured user_options {cuv.user_options or {}} : {match}"
-                                                    )
-                                                    if match:
-                                                        user_credits_for_spawner = cuv
-                                                        break
-
-                                            if user_credits_for_spawner is None:
-                                                user_credits_for_spawner = default_cuv
-                                            if not user_credits_for_spawner:
-                                                self.log.warning(
-                                                    f"No matching CreditsUserValues found for spawner {spawner._log_name}. Stop Spawner."
-                                                )
-                                                if spawner.name not in to_stop:
-                                                    to_stop.append(spawner.name)
-                                                continue
-                                            available_balance = 0
-                                            project_credits_for_spawner = None
-                                            self.log.debug(
-                                                f"Using user credits '{user_credits_for_spawner.name}' for spawner {spawner._log_name}"
-                                            )
-                                            available_balance += (
-                                                user_credits_for_spawner.balance
-                                            )
-                                            prev_balance = (
-                                                user_credits_for_spawner.balance
-                                            )
-                                            if user_credits_for_spawner.project:
-                                                project_credits_for_spawner = (
-                                                    user_credits_for_spawner.project
-                                                )
-                                                self.log.debug(
-                                                    f"Using project credits '{project_credits_for_spawner.name}' for spawner {spawner._log_name}"
-                                                )
-                                                available_balance += (
-                                                    project_credits_for_spawner.balance
-                                                )
-                                                proj_prev_balance = (
-                                                    project_credits_for_spawner.balance
-                                                )
-
-                                            # When force_bill is true we have to make sure to bill the first
-                                            # interval as well
-                                            bills = max(
-                                                int(
-                                                    elapsed // spawner._billing_interval
-                                                ),
-                                                1,
-                                            )
-                                            cost = bills * spawner._billing_value
-                                            if cost > available_balance:
-                                                # Stop Server. Not enough credits left for next interval
-                                                if spawner.name not in to_stop:
-                                                    to_stop.append(spawner.name)
-                                                self.log.info(
-                                                    f"User Credits exceeded. Stopping Server '{mem_user.name}:{spawner.name}' (Credits available: {available_balance}, Cost: {cost})",
-                                                    extra={
-                                                        "action": "creditsexceeded",
-                                                        "userid": mem_user.id,
-                                                        "username": mem_user.name,
-                                                        "servername": spawner.name,
-                                                    },
-                                                )
-                                            else:
-                                                if project_credits_for_spawner:
-                                                    if (
-                                                        cost
-                                                        > project_credits_for_spawner.balance
-                                                    ):
-                                                        proj_cost = (
-                                                            project_credits_for_spawner.balance
-                                                        )
-                                                    else:
-                                                        proj_cost = cost
-                                                    project_credits_for_spawner.balance -= (
-                                                        proj_cost
-                                                    )
-                                                    cost -= proj_cost
-                                                    self.log.debug(
-                                                        f"Project {project_credits_for_spawner.name} credits recuded by {proj_cost} ({proj_prev_balance} -> {project_credits_for_spawner.balance}) for server '{spawner._log_name}' ({elapsed}s since last bill timestamp)",
-                                                        extra={
-                                                            "action": "creditspaid",
-                                                            "userid": mem_user.id,
-                                                            "username": mem_user.name,
-                                                            "servername": spawner.name,
-                                                            "projectname": project_credits_for_spawner.name,
-                                                        },
-                                                    )
-
-                                                user_credits_for_spawner.balance -= cost
-                                                if not force_bill:
-                                                    last_billed += timedelta(
-                                                        seconds=bills
-                                                        * spawner._billing_interval
-                                                    )
-                                                self.log.debug(
-                                                    f"User {mem_user.name} credits recuded by {cost} ({prev_balance} -> {user_credits_for_spawner.balance}) for server '{spawner._log_name}' ({elapsed}s since last bill timestamp)",
-                                                    extra={
-                                                        "action": "creditspaid",
-                                                        "userid": mem_user.id,
-                                                        "username": mem_user.name,
-                                                        "servername": spawner.name,
-                                                    },
-                                                )
-                                                credit_user.spawner_bills[
-                                                    spawner_id_str
-                                                ] = last_billed.isoformat()
-                                                self.parent.db.commit()
-                                    except:
-                                        self.log.exception(
-                                            f"Error while updating user credits for {credit_user} in spawner {spawner._log_name}."
-                                        )
-
-                                for spawner_name in to_stop:
-                                    self.log.info(
-                                        f"Stopping spawner {spawner_name} for user {mem_user.name} due to insufficient credits."
-                                    )
-                                    asyncio.create_task(mem_user.stop(spawner_name))
-                        except:
-                            self.log.exception(
-                                f"Error while updating user credits for {credits}."
-                            )
+                with CREDITS_TASK_PHASE_DURATION_SECONDS.labels(
+                    phase=CreditsTaskPhase.refresh.value
+                ).time():
+                    await self.credits_refresh_users()
             except:
-                self.log.exception("Error while updating user credits.")
+                self.log.exception("Error while refreshing users in credit task.")
             finally:
-                try:
-                    await self.run_credits_task_post_hook()
-                except:
-                    self.log.exception("Exception in credits_task_post_hook")
                 tac = time.time() - tic
-                self.log.debug(f"Credit task took {tac}s to update all user credits")
-                self.credits_task_event.set()
-                await asyncio.sleep(0)  # give waiters time to proceed
-                self.credits_task_event.clear()
-                await asyncio.sleep(self.credits_task_interval)
+                self.log.debug(f"Credit refresh task took {tac}s to refresh users")
+                await asyncio.sleep(max(self.credits_refresh_interval() - tac, 0))
+
+    async def credit_reconciliation_task(self):
+        try:
+            while True:
+                await self.credit_reconciliation_run()
+        except asyncio.CancelledError:
+            # The Hub cancels all tasks when it shuts down
+            self.credits_balances_shutdown()
+            raise
+
+    async def credit_reconciliation_run(self):
+        tic = time.time()
+        try:
+            await self.credits_reconcile(utcnow(with_tz=False))
+        except asyncio.CancelledError:
+            raise
+        except:
+            self.log.exception("Error while updating user credits.")
+            if self.credits_batch_commit and not self.credits_own_sessions:
+                self.parent.db.rollback()
+        tac = time.time() - tic
+        self.log.debug(f"Credit task took {tac}s to update all user credits")
+        if self.credits_post_hook_due(time.monotonic()):
+            try:
+                with CREDITS_TASK_PHASE_DURATION_SECONDS.labels(
+                    phase=CreditsTaskPhase.post_hook.value
+                ).time():
+                    await self.run_credits_task_post_hook()
+            except asyncio.CancelledError:
+                raise
+            except:
+                self.log.exception("Exception in credits_task_post_hook")
+        # SSE streams only query the credits they saw change
+        self.credits_task_event.set()
+        await asyncio.sleep(0)  # give waiters time to proceed
+        self.credits_task_event.clear()
+        await self.credits_scheduler.wait(self.credits_sleep_time())
+
+    def credits_post_hook_due(self, now):
+        """Whether the post hook is due again.
+
+        The task runs at every bill deadline, but the hook only runs once
+        per `credits_task_interval`. The task never sleeps longer than
+        that, so the hook runs at most one interval late.
+        """
+        notified = self._credits_task_notified
+        if notified is not None and now - notified < self.credits_task_interval:
+            return False
+        self._credits_task_notified = now
+        return True
+
+    @property
+    def credits_own_sessions(self):
+        """Whether the credits use their own engine and sessions"""
+        return self.credits_db_threads > 0 or bool(self.credits_db_url)
+
+    @property
+    def credits_db(self):
+        """Database session for the credit tables.
+
+        The Hub's session, or the session of the current thread if
+        `credits_db_threads` or `credits_db_url` is used.
+        """
+        if self.credits_own_sessions:
+            if self._credits_sessions is None:
+                self._credits_sessions = scoped_session(self.credits_session_factory())
+            return self._credits_sessions()
+        return self.parent.db
+
+    @property
+    def credits_engine(self):
+        """Engine of the credit tables. The Hub's, without own sessions"""
+        if not self.credits_own_sessions:
+            return self.parent.db.get_bind()
+        if self._credits_engine is None:
+            self._credits_engine = self.credits_create_engine()
+        return self._credits_engine
+
+    def credits_create_engine(self):
+        db_url = self.credits_db_url or self.parent.db_url
+        kwargs = dict(self.credits_db_kwargs)
+        if db_url.startswith("sqlite"):
+            # Connections are shared by the threads of the pool
+            kwargs["connect_args"] = {
+                "check_same_thread": False,
+                **kwargs.get("connect_args", {}),
+            }
+        engine = create_engine(db_url, **kwargs)
+        if db_url.startswith("sqlite") and self.credits_db_sqlite_wal:
+            event.listen(engine, "connect", _sqlite_wal)
+        return engine
+
+    def credits_session_factory(self):
+        session_factory = sessionmaker(bind=self.credits_engine, expire_on_commit=False)
+        event.listen(session_factory, "after_flush", self._credits_count_flush)
+        return session_factory
+
+    async def credits_run(self, func, *args):
+        """Run database work of the credits.
+
+        Runs `func(*args)` in the credit database threads, if
+        `credits_db_threads` is set, otherwise right away on the event loop.
+        Results have to be plain values, database objects of the thread's
+        session must not be used outside of it.
+        """
+        if self.credits_db_threads <= 0:
+            if self.credits_own_sessions:
+                return self._credits_run_in_session(func, args)
+            return func(*args)
+        if self._credits_executor is None:
+            self._credits_executor = ThreadPoolExecutor(
+                max_workers=self.credits_db_threads, thread_name_prefix="credits-db"
+            )
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(
+            self._credits_executor, self._credits_run_in_session, func, args
+        )
+
+    def _credits_run_in_session(self, func, args):
+        try:
+            return func(*args)
+        finally:
+            # Don't keep a transaction (and its database locks) open
+            # between two calls. There's no session yet if func didn't use
+            # credits_db.
+            if self._credits_sessions is not None:
+                self._credits_sessions.remove()
+
+    def credits_user_names(self):
+        return [name for (name,) in self.credits_db.query(CreditsUser.name).all()]
 
     def credits_append_user(self, user):
         if user.name not in self.user_credits_dict.keys():
@@ -548,26 +1566,140 @@ class CreditsAuthenticator(Authenticator):
 
     def __init__(self, **kwargs):
         super().__init__(**kwargs)
+        self._credits_matchers = {}
+        self._credits_indexes = {}
+        self._credits_user_updates = {}
+        self._credits_user_cache = TTLCache(
+            self.credits_user_cache_ttl, self.credits_user_cache_size
+        )
+        self.credits_scheduler = DeadlineScheduler()
+        self.credits_scheduler.schedule(CREDITS_GRANTS, utcnow(with_tz=False))
+        self.credits_billable = BillableSpawners(self.credits_scheduler)
+        self.credits_ledger_buffer = CreditsLedgerBuffer()
+        self.credits_versions = VersionStamps()
         if self.credits_enabled:
             self.credits_task_event = asyncio.Event()
-            inspector = sqlinspect(self.parent.db.bind)
-            tables = set(inspector.get_table_names())
-
-            missing = {
-                "credits_user",
-                "credits_user_values",
-                "credits_project",
-            } - tables
-            if missing:
+            if not self.credits_own_sessions:
+                event.listen(self.parent.db, "after_flush", self._credits_count_flush)
+            upgrade = upgrade_tables(self.credits_engine)
+            if upgrade["tables"]:
                 self.log.warning("Create Database Tables for JupyterHub Credit Service")
-                from sqlalchemy import create_engine
+            if upgrade["bills"]:
+                self.log.info(
+                    f"Migrated {upgrade['bills']} spawner bills to their own table"
+                )
+            if upgrade["columns"]:
+                self.log.info(
+                    f"Added columns to credit tables: {', '.join(upgrade['columns'])}"
+                )
+            if upgrade["indexes"]:
+                self.log.info(
+                    f"Created indexes of credit tables: {', '.join(upgrade['indexes'])}"
+                )
+            for name, error in upgrade["index_errors"].items():
+                self.log.error(
+                    f"Could not create index {name} of credit tables: {error}"
+                )
 
-                engine = create_engine(self.parent.db_url)
-                Base.metadata.create_all(engine)
+            if self.credits_balance_cache:
+                self.credits_balances = CreditsBalanceCache()
+                if self.credits_own_sessions:
+                    users = self._credits_run_in_session(self.credits_balances_load, ())
+                else:
+                    users = self.credits_balances_load()
+                self.log.info(f"Loaded credits of {users} users into the balance cache")
+                atexit.register(self.credits_balances_atexit)
 
             self.credits_task = asyncio.create_task(self.credit_reconciliation_task())
+            self.credits_refresh_task = asyncio.create_task(self.credit_refresh_task())
+
+    def credits_auth_key(self, user_name, user_groups, user_admin, auth_state):
+        """What the configured credits of a user may depend on, as dict key"""
+        return (
+            user_name,
+            tuple(sorted(user_groups or [])),
+            bool(user_admin),
+            auth_state_hash(auth_state),
+        )
+
+    async def credits_resolve_user(
+        self, user_name, user_groups, user_admin, auth_state
+    ):
+        """Configured credits_user values of a user.
+
+        Results of a callable are cached, if `credits_user_cache_ttl` is set.
+        """
+        value = self.credits_user
+        if not callable(value):
+            return value
+        if self.credits_user_cache_ttl <= 0:
+            value = value(self, user_name, user_groups, user_admin, auth_state)
+            if inspect.isawaitable(value):
+                value = await value
+            return value
+
+        cache = self._credits_user_cache
+        cache.ttl = self.credits_user_cache_ttl
+        cache.size = self.credits_user_cache_size
+        key = self.credits_auth_key(user_name, user_groups, user_admin, auth_state)
+        cached = cache.get(key, _NOT_CACHED)
+        if cached is not _NOT_CACHED:
+            return cached
+        value = value(self, user_name, user_groups, user_admin, auth_state)
+        if inspect.isawaitable(value):
+            value = await value
+        cache.set(key, value)
+        return value
+
+    def credits_user_cache_invalidate(self, user_name=None):
+        """Forget cached credits_user results of one user, or of all users.
+
+        Returns the number of removed results.
+        """
+        if user_name is None:
+            return self._credits_user_cache.invalidate()
+        return self._credits_user_cache.invalidate(lambda key: key[0] == user_name)
 
     async def update_user_credit(self, auth_model):
+        """Store the configured credits of a user.
+
+        Concurrent calls for the same user (e.g. logins from several tabs
+        and pre-spawn refreshes) wait for the update in progress instead
+        of running their own, if their auth_model is the same. Otherwise
+        they run after it.
+        """
+        user_name = auth_model.get("name", None)
+        key = self.credits_auth_key(
+            user_name,
+            auth_model.get("groups", []),
+            auth_model.get("admin", False),
+            auth_model.get("auth_state", {}),
+        )
+        while True:
+            in_flight = self._credits_user_updates.get(user_name, None)
+            if in_flight is None:
+                break
+            in_flight_key, task = in_flight
+            try:
+                # Cancelling a waiter must not cancel the update of the others
+                await asyncio.shield(task)
+            except Exception:
+                if in_flight_key == key:
+                    raise
+            if in_flight_key == key:
+                return
+        task = asyncio.ensure_future(self._update_user_credit(auth_model))
+        self._credits_user_updates[user_name] = (key, task)
+
+        def done(task):
+            # Not in the caller, which may be cancelled while the task runs
+            if self._credits_user_updates.get(user_name, (None, None))[1] is task:
+                del self._credits_user_updates[user_name]
+
+        task.add_done_callback(done)
+        await asyncio.shield(task)
+
+    async def _update_user_credit(self, auth_model):
         # Create new ORMUserCredits or ORMProjectCredits entries
         # or Update existing ones, if the config returns values
         # that are not different than values in db
@@ -576,28 +1708,15 @@ class CreditsAuthenticator(Authenticator):
         user_groups = auth_model.get("groups", [])
         user_admin = auth_model.get("admin", False)
 
-        async def resolve_value(value):
-            if callable(value):
-                value = value(self, user_name, user_groups, user_admin, auth_state)
-            if inspect.isawaitable(value):
-                value = await value
-            return value
-
         grant_last_update = utcnow(with_tz=False)
 
-        credits_user_database = CreditsUser.get_user(self.parent.db, user_name)
-        if not credits_user_database:
-            # Add CreditsUser entry
-            credits_user_database = CreditsUser(name=user_name)
-            self.parent.db.add(credits_user_database)
-            self.parent.db.commit()
-
         # Collect configured values
-        credits_user_values_configured = await resolve_value(self.credits_user)
+        credits_user_values_configured = await self.credits_resolve_user(
+            user_name, user_groups, user_admin, auth_state
+        )
         if type(credits_user_values_configured) == dict:
             credits_user_values_configured = [credits_user_values_configured]
 
-        credits_user_values_configured_names = []
         credits_user_values_configured_by_name = {}
         if credits_user_values_configured:
             for x in credits_user_values_configured:
@@ -606,72 +1725,137 @@ class CreditsAuthenticator(Authenticator):
                         "User Credit Configuration has no name. Use name default as placeholder."
                     )
                     x["name"] = "default"
-                credits_user_values_configured_names.append(x["name"])
                 credits_user_values_configured_by_name[x["name"]] = x
 
-        # 1. Keep database entries that are currently configured
-        for credits_user_value_db in credits_user_database.credits_user_values:
-            if credits_user_value_db.name not in credits_user_values_configured_names:
-                self.parent.db.delete(credits_user_value_db)
-                self.parent.db.commit()
+        fingerprint = self.credits_config_fingerprint(
+            credits_user_values_configured_by_name
+        )
+        if await self.credits_run(self.credits_config_stored, user_name, fingerprint):
+            # Nothing to write
+            return
+
+        deadlines, changed = await self.credits_run(
+            self.credits_write,
+            user_name,
+            None,
+            self.credits_store_user_values,
+            user_name,
+            credits_user_values_configured_by_name,
+            grant_last_update,
+            fingerprint,
+        )
+        for when in deadlines:
+            self.credits_schedule_grant(when)
+        if changed:
+            # Running servers may be paid by other values now
+            self.credits_billable.invalidate_user(user_name)
+
+    def credits_config_fingerprint(self, credits_user_values_configured_by_name):
+        """Fingerprint of what credits_store_user_values() stores for a user.
 
+        Hashes a canonical form, so reordered keys of the same
+        configuration keep their fingerprint.
+        """
+        config = {}
         for name, credits_user_value in credits_user_values_configured_by_name.items():
-            # Does the configuration for the user exist in database, update it. Otherwise create it
+            project = credits_user_value.get("project", None) or {}
+            config[name] = [
+                {key: credits_user_value.get(key, None) for key in CREDITS_CONFIG_KEYS},
+                {key: project.get(key, None) for key in PROJECT_CONFIG_KEYS},
+            ]
+        dumped = json.dumps(config, sort_keys=True, default=repr)
+        return hashlib.sha256(dumped.encode("utf8")).hexdigest()
 
+    def credits_config_stored(self, user_name, fingerprint):
+        """Whether the configuration with `fingerprint` is stored for a user"""
+        stored = (
+            self.credits_db.query(CreditsUser.config_fingerprint)
+            .filter(CreditsUser.name == user_name)
+            .scalar()
+        )
+        return stored is not None and stored == fingerprint
+
+    def credits_store_user_values(
+        self,
+        user_name,
+        credits_user_values_configured_by_name,
+        grant_last_update,
+        fingerprint=None,
+    ):
+        """Store the configured credit values of a user.
+
+        Only what differs from the database is changed, and everything is
+        committed at once. `fingerprint` is stored with the values, see
+        credits_config_stored().
+
+        Returns the times of the next grants of all stored values, and
+        whether the set of values or their user_options or projects changed.
+        """
+        db = self.credits_db
+        deadlines = []
+        credits_user_database = CreditsUser.get_user(db, user_name)
+        if not credits_user_database:
+            credits_user_database = CreditsUser(name=user_name)
+            db.add(credits_user_database)
+        previous_set = self.credits_user_values_set(credits_user_database)
+        values_by_name = {
+            cuv.name: cuv for cuv in credits_user_database.credits_user_values
+        }
+
+        # 1. Remove database entries that are no longer configured
+        for name, credits_user_value_db in list(values_by_name.items()):
+            if name not in credits_user_values_configured_by_name:
+                credits_user_database.credits_user_values.remove(credits_user_value_db)
+                db.delete(credits_user_value_db)
+                del values_by_name[name]
+
+        # 2. All configured projects with one query
+        project_names = set()
+        for credits_user_value in credits_user_values_configured_by_name.values():
+            configured_project = credits_user_value.get("project", None)
+            if configured_project and configured_project.get("name", None):
+                project_names.add(configured_project["name"])
+        projects = {}
+        if project_names:
+            projects = {
+                project.name: project
+                for project in db.query(CreditsProject).filter(
+                    CreditsProject.name.in_(project_names)
+                )
+            }
+
+        # 3. Create or update the configured values and their projects
+        for name, credits_user_value in credits_user_values_configured_by_name.items():
             orm_project = None
             configured_project = credits_user_value.get("project", None)
             if configured_project and configured_project.get("name", None):
                 project = self.credits_validate_and_update_project(configured_project)
                 if not project:
                     continue
-                orm_project = CreditsProject.get_project(
-                    self.parent.db, configured_project["name"]
-                )
-
+                orm_project = projects.get(project["name"], None)
                 if not orm_project:
-                    # Create entry in database
                     project["balance"] = project["cap"]
                     orm_project = CreditsProject(**project)
-                    self.parent.db.add(orm_project)
-                    self.parent.db.commit()
-                else:
-                    # Check + Update project
-                    prev_project_balance = orm_project.balance
-                    prev_project_cap = orm_project.cap
-                    prev_project_grant_value = orm_project.grant_value
-                    prev_project_grant_interval = orm_project.grant_interval
-                    proj_updated = False
-                    if prev_project_cap != project["cap"]:
-                        proj_updated = True
-                        orm_project.cap = project["cap"]
-                        if prev_project_balance > orm_project.cap:
-                            orm_project.balance = orm_project.cap
-                    if prev_project_grant_value != project["grant_value"]:
-                        proj_updated = True
-                        orm_project.grant_value = project["grant_value"]
-                    if prev_project_grant_interval != project["grant_interval"]:
-                        proj_updated = True
-                        orm_project.grant_interval = project["grant_interval"]
-                    if proj_updated:
-                        self.parent.db.add(orm_project)
-                        self.parent.db.commit()
-
-            database_entry = CreditsUser.get_user(
-                self.parent.db, user_name
-            ).credits_user_values
-            database_entry = [x for x in database_entry if x.name == name]
-            if database_entry:
-                database_entry = database_entry[0]
-                database_entry.cap = credits_user_value.get("cap")
-                database_entry.grant_value = credits_user_value.get("grant_value")
-                database_entry.grant_interval = credits_user_value.get("grant_interval")
-                database_entry.user_options = credits_user_value.get(
-                    "user_options", None
+                    db.add(orm_project)
+                    projects[project["name"]] = orm_project
+                    deadlines.append(self.credits_grant_deadline(orm_project))
+                elif self.credits_update_grant_values(
+                    orm_project, project, grant_last_update
+                ):
+                    self.credits_reduce_to_cap(orm_project, grant_last_update)
+                    deadlines.append(self.credits_grant_deadline(orm_project))
+
+            database_entry = values_by_name.get(name, None)
+            if database_entry is not None:
+                self.credits_update_grant_values(
+                    database_entry, credits_user_value, grant_last_update
                 )
-                if database_entry.balance > database_entry.cap:
-                    database_entry.balance = database_entry.cap
-                database_entry.project = orm_project
-                # Add existing DB Project to existing userconfig entry
+                self.credits_reduce_to_cap(database_entry, grant_last_update)
+                user_options = credits_user_value.get("user_options", None)
+                if database_entry.user_options != user_options:
+                    database_entry.user_options = user_options
+                if database_entry.project is not orm_project:
+                    database_entry.project = orm_project
             else:
                 database_entry = CreditsUserValues(
                     name=name,
@@ -684,8 +1868,55 @@ class CreditsAuthenticator(Authenticator):
                     credits_user=credits_user_database,
                     project=orm_project,
                 )
-            self.parent.db.add(database_entry)
-            self.parent.db.commit()
+                db.add(database_entry)
+            deadlines.append(self.credits_grant_deadline(database_entry))
+        if credits_user_database.config_fingerprint != fingerprint:
+            credits_user_database.config_fingerprint = fingerprint
+        db.commit()
+        self.credits_versions.touch_user(user_name)
+        for project_name in project_names:
+            self.credits_versions.touch_project(project_name)
+
+        changed = previous_set != self.credits_user_values_set(credits_user_database)
+        if changed:
+            self.credits_invalidate_user_values(user_name)
+        return deadlines, changed
+
+    def credits_update_grant_values(self, credits, configured, now):
+        """Set cap, grant_value and grant_interval of a project or user value.
+
+        Only changed attributes are set. Returns True if anything changed.
+        """
+        new = {key: configured.get(key, None) for key in GRANT_CONFIG_KEYS}
+        old = {key: getattr(credits, key) for key in GRANT_CONFIG_KEYS}
+        if new == old:
+            return False
+        if self.credits_lazy_grants:
+            # Keep the credits granted with the previous values
+            self.credits_ledger_materialize(credits, now)
+        for key, value in new.items():
+            if old[key] != value:
+                setattr(credits, key, value)
+        return True
+
+    def credits_reduce_to_cap(self, credits, now):
+        if credits.balance > credits.cap:
+            prev_balance = credits.balance
+            credits.balance = credits.cap
+            self.credits_ledger_record("cap", credits, credits.cap - prev_balance, now)
+
+    def credits_user_values_set(self, credit_user):
+        """What decides which values pay for a server, to detect changes"""
+        values = sorted(credit_user.credits_user_values, key=lambda cuv: cuv.id)
+        return [
+            (
+                cuv.id,
+                cuv.name,
+                cuv.project_name,
+                user_options_fingerprint(cuv.user_options),
+            )
+            for cuv in values
+        ]
 
     async def run_post_auth_hook(self, handler, auth_model):
         auth_model = await super().run_post_auth_hook(handler, auth_model)
@@ -0,0 +1,401 @@
+import threading
+import time
+
+from sqlalchemy import bindparam, delete, insert, update
+from sqlalchemy.orm import selectinload
+
+from .orm import (
+    CreditsGrantMixin,
+    CreditsProject,
+    CreditsSpawnerBill,
+    CreditsUser,
+    CreditsUserValues,
+)
+
+
+class CachedCredits(CreditsGrantMixin):
+    """Balance and grant values of a project or user value, in memory.
+
+    Has the attributes of the ORM objects used for granting, billing and
+    the credit models, so the same code works on both. The grant rules
+    (effective_grant(), materialize()) are the ones of the ORM classes.
+    """
+
+    # Written back to the database by CreditsBalanceCache.flush()
+    flushed_columns = ("balance", "grant_last_update")
+
+    def __init__(self, row):
+        self.update_from(row)
+
+    def update_from(self, row):
+        self.balance = row.balance
+        self.cap = row.cap
+        self.grant_value = row.grant_value
+        self.grant_interval = row.grant_interval
+        self.grant_last_update = row.grant_last_update
+
+    def state(self):
+        return (self.balance, self.grant_last_update)
+
+
+class CachedProject(CachedCredits):
+    grant_at_cap = CreditsProject.grant_at_cap
+    grant_inclusive = CreditsProject.grant_inclusive
+
+    def update_from(self, row):
+        super().update_from(row)
+        self.name = row.name
+        self.display_name = row.display_name
+        self.user_options = _copy(row.user_options)
+
+    def __repr__(self):
+        return f"<CachedProject {self.name} balance={self.balance}>"
+
+
+class CachedUserValues(CachedCredits):
+    grant_at_cap = CreditsUserValues.grant_at_cap
+    grant_inclusive = CreditsUserValues.grant_inclusive
+
+    def __init__(self, row, project):
+        super().__init__(row)
+        self.id = row.id
+        self.name = row.name
+        self.user_name = row.user_name
+        self.project_name = row.project_name
+        self.user_options = _copy(row.user_options)
+        self.project = project
+
+    def __repr__(self):
+        return f"<CachedUserValues {self.user_name}:{self.name} balance={self.balance}>"
+
+
+def _copy(user_options):
+    # Don't keep the MutableDict of the ORM object
+    if user_options is None:
+        return None
+    return dict(user_options)
+
+
+BILL_KEYS = ("spawner_id", "user_name")
+BILL_COLUMNS = ("last_billed", "billing_value", "billing_interval")
+
+
+class CachedSpawnerBill:
+    def __init__(
+        self, spawner_id, last_billed=None, billing_value=None, billing_interval=None
+    ):
+        self.spawner_id = spawner_id
+        self.last_billed = last_billed
+        self.billing_value = billing_value
+        self.billing_interval = billing_interval
+
+    def state(self):
+        return tuple([getattr(self, name) for name in BILL_COLUMNS])
+
+
+class CachedUser:
+    def __init__(self, name, credits_user_values, spawner_bills):
+        self.name = name
+        self.credits_user_values = credits_user_values
+        # spawner id -> CachedSpawnerBill
+        self.spawner_bills = spawner_bills
+
+    def add_spawner_bill(self, spawner_id):
+        bill = CachedSpawnerBill(spawner_id)
+        self.spawner_bills[spawner_id] = bill
+        return bill
+
+
+class CreditsBalanceCache:
+    """Balances of all users and projects, kept in memory.
+
+    Loaded from the database once, then grants and bills only change the
+    cached objects. Changed users and projects are marked with touch_user()
+    and touch_project(), and flush() writes what changed since the last
+    flush with a few executemany statements.
+
+    Everything else that writes credits to the database flushes the cache
+    before, and loads the changed users and projects again afterwards
+    (see CreditsAuthenticator.credits_write()). `lock` is held meanwhile,
+    so this doesn't interleave with a credit task run in another thread.
+    """
+
+    def __init__(self):
+        self.lock = threading.RLock()
+        # name -> CachedUser / CachedProject
+        self.users = {}
+        self.projects = {}
+        # Number of grants and bills since the last flush
+        self.changes = 0
+        self.last_flush = time.monotonic()
+        self._dirty_users = set()
+        self._dirty_projects = set()
+        # State in the database: value id -> state(),
+        # project name -> state(), user name -> {spawner id: state()}
+        self._flushed_values = {}
+        self._flushed_projects = {}
+        self._flushed_bills = {}
+
+    @property
+    def dirty(self):
+        return bool(self._dirty_users or self._dirty_projects)
+
+    def load(self, db):
+        """Load all users and projects. Returns the number of users"""
+        self.users = {}
+        self.projects = {}
+        self._flushed_values = {}
+        self._flushed_projects = {}
+        self._flushed_bills = {}
+        for project in db.query(CreditsProject).populate_existing():
+            self._load_project(project)
+        query = (
+            CreditsUser.query_with_values(db)
+            .options(selectinload(CreditsUser.spawner_bills))
+            .populate_existing()
+        )
+        for credit_user in query:
+            self._load_user(credit_user)
+        self.changes = 0
+        self.last_flush = time.monotonic()
+        self._dirty_users.clear()
+        self._dirty_projects.clear()
+        return len(self.users)
+
+    def load_user(self, db, user_name):
+        """Load one user and their projects again, e.g. after a config change"""
+        credit_user = CreditsUser.get_user(db, user_name, refresh=True)
+        if credit_user is None:
+            self.forget_user(user_name)
+            return
+        credit_user.spawner_bills  # load, if expired
+        for cuv in credit_user.credits_user_values:
+            if cuv.project is not None:
+                self._load_project(cuv.project)
+        self._load_user(credit_user)
+        self._dirty_users.discard(user_name)
+
+    def load_project(self, db, project_name):
+        """Load one project again, e.g. after an admin changed it"""
+        project = CreditsProject.get_project(db, project_name)
+        if project is None:
+            self.projects.pop(project_name, None)
+            self._flushed_projects.pop(project_name, None)
+        else:
+            db.refresh(project)
+            self._load_project(project)
+        self._dirty_projects.discard(project_name)
+
+    def forget_user(self, user_name):
+        credit_user = self.users.pop(user_name, None)
+        if credit_user is not None:
+            for cuv in credit_user.credits_user_values:
+                self._flushed_values.pop(cuv.id, None)
+        self._flushed_bills.pop(user_name, None)
+        self._dirty_users.discard(user_name)
+
+    def _load_project(self, row):
+        # Update in place, the values of other users refer to the object
+        project = self.projects.get(row.name, None)
+        if project is None:
+            project = self.projects[row.name] = CachedProject(row)
+        else:
+            project.update_from(row)
+        self._flushed_projects[project.name] = project.state()
+        return project
+
+    def _load_user(self, row):
+        self.forget_user(row.name)
+        values = []
+        for cuv in sorted(row.credits_user_values, key=lambda cuv: cuv.id):
+            project = None
+            if cuv.project_name is not None:
+                project = self.projects.get(cuv.project_name, None)
+                if project is None:
+                    project = self._load_project(cuv.project)
+            values.append(CachedUserValues(cuv, project))
+            self._flushed_values[cuv.id] = values[-1].state()
+        bills = {
+            spawner_id: CachedSpawnerBill(
+                spawner_id,
+                bill.last_billed,
+                bill.billing_value,
+                bill.billing_interval,
+            )
+            for spawner_id, bill in row.spawner_bills.items()
+        }
+        self._flushed_bills[row.name] = {
+            spawner_id: bill.state() for spawner_id, bill in bills.items()
+        }
+        self.users[row.name] = CachedUser(row.name, values, bills)
+
+    def touch_user(self, credit_user):
+        """Mark a user, their values and projects as changed"""
+        self._dirty_users.add(credit_user.name)
+        for cuv in credit_user.credits_user_values:
+            if cuv.project is not None:
+                self._dirty_projects.add(cuv.project.name)
+
+    def touch_project(self, project):
+        self._dirty_projects.add(project.name)
+
+    def snapshot(self, credit_user=None, project=None):
+        """State of a cached user (with their projects) or project.
+
+        restore() sets them back to it, e.g. after a failed bill.
+        """
+        credits = [project] if project is not None else []
+        bills = None
+        if credit_user is not None:
+            for cuv in credit_user.credits_user_values:
+                credits.append(cuv)
+                if cuv.project is not None:
+                    credits.append(cuv.project)
+            bills = {
+                spawner_id: bill.state()
+                for spawner_id, bill in credit_user.spawner_bills.items()
+            }
+        return credit_user, [(c, c.state()) for c in credits], bills
+
+    def restore(self, snapshot):
+        credit_user, credits, bills = snapshot
+        for c, state in credits:
+            for name, value in zip(c.flushed_columns, state):
+                setattr(c, name, value)
+        if credit_user is not None:
+            credit_user.spawner_bills = {
+                spawner_id: CachedSpawnerBill(spawner_id, *state)
+                for spawner_id, state in bills.items()
+            }
+
+    def flush_due(self, interval, max_changes):
+        """Whether changes are older than `interval` seconds or too many"""
+        if not self.dirty:
+            return False
+        if max_changes and self.changes >= max_changes:
+            return True
+        return time.monotonic() - self.last_flush >= interval
+
+    def flush(self, db):
+        """Write the changes since the last flush, without commit.
+
+        Returns the number of rows written.
+        """
+        values = []
+        bills_insert = []
+        bills_update = []
+        bills_delete = []
+        for user_name in self._dirty_users:
+            credit_user = self.users.get(user_name, None)
+            if credit_user is None:
+                continue
+            for cuv in credit_user.credits_user_values:
+                state = cuv.state()
+                if self._flushed_values.get(cuv.id, None) != state:
+                    values.append(
+                        {"b_id": cuv.id, **dict(zip(cuv.flushed_columns, state))}
+                    )
+            flushed = self._flushed_bills.get(user_name, {})
+            for spawner_id, bill in credit_user.spawner_bills.items():
+                state = bill.state()
+                if spawner_id not in flushed:
+                    bills_insert.append(
+                        {
+                            "spawner_id": spawner_id,
+                            "user_name": user_name,
+                            **dict(zip(BILL_COLUMNS, state)),
+                        }
+                    )
+                elif flushed[spawner_id] != state:
+                    bills_update.append(
+                        {
+                            "b_spawner_id": spawner_id,
+                            "b_user_name": user_name,
+                            **dict(zip(BILL_COLUMNS, state)),
+                        }
+                    )
+            for spawner_id in flushed.keys() - credit_user.spawner_bills.keys():
+                bills_delete.append(
+                    {"b_spawner_id": spawner_id, "b_user_name": user_name}
+                )
+        projects = []
+        for project_name in self._dirty_projects:
+            project = self.projects.get(project_name, None)
+            if project is None:
+                continue
+            state = project.state()
+            if self._flushed_projects.get(project_name, None) != state:
+                projects.append(
+                    {
+                        "b_name": project_name,
+                        **dict(zip(project.flushed_columns, state)),
+                    }
+                )
+
+        statements = [
+            (
+                _update_by(CreditsUserValues, ["id"], CachedCredits.flushed_columns),
+                values,
+            ),
+            (
+                _update_by(CreditsProject, ["name"], CachedCredits.flushed_columns),
+                projects,
+            ),
+            (_update_by(CreditsSpawnerBill, BILL_KEYS, BILL_COLUMNS), bills_update),
+            (
+                delete(CreditsSpawnerBill.__table__).where(
+                    *_where(CreditsSpawnerBill, BILL_KEYS)
+                ),
+                bills_delete,
+            ),
+            (insert(CreditsSpawnerBill.__table__), bills_insert),
+        ]
+        rows = 0
+        for statement, parameters in statements:
+            if parameters:
+                db.execute(statement, parameters)
+                rows += len(parameters)
+
+        # Loaded ORM objects don't know about these changes
+        for obj in list(db.identity_map.values()):
+            if isinstance(
+                obj,
+                (CreditsUser, CreditsUserValues, CreditsProject, CreditsSpawnerBill),
+            ):
+                db.expire(obj)
+        return rows
+
+    def flushed(self):
+        """Remember the flushed state, once flush() is committed"""
+        for user_name in self._dirty_users:
+            credit_user = self.users.get(user_name, None)
+            if credit_user is None:
+                continue
+            for cuv in credit_user.credits_user_values:
+                self._flushed_values[cuv.id] = cuv.state()
+            self._flushed_bills[user_name] = {
+                spawner_id: bill.state()
+                for spawner_id, bill in credit_user.spawner_bills.items()
+            }
+        for project_name in self._dirty_projects:
+            project = self.projects.get(project_name, None)
+            if project is not None:
+                self._flushed_projects[project_name] = project.state()
+        self._dirty_users.clear()
+        self._dirty_projects.clear()
+        self.changes = 0
+        self.last_flush = time.monotonic()
+
+
+def _where(cls, keys):
+    table = cls.__table__
+    return [table.c[key] == bindparam(f"b_{key}") for key in keys]
+
+
+def _update_by(cls, keys, columns):
+    """executemany UPDATE of `columns`, by the `keys` given as b_<key>"""
+    return (
+        update(cls.__table__)
+        .where(*_where(cls, keys))
+        .values({name: bindparam(name) for name in columns})
+    )
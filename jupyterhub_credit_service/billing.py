@@ -0,0 +1,189 @@
+from collections import namedtuple
+
+from jupyterhub.utils import utcnow
+
+_SpawnerSnapshot = namedtuple(
+    "_SpawnerSnapshot",
+    [
+        "user_name",
+        "user_id",
+        "name",
+        "log_name",
+        "orm_id",
+        "started",
+        "active",
+        "ready",
+        "billing_interval",
+        "billing_value",
+        "user_options",
+        "values_id",
+        "values_generation",
+    ],
+    defaults=(None, None),
+)
+
+
+class SpawnerSnapshot(_SpawnerSnapshot):
+    """State of a spawner needed to bill it.
+
+    Taken on the event loop, so billing can run in another thread
+    without touching the spawner or the Hub's database session.
+    `values_id` is the id of the CreditsUserValues that paid the last
+    bill, if it's still valid.
+    """
+
+    __slots__ = ()
+
+    @classmethod
+    def from_spawner(cls, spawner):
+        orm_spawner = spawner.orm_spawner
+        return cls(
+            user_name=spawner.user.name,
+            user_id=spawner.user.id,
+            name=spawner.name,
+            log_name=spawner._log_name,
+            orm_id=orm_spawner.id if orm_spawner is not None else None,
+            started=orm_spawner.started if orm_spawner is not None else None,
+            active=spawner.active,
+            ready=spawner.ready,
+            billing_interval=spawner._billing_interval,
+            billing_value=spawner._billing_value,
+            user_options=dict(getattr(spawner, "user_options", None) or {}),
+        )
+
+
+class BillingResult:
+    """Outcome of a billing run, applied on the event loop afterwards"""
+
+    def __init__(self):
+        # (user name, spawner name) -> time of the next bill,
+        # None to unregister the spawner
+        self.next_bills = {}
+        # (user name, spawner name) of servers without enough credits
+        self.to_stop = []
+        # Deadline of the next grant, None if there's nothing to grant
+        self.next_grant = None
+        # (user name, spawner name) -> (values id, values generation)
+        # of newly resolved CreditsUserValues
+        self.values_ids = {}
+        # Whether credits were granted, and the projects of bills. Their
+        # versions are touched afterwards, see VersionStamps.
+        self.granted = False
+        self.billed_projects = set()
+        # Number of bills, and credit rows read and written
+        self.billed = 0
+        self.rows_read = 0
+        self.rows_written = 0
+
+
+class BillableSpawners:
+    """Registry of the spawners the credit task has to bill.
+
+    Spawners register themselves while they're starting or running and
+    unregister when they're stopped. The billing phase of the credit
+    task only visits the users in this registry, so its costs depend on
+    the number of running servers instead of the number of users.
+
+    Each registered spawner has a deadline for its next bill in the
+    scheduler of the credit task. New spawners are due immediately.
+
+    The user_options of a running server don't change, so the
+    CreditsUserValues paying for it are resolved once and their id is
+    kept here until the credit values of the user change.
+    """
+
+    def __init__(self, scheduler):
+        self.scheduler = scheduler
+        # user name -> {spawner name: spawner}
+        self._running = {}
+        # user name -> {orm spawner id}, bills to remove in the next run
+        self._stopped = {}
+        # (user name, spawner name) -> id of the paying CreditsUserValues
+        self._values_ids = {}
+        # user name -> number of changes of the user's credit values
+        self._generations = {}
+
+    @staticmethod
+    def key(user_name, spawner_name):
+        """Key of the billing deadline of a spawner in the scheduler"""
+        return ("bill", user_name, spawner_name)
+
+    def __len__(self):
+        return sum(len(spawners) for spawners in self._running.values())
+
+    def __contains__(self, spawner):
+        return spawner is self.get(spawner.user.name, spawner.name)
+
+    def get(self, user_name, spawner_name):
+        return self._running.get(user_name, {}).get(spawner_name, None)
+
+    def add(self, spawner):
+        if spawner in self:
+            return
+        user_name = spawner.user.name
+        self._running.setdefault(user_name, {})[spawner.name] = spawner
+        if spawner.orm_spawner is not None:
+            self._stopped.get(user_name, set()).discard(spawner.orm_spawner.id)
+        self.schedule(spawner, utcnow(with_tz=False))
+
+    def discard(self, spawner):
+        if spawner not in self:
+            return
+        user_name = spawner.user.name
+        spawners = self._running[user_name]
+        del spawners[spawner.name]
+        if not spawners:
+            del self._running[user_name]
+        self.scheduler.cancel(self.key(user_name, spawner.name))
+        self._values_ids.pop((user_name, spawner.name), None)
+        if spawner.orm_spawner is not None:
+            # The bill timestamp is removed in the next run
+            self._stopped.setdefault(user_name, set()).add(spawner.orm_spawner.id)
+
+    def schedule(self, spawner, when):
+        """Set the time of the next bill of a registered spawner"""
+        if spawner in self:
+            self.scheduler.schedule(self.key(spawner.user.name, spawner.name), when)
+
+    def values_id(self, spawner):
+        """Id of the CreditsUserValues paying for a spawner, or None"""
+        return self._values_ids.get((spawner.user.name, spawner.name), None)
+
+    def generation(self, user_name):
+        return self._generations.get(user_name, 0)
+
+    def set_values_id(self, spawner, values_id, generation):
+        """Keep the resolved CreditsUserValues of a spawner.
+
+        Ignored if the credit values of the user changed since
+        `generation`, or the spawner isn't registered anymore.
+        """
+        if spawner in self and generation == self.generation(spawner.user.name):
+            self._values_ids[(spawner.user.name, spawner.name)] = values_id
+
+    def invalidate_user(self, user_name):
+        """Forget the resolved CreditsUserValues of a user's spawners"""
+        self._generations[user_name] = self.generation(user_name) + 1
+        for spawner_name in self._running.get(user_name, {}):
+            self._values_ids.pop((user_name, spawner_name), None)
+
+    def snapshot(self, spawner):
+        """SpawnerSnapshot of a registered spawner, with its values id"""
+        return SpawnerSnapshot.from_spawner(spawner)._replace(
+            values_id=self.values_id(spawner),
+            values_generation=self.generation(spawner.user.name),
+        )
+
+    def user_names(self):
+        """Names of all users with running or recently stopped spawners"""
+        return set(self._running.keys()) | set(self._stopped.keys())
+
+    def stopped_user_names(self):
+        return set(self._stopped.keys())
+
+    def spawners(self, user_name):
+        return list(self._running.get(user_name, {}).values())
+
+    def pop_stopped(self, user_name):
+        """Return and forget the ids of the stopped spawners of a user"""
+        return self._stopped.pop(user_name, set())
@@ -0,0 +1,146 @@
+import calendar
+import copy
+import hashlib
+import itertools
+import json
+import time
+import uuid
+from collections import OrderedDict
+
+
+def auth_state_hash(auth_state):
+    """Stable hash of an auth_state dict, for cache keys"""
+    if not auth_state:
+        return None
+    dumped = json.dumps(auth_state, sort_keys=True, default=str)
+    return hashlib.sha256(dumped.encode("utf8")).hexdigest()
+
+
+class TTLCache:
+    """Size-bounded LRU cache whose entries expire after `ttl` seconds.
+
+    Values are deep-copied on the way in and out, so callers may modify
+    what they get without changing the cached value.
+    """
+
+    def __init__(self, ttl, size):
+        self.ttl = ttl
+        self.size = size
+        # key -> (expires, value), least recently used first
+        self._entries = OrderedDict()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, key, default=None):
+        entry = self._entries.get(key, None)
+        if entry is None:
+            return default
+        expires, value = entry
+        if expires <= time.monotonic():
+            del self._entries[key]
+            return default
+        self._entries.move_to_end(key)
+        return copy.deepcopy(value)
+
+    def set(self, key, value):
+        self._entries[key] = (time.monotonic() + self.ttl, copy.deepcopy(value))
+        self._entries.move_to_end(key)
+        while len(self._entries) > max(self.size, 1):
+            self._entries.popitem(last=False)
+
+    def invalidate(self, match=None):
+        """Remove all entries, or those whose key `match(key)` returns True for.
+
+        Returns the number of removed entries.
+        """
+        if match is None:
+            removed = len(self._entries)
+            self._entries.clear()
+            return removed
+        keys = [key for key in self._entries if match(key)]
+        for key in keys:
+            del self._entries[key]
+        return len(keys)
+
+
+class VersionStamps:
+    """Versions of the credits of users and projects, for ETags.
+
+    Every change of credits touches the changed users and projects after
+    it's committed, which gives them a new stamp from one increasing
+    counter. A response is tagged with a stamp taken before its credits are
+    read. They're unchanged as long as neither the user, nor one of their
+    projects, nor everything was touched after that stamp.
+
+    Stamps are only kept in memory. The ETags contain a random epoch, so
+    the ones of an earlier process never match. Changes made to the
+    database by anything else than this process aren't noticed.
+    """
+
+    def __init__(self):
+        self.epoch = uuid.uuid4().hex[:8]
+        self._counter = itertools.count(1)
+        self._all = 0
+        # name -> stamp of the last change
+        self._users = {}
+        self._projects = {}
+        # user name -> names of their projects, as of their last response
+        self._user_projects = {}
+
+    def stamp(self):
+        return next(self._counter)
+
+    def touch_user(self, user_name):
+        self._users[user_name] = self.stamp()
+
+    def touch_project(self, project_name):
+        self._projects[project_name] = self.stamp()
+
+    def touch_all(self):
+        self._all = self.stamp()
+
+    def remember(self, user_name, project_names):
+        self._user_projects[user_name] = tuple(project_names)
+
+    def etag(self, stamp, expires=None):
+        """ETag for the credits read after `stamp`.
+
+        `expires` is the time (naive UTC) at which they change without any
+        write, e.g. by lazy grants.
+        """
+        expires = int(calendar.timegm(expires.timetuple())) if expires else 0
+        return f'"{self.epoch}-{stamp}-{expires}"'
+
+    def latest(self, user_name, project_names):
+        """Stamp of the last change of a user or their projects"""
+        return max(
+            [self._all, self._users.get(user_name, 0)]
+            + [self._projects.get(name, 0) for name in project_names]
+        )
+
+    def changed_since(self, user_name, project_names, stamp):
+        return self.latest(user_name, project_names) > stamp
+
+    def unchanged(self, user_name, etags, now):
+        """The first ETag in `etags` (If-None-Match) that is still valid, or None"""
+        if user_name not in self._user_projects:
+            return None
+        latest = self.latest(user_name, self._user_projects[user_name])
+        now = calendar.timegm(now.timetuple())
+        for etag in etags.split(","):
+            etag = etag.strip()
+            if etag.startswith("W/"):
+                etag = etag[2:]
+            try:
+                epoch, stamp, expires = etag.strip('"').split("-")
+                stamp = int(stamp)
+                expires = int(expires)
+            except ValueError:
+                continue
+            if epoch != self.epoch or stamp < latest:
+                continue
+            if expires and now >= expires:
+                continue
+            return f'"{epoch}-{stamp}-{expires}"'
+        return None
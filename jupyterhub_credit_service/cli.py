@@ -0,0 +1,579 @@
+"""
+Offline admin tool for the credit tables in the Hub's database.
+
+    jupyterhub-credit-service --db-url sqlite:///jupyterhub.sqlite stats
+    jupyterhub-credit-service export values -o values.jsonl
+    jupyterhub-credit-service import values values.csv
+    jupyterhub-credit-service reset --project community1
+
+Imports and exports stream their rows in chunks, so they work with any
+number of users. import and reset upgrade the credit tables like the Hub
+does at startup (import creates them), stats and export only read them.
+Changed balances are recorded in the ledger as admin changes, with
+--ledger (default: $JUPYTERHUB_CREDITS_LEDGER).
+
+Changes are written to the database directly, a running Hub doesn't
+notice them. Restart it afterwards, whatever its configuration: it
+keeps answering /api/credits requests with If-None-Match with
+304 Not Modified for unchanged ETags, and with `credits_balance_cache`
+it overwrites the balances with its own at the next flush, unless it's
+stopped before.
+"""
+
+import argparse
+import csv
+import json
+import os
+import sys
+from datetime import datetime
+
+from jupyterhub.utils import utcnow
+from sqlalchemy import (
+    DateTime,
+    Unicode,
+    bindparam,
+    case,
+    create_engine,
+    func,
+    insert,
+    inspect,
+    literal,
+    select,
+    update,
+)
+
+from .orm import (
+    Base,
+    CreditsLedger,
+    CreditsProject,
+    CreditsSpawnerBill,
+    CreditsUser,
+    CreditsUserValues,
+    outdated_tables,
+    upgrade_tables,
+)
+
+# Columns of the exported and imported rows of each kind
+COLUMNS = {
+    "values": [
+        "user_name",
+        "name",
+        "balance",
+        "cap",
+        "grant_value",
+        "grant_interval",
+        "grant_last_update",
+        "project_name",
+        "user_options",
+    ],
+    "projects": [
+        "name",
+        "display_name",
+        "balance",
+        "cap",
+        "grant_value",
+        "grant_interval",
+        "grant_last_update",
+        "user_options",
+    ],
+}
+TABLES = {"values": CreditsUserValues, "projects": CreditsProject}
+INTEGERS = {"balance", "cap", "grant_value", "grant_interval"}
+# Columns without a default, required in imported rows
+REQUIRED = {
+    "values": {"user_name", "name", "cap", "grant_value", "grant_interval"},
+    "projects": {"name", "cap", "grant_value", "grant_interval"},
+}
+
+
+def detect_format(path, format):
+    if format:
+        return format
+    if path and path.endswith(".csv"):
+        return "csv"
+    return "jsonl"
+
+
+def to_plain(row, columns):
+    """Exported row: JSON compatible values"""
+    plain = {}
+    for column in columns:
+        value = row[column]
+        if isinstance(value, datetime):
+            value = value.isoformat()
+        plain[column] = value
+    return plain
+
+
+def from_plain(row, kind, now):
+    """Imported row: column values of the table.
+
+    Missing or empty columns get their defaults (the cap for the balance,
+    `now` for grant_last_update). Raises ValueError for invalid rows.
+    """
+    missing = {c for c in REQUIRED[kind] if row.get(c, None) in (None, "")}
+    if missing:
+        raise ValueError(f"Missing {', '.join(sorted(missing))} in {row}")
+    values = {}
+    for column in COLUMNS[kind]:
+        value = row.get(column, None)
+        if value == "":
+            value = None
+        if value is not None:
+            if column in INTEGERS:
+                value = int(value)
+            elif column == "grant_last_update":
+                value = datetime.fromisoformat(value)
+            elif column == "user_options" and isinstance(value, str):
+                value = json.loads(value)
+        values[column] = value
+    if values["balance"] is None:
+        values["balance"] = values["cap"]
+    if values["grant_last_update"] is None:
+        values["grant_last_update"] = now
+    if kind == "projects" and values["display_name"] is None:
+        values["display_name"] = values["name"]
+    return values
+
+
+def read_rows(file, format):
+    if format == "csv":
+        yield from csv.DictReader(file)
+    else:
+        for line in file:
+            if line.strip():
+                yield json.loads(line)
+
+
+def chunked(rows, size):
+    chunk = []
+    for row in rows:
+        chunk.append(row)
+        if len(chunk) >= size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+
+def iter_table(connection, kind, chunk_size):
+    """All rows of a table, in chunks ordered by primary key"""
+    cls = TABLES[kind]
+    key = cls.id if kind == "values" else cls.name
+    columns = [getattr(cls, column) for column in COLUMNS[kind]]
+    last = None
+    while True:
+        query = select(key, *columns).order_by(key).limit(chunk_size)
+        if last is not None:
+            query = query.where(key > last)
+        rows = connection.execute(query).mappings().all()
+        if not rows:
+            return
+        yield from rows
+        last = rows[-1][key.name]
+
+
+def export_rows(engine, kind, file, format, chunk_size):
+    columns = COLUMNS[kind]
+    writer = None
+    if format == "csv":
+        writer = csv.DictWriter(file, fieldnames=columns)
+        writer.writeheader()
+    count = 0
+    with engine.connect() as connection:
+        for row in iter_table(connection, kind, chunk_size):
+            plain = to_plain(row, columns)
+            if writer:
+                if plain["user_options"] is not None:
+                    plain["user_options"] = json.dumps(plain["user_options"])
+                writer.writerow(plain)
+            else:
+                file.write(json.dumps(plain) + "\n")
+            count += 1
+    return count
+
+
+def ledger_entry(now, amount, balance, **names):
+    """Ledger entry of an admin change of a balance"""
+    return {
+        "timestamp": now,
+        "kind": "admin",
+        "user_name": None,
+        "credits_name": None,
+        "project_name": None,
+        "spawner_id": None,
+        "spawner_name": None,
+        "amount": amount,
+        "balance": balance,
+        **names,
+    }
+
+
+def import_projects(connection, rows, now, ledger):
+    names = [row["name"] for row in rows]
+    existing = dict(
+        connection.execute(
+            select(CreditsProject.name, CreditsProject.balance).where(
+                CreditsProject.name.in_(names)
+            )
+        ).all()
+    )
+    new = [row for row in rows if row["name"] not in existing]
+    changed = [
+        {"b_name": row["name"], **row} for row in rows if row["name"] in existing
+    ]
+    entries = [
+        ledger_entry(
+            now,
+            row["balance"] - existing[row["name"]],
+            row["balance"],
+            project_name=row["name"],
+        )
+        for row in rows
+        if ledger
+        and row["name"] in existing
+        and row["balance"] != existing[row["name"]]
+    ]
+    if new:
+        connection.execute(insert(CreditsProject), new)
+    if changed:
+        table = CreditsProject.__table__
+        connection.execute(
+            update(table)
+            .where(table.c.name == bindparam("b_name"))
+            .values({c: bindparam(c) for c in COLUMNS["projects"]}),
+            changed,
+        )
+    if entries:
+        connection.execute(insert(CreditsLedger), entries)
+    return len(new), len(changed)
+
+
+def import_values(connection, rows, now, ledger):
+    user_names = {row["user_name"] for row in rows}
+    existing_users = set(
+        connection.scalars(
+            select(CreditsUser.name).where(CreditsUser.name.in_(user_names))
+        )
+    )
+    new_users = [{"name": name} for name in sorted(user_names - existing_users)]
+    if new_users:
+        connection.execute(insert(CreditsUser), new_users)
+    existing = {
+        (user_name, name): (id, balance)
+        for id, user_name, name, balance in connection.execute(
+            select(
+                CreditsUserValues.id,
+                CreditsUserValues.user_name,
+                CreditsUserValues.name,
+                CreditsUserValues.balance,
+            ).where(CreditsUserValues.user_name.in_(user_names))
+        )
+    }
+    new = []
+    changed = []
+    entries = []
+    for row in rows:
+        id, balance = existing.get((row["user_name"], row["name"]), (None, None))
+        if id is None:
+            new.append(row)
+            continue
+        changed.append({"b_id": id, **row})
+        if ledger and row["balance"] != balance:
+            entries.append(
+                ledger_entry(
+                    now,
+                    row["balance"] - balance,
+                    row["balance"],
+                    user_name=row["user_name"],
+                    credits_name=row["name"],
+                )
+            )
+    if new:
+        connection.execute(insert(CreditsUserValues), new)
+    if changed:
+        table = CreditsUserValues.__table__
+        connection.execute(
+            update(table)
+            .where(table.c.id == bindparam("b_id"))
+            .values({c: bindparam(c) for c in COLUMNS["values"]}),
+            changed,
+        )
+    if entries:
+        connection.execute(insert(CreditsLedger), entries)
+    # Apply their configuration at the next login again, like after
+    # changes through the admin API
+    connection.execute(
+        update(CreditsUser)
+        .where(CreditsUser.name.in_(user_names))
+        .values(config_fingerprint=None)
+    )
+    return len(new), len(changed)
+
+
+def import_rows(engine, kind, file, format, chunk_size, now, ledger=False):
+    """Insert or update the rows of `file`, one transaction per chunk.
+
+    With `ledger`, changed balances of updated rows are recorded as admin
+    changes. Returns the number of inserted and updated rows.
+    """
+    importer = import_values if kind == "values" else import_projects
+    inserted = updated = 0
+    for number, chunk in enumerate(chunked(read_rows(file, format), chunk_size)):
+        try:
+            rows = [from_plain(row, kind, now) for row in chunk]
+        except ValueError as e:
+            raise ValueError(f"Chunk {number + 1}: {e}") from e
+        # The last row of a key in a chunk wins
+        key = ("user_name", "name") if kind == "values" else ("name",)
+        rows = list({tuple(row[k] for k in key): row for row in rows}.values())
+        with engine.begin() as connection:
+            new, changed = importer(connection, rows, now, ledger)
+        inserted += new
+        updated += changed
+    return inserted, updated
+
+
+def reset_balances(engine, kind, balance, names, projects, now, ledger=False):
+    """Set balances to `balance` (or their cap, if None), limited by the cap.
+
+    Projects are selected by `names`, user values by the user `names` or
+    their `projects`. No names select all rows. grant_last_update is set to
+    `now`. With `ledger`, the changes are recorded as admin changes.
+    Returns the number of changed rows.
+    """
+    cls = TABLES[kind]
+    if balance is None:
+        new_balance = cls.cap
+    else:
+        new_balance = case((cls.cap < balance, cls.cap), else_=balance)
+    where = []
+    if kind == "projects" and names:
+        where.append(cls.name.in_(names))
+    if kind == "values":
+        if names:
+            where.append(cls.user_name.in_(names))
+        if projects:
+            where.append(cls.project_name.in_(projects))
+    with engine.begin() as connection:
+        if ledger:
+            # Copied with INSERT ... SELECT, like the set-based grants
+            ledger_names = cls.ledger_names()
+            columns = ["timestamp", "kind", *ledger_names, "amount", "balance"]
+            changes = select(
+                bindparam("now", now, type_=DateTime()),
+                literal("admin", Unicode),
+                *ledger_names.values(),
+                new_balance - cls.balance,
+                new_balance,
+            ).where(*where, new_balance != cls.balance)
+            connection.execute(insert(CreditsLedger).from_select(columns, changes))
+        query = update(cls).where(*where)
+        query = query.values(balance=new_balance, grant_last_update=now)
+        return connection.execute(query).rowcount
+
+
+def stats(engine):
+    with engine.connect() as connection:
+
+        def scalar(query):
+            return connection.execute(query).scalar() or 0
+
+        result = {"users": scalar(select(func.count()).select_from(CreditsUser))}
+        for kind, cls in TABLES.items():
+            result[kind] = {
+                "rows": scalar(select(func.count()).select_from(cls)),
+                "balance": scalar(select(func.sum(cls.balance))),
+                "cap": scalar(select(func.sum(cls.cap))),
+                "empty": scalar(
+                    select(func.count()).select_from(cls).where(cls.balance <= 0)
+                ),
+                "at_cap": scalar(
+                    select(func.count()).select_from(cls).where(cls.balance >= cls.cap)
+                ),
+            }
+        result["billed_servers"] = scalar(
+            select(func.count()).select_from(CreditsSpawnerBill)
+        )
+        result["ledger_entries"] = scalar(
+            select(func.count()).select_from(CreditsLedger)
+        )
+    return result
+
+
+def open_output(path):
+    if not path or path == "-":
+        return sys.stdout
+    return open(path, "w", newline="")
+
+
+def open_input(path):
+    if not path or path == "-":
+        return sys.stdin
+    return open(path, newline="")
+
+
+def get_parser():
+    parser = argparse.ArgumentParser(
+        prog="jupyterhub-credit-service",
+        description=__doc__.strip().splitlines()[0],
+    )
+    parser.add_argument(
+        "--db-url",
+        default=os.environ.get(
+            "JUPYTERHUB_CREDITS_DB_URL",
+            os.environ.get("JUPYTERHUB_DB_URL", "sqlite:///jupyterhub.sqlite"),
+        ),
+        help="Database with the credit tables (default: $JUPYTERHUB_CREDITS_DB_URL, $JUPYTERHUB_DB_URL or sqlite:///jupyterhub.sqlite)",
+    )
+    parser.add_argument(
+        "--ledger",
+        action=argparse.BooleanOptionalAction,
+        default=os.environ.get("JUPYTERHUB_CREDITS_LEDGER", "0").lower()
+        in ["1", "true"],
+        help="Record changed balances in the ledger, like credits_ledger (default: $JUPYTERHUB_CREDITS_LEDGER)",
+    )
+    parser.add_argument(
+        "--chunk-size",
+        type=int,
+        default=1000,
+        help="Rows per query and per import transaction (default: 1000)",
+    )
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    export_parser = commands.add_parser(
+        "export", help="Write all user values or projects"
+    )
+    export_parser.add_argument("kind", choices=sorted(COLUMNS))
+    export_parser.add_argument("-o", "--output", help="File (default: stdout)")
+    export_parser.add_argument("--format", choices=["csv", "jsonl"])
+
+    import_parser = commands.add_parser(
+        "import",
+        help="Insert or update user values or projects",
+        description="Rows are matched by user_name and name (values) or name "
+        "(projects). Users of new values are created. Import the projects "
+        "before the values that refer to them.",
+    )
+    import_parser.add_argument("kind", choices=sorted(COLUMNS))
+    import_parser.add_argument("input", nargs="?", help="File (default: stdin)")
+    import_parser.add_argument("--format", choices=["csv", "jsonl"])
+
+    reset_parser = commands.add_parser(
+        "reset",
+        help="Set balances to their cap or a value",
+    )
+    reset_parser.add_argument(
+        "--kind", choices=sorted(COLUMNS), default="values", help="(default: values)"
+    )
+    reset_parser.add_argument(
+        "--balance",
+        type=int,
+        default=None,
+        help="New balance, at most the cap (default: the cap)",
+    )
+    reset_parser.add_argument(
+        "--name",
+        action="append",
+        dest="names",
+        help="Only these users (values) or projects (projects). May be repeated.",
+    )
+    reset_parser.add_argument(
+        "--project",
+        action="append",
+        dest="projects",
+        help="Only the values of the members of these projects. May be repeated.",
+    )
+
+    commands.add_parser("stats", help="Summary of users, balances and projects")
+    return parser
+
+
+def prepare_tables(engine, command):
+    """Upgrade the credit tables like the Hub does at startup, for changes.
+
+    Only import creates them. The other commands need existing tables, so
+    a mistyped --db-url isn't filled with empty ones, and stats and export
+    don't change the database at all. Returns an error message or None.
+    """
+    tables = set(inspect(engine).get_table_names())
+    if not tables & set(Base.metadata.tables) and command != "import":
+        return "No credit tables in the database, check --db-url"
+    outdated = outdated_tables(engine)
+    if command in ("import", "reset"):
+        upgrade = upgrade_tables(engine)
+        if upgrade["bills"]:
+            print(
+                f"Migrated {upgrade['bills']} spawner bills to their own table",
+                file=sys.stderr,
+            )
+        for name, error in upgrade["index_errors"].items():
+            print(f"Could not create index {name}: {error}", file=sys.stderr)
+    elif outdated:
+        return (
+            f"Credit tables of an earlier version ({', '.join(outdated)}), "
+            "start the Hub or run import or reset to upgrade them"
+        )
+    return None
+
+
+def main(argv=None):
+    parser = get_parser()
+    args = parser.parse_args(argv)
+    if args.command == "reset" and args.kind == "projects" and args.projects:
+        parser.error("--project only selects values, use --name for projects")
+    engine = create_engine(args.db_url)
+    now = utcnow(with_tz=False)
+    try:
+        error = prepare_tables(engine, args.command)
+        if error:
+            print(error, file=sys.stderr)
+            return 1
+        if args.command == "export":
+            format = detect_format(args.output, args.format)
+            file = open_output(args.output)
+            try:
+                count = export_rows(engine, args.kind, file, format, args.chunk_size)
+            finally:
+                if file is not sys.stdout:
+                    file.close()
+            print(f"Exported {count} {args.kind}", file=sys.stderr)
+        elif args.command == "import":
+            format = detect_format(args.input, args.format)
+            file = open_input(args.input)
+            try:
+                inserted, updated = import_rows(
+                    engine,
+                    args.kind,
+                    file,
+                    format,
+                    args.chunk_size,
+                    now,
+                    args.ledger,
+                )
+            except ValueError as e:
+                print(f"Import failed: {e}", file=sys.stderr)
+                return 1
+            finally:
+                if file is not sys.stdin:
+                    file.close()
+            print(
+                f"Imported {args.kind}: {inserted} inserted, {updated} updated",
+                file=sys.stderr,
+            )
+        elif args.command == "reset":
+            rows = reset_balances(
+                engine,
+                args.kind,
+                args.balance,
+                args.names,
+                args.projects,
+                now,
+                args.ledger,
+            )
+            print(f"Reset {rows} {args.kind}", file=sys.stderr)
+        elif args.command == "stats":
+            print(json.dumps(stats(engine), indent=2))
+    finally:
+        engine.dispose()
+    return 0
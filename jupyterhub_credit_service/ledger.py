@@ -0,0 +1,98 @@
+import threading
+from collections import deque
+from contextlib import contextmanager
+
+from sqlalchemy import insert
+
+from .balances import CachedProject
+from .orm import CreditsLedger, CreditsProject
+
+
+class CreditsLedgerBuffer:
+    """Ledger entries waiting to be written to the credits_ledger table.
+
+    Entries are added while balances change and written with one bulk
+    INSERT by flush(), once per credit task run. Entries can be added
+    from the credit database threads and the event loop at the same time.
+
+    Entries added inside scope() are only kept if their changes are, e.g.
+    not those of a user whose bill failed and was rolled back.
+    """
+
+    def __init__(self):
+        self._entries = deque()
+        # Entries of the open scopes of each thread, innermost last
+        self._local = threading.local()
+
+    def _scopes(self):
+        scopes = getattr(self._local, "scopes", None)
+        if scopes is None:
+            scopes = self._local.scopes = []
+        return scopes
+
+    def __len__(self):
+        return len(self._entries)
+
+    def add(self, kind, credits, amount, now, spawner=None):
+        """Record a change of `amount` of a CreditsUserValues or CreditsProject.
+
+        `credits` may also be one of their CreditsBalanceCache counterparts.
+        `spawner` is the SpawnerSnapshot of a billed server.
+        """
+        entry = {
+            "timestamp": now,
+            "kind": kind,
+            "user_name": None,
+            "credits_name": None,
+            "project_name": None,
+            "spawner_id": None,
+            "spawner_name": None,
+            "amount": amount,
+            "balance": credits.balance,
+        }
+        if isinstance(credits, (CreditsProject, CachedProject)):
+            entry["project_name"] = credits.name
+        else:
+            entry["user_name"] = credits.user_name
+            entry["credits_name"] = credits.name
+        if spawner is not None:
+            entry["spawner_id"] = spawner.orm_id
+            entry["spawner_name"] = spawner.name
+        scopes = self._scopes()
+        (scopes[-1] if scopes else self._entries).append(entry)
+
+    @contextmanager
+    def scope(self):
+        """Drop the entries added by this thread in the block, if it raises"""
+        scopes = self._scopes()
+        scopes.append([])
+        try:
+            yield
+        except:
+            scopes.pop()
+            raise
+        entries = scopes.pop()
+        (scopes[-1] if scopes else self._entries).extend(entries)
+
+    def keep(self):
+        """Keep the entries of the open scopes of this thread, once committed"""
+        for entries in self._scopes():
+            self._entries.extend(entries)
+            entries.clear()
+
+    def flush(self, db):
+        """Insert all buffered entries. Returns the number of rows written.
+
+        The entries are part of the current transaction of `db`.
+        """
+        entries = []
+        while self._entries:
+            entries.append(self._entries.popleft())
+        if entries:
+            try:
+                db.execute(insert(CreditsLedger), entries)
+            except:
+                # Keep them for the next flush
+                self._entries.extendleft(reversed(entries))
+                raise
+        return len(entries)
@@ -0,0 +1,259 @@
+import fnmatch
+import re
+
+
+class UserOptionsMatcher:
+    """Compiled form of a configured `user_options` value.
+
+    CreditsAuthenticator.match_user_options() compiles each configuration
+    once and reuses the matcher for all spawners. Configured values are
+    dispatched by type when compiled:
+
+    - list: the spawner value has to be in the list
+    - str: regex (or, if it's no valid regex, glob) full match of the
+      spawner value as string
+    - int, float, bool: the spawner value has to be equal
+    - dict: nested user_options, matched recursively
+    - anything else: the string representations have to be equal
+
+    A spawner value that is a list with one element is matched as that
+    element. Each matcher class of these types has a match(value) method,
+    compile_user_options() only creates those.
+    """
+
+    @staticmethod
+    def unwrap(value):
+        if type(value) == list and len(value) == 1:
+            return value[0]
+        return value
+
+
+class ListMatcher(UserOptionsMatcher):
+    def __init__(self, values):
+        try:
+            self.values = frozenset(values)
+        except TypeError:
+            # Unhashable entries, e.g. nested lists
+            self.values = list(values)
+
+    def match(self, value):
+        try:
+            return self.unwrap(value) in self.values
+        except TypeError:
+            # Unhashable spawner value can't be in a set of hashable ones
+            return False
+
+
+class PatternMatcher(UserOptionsMatcher):
+    def __init__(self, pattern):
+        self.pattern = pattern
+
+    def match(self, value):
+        return self.pattern.fullmatch(str(self.unwrap(value))) is not None
+
+
+class EqualMatcher(UserOptionsMatcher):
+    def __init__(self, value):
+        self.value = value
+
+    def match(self, value):
+        return self.unwrap(value) == self.value
+
+
+class StrEqualMatcher(UserOptionsMatcher):
+    def __init__(self, value):
+        self.value = str(value)
+
+    def match(self, value):
+        return str(self.unwrap(value)) == self.value
+
+
+class DictMatcher(UserOptionsMatcher):
+    def __init__(self, matchers):
+        # (key, matcher) tuples
+        self.matchers = tuple(matchers)
+
+    def match(self, value):
+        if not self.matchers:
+            return True
+        value = self.unwrap(value)
+        if not isinstance(value, dict):
+            return False
+        for key, matcher in self.matchers:
+            if key not in value:
+                return False
+            if not matcher.match(value[key]):
+                return False
+        return True
+
+
+def compile_pattern(pattern):
+    """Compile a configured string to a regex.
+
+    Strings that aren't valid regular expressions are used as glob
+    patterns. Returns None if neither works.
+    """
+    try:
+        return re.compile(pattern)
+    except re.error:
+        pass
+    try:
+        return re.compile(fnmatch.translate(pattern))
+    except re.error:
+        return None
+
+
+def compile_user_options(user_options_configured, log=None):
+    """Compile configured user_options into a UserOptionsMatcher"""
+    matchers = []
+    for key, value in (user_options_configured or {}).items():
+        if type(value) == list:
+            matcher = ListMatcher(value)
+        elif type(value) == str:
+            pattern = compile_pattern(value)
+            if pattern is None:
+                if log:
+                    log.warning(
+                        f"Invalid regex pattern {value} for user_option {key}. Check if strings are equal."
+                    )
+                matcher = EqualMatcher(value)
+            else:
+                matcher = PatternMatcher(pattern)
+        elif type(value) in [int, float, bool]:
+            matcher = EqualMatcher(value)
+        elif type(value) == dict:
+            matcher = compile_user_options(value, log)
+        else:
+            if log:
+                log.debug(
+                    f"Unsupported type {type(value)} for user_option {key}. Check if strings are equal."
+                )
+            matcher = StrEqualMatcher(value)
+        matchers.append((key, matcher))
+    return DictMatcher(matchers)
+
+
+_SCALARS = {str, int, float, bool, type(None)}
+
+
+def _freeze(value):
+    value_type = type(value)
+    if value_type in _SCALARS:
+        return (value_type, value)
+    if value_type == dict:
+        return (dict, tuple([(k, _freeze(v)) for k, v in value.items()]))
+    if value_type == list:
+        return (list, tuple([_freeze(v) for v in value]))
+    try:
+        hash(value)
+    except TypeError:
+        return (value_type, repr(value))
+    return (value_type, value)
+
+
+def user_options_fingerprint(user_options_configured):
+    """Key of a user_options configuration in the matcher cache.
+
+    Equal configurations have equal fingerprints, values of different
+    types (e.g. 1, 1.0, True and "1") have different ones.
+    """
+    return tuple(
+        (key, _freeze(value)) for key, value in (user_options_configured or {}).items()
+    )
+
+
+# Strings without these characters are matched as literal strings
+_REGEX_SPECIAL = set(".^$*+?{}[]\\|()")
+
+
+class UserOptionsIndex:
+    """Dispatch from spawner user_options to an ordered list of configurations.
+
+    Each configuration with user_options is put in a bucket by its first
+    key with an exact constraint: a list, a number or a string without
+    regex characters. Only configurations in the buckets of the spawner's
+    values, and those without an exact constraint, are matched against
+    the spawner, in their configured order. Configurations without
+    user_options are the defaults.
+    """
+
+    def __init__(self, user_options_list, get_matcher=compile_user_options):
+        self.defaults = []
+        self.matchers = {}
+        # key -> {value: [positions]}, compared with the spawner value
+        self.exact = {}
+        # key -> {string: [positions]}, compared with str(spawner value)
+        self.strings = {}
+        # positions without an exact constraint
+        self.scan = []
+        for position, user_options_configured in enumerate(user_options_list):
+            if not user_options_configured:
+                self.defaults.append(position)
+                continue
+            self.matchers[position] = get_matcher(user_options_configured)
+            if not self._add_to_bucket(position, user_options_configured):
+                self.scan.append(position)
+
+    def _add_to_bucket(self, position, user_options_configured):
+        for key, value in user_options_configured.items():
+            value_type = type(value)
+            if value_type == list:
+                try:
+                    values = set(value)
+                except TypeError:
+                    continue
+                buckets = self.exact
+            elif value_type in [int, float, bool]:
+                values = {value}
+                buckets = self.exact
+            elif value_type == str and not _REGEX_SPECIAL.intersection(value):
+                values = {value}
+                buckets = self.strings
+            else:
+                continue
+            bucket = buckets.setdefault(key, {})
+            for value in values:
+                bucket.setdefault(value, []).append(position)
+            return True
+        return False
+
+    def candidates(self, user_options):
+        """Positions of the configurations that may match, in order"""
+        user_options = user_options or {}
+        positions = set(self.scan)
+        for key, bucket in self.exact.items():
+            if key in user_options:
+                try:
+                    value = UserOptionsMatcher.unwrap(user_options[key])
+                    positions.update(bucket.get(value, ()))
+                except TypeError:
+                    # Unhashable spawner values can't be in a bucket
+                    pass
+        for key, bucket in self.strings.items():
+            if key in user_options:
+                value = str(UserOptionsMatcher.unwrap(user_options[key]))
+                positions.update(bucket.get(value, ()))
+        return sorted(positions)
+
+    def match(self, user_options):
+        """Position of the first configuration with matching user_options"""
+        for position in self.candidates(user_options):
+            if self.matchers[position].match(user_options or {}):
+                return position
+        return None
+
+    def resolve(self, user_options, defaults_last=True):
+        """Position of the configuration to use for user_options, or None.
+
+        With defaults_last, the first matching configuration with
+        user_options is used, or else the last default. Otherwise the
+        defaults match any user_options at their position.
+        """
+        position = self.match(user_options)
+        if defaults_last:
+            if position is None and self.defaults:
+                return self.defaults[-1]
+            return position
+        positions = [position] + self.defaults[:1]
+        positions = [p for p in positions if p is not None]
+        return min(positions) if positions else None
@@ -0,0 +1,108 @@
+"""
+Prometheus metrics of the credit service
+
+The metrics are registered in the default registry of prometheus_client,
+like JupyterHub's own metrics, so they're served at /hub/metrics with
+the same prefix (`jupyterhub_` by default).
+"""
+
+import time
+from contextlib import contextmanager
+from enum import Enum
+
+from jupyterhub.metrics import metrics_prefix
+from prometheus_client import Counter, Gauge, Histogram
+
+
+class CreditsTaskPhase(Enum):
+    """Phases of the credit task"""
+
+    refresh = "refresh"
+    project_grant = "project_grant"
+    user_grant = "user_grant"
+    billing = "billing"
+    commit = "commit"
+    post_hook = "post_hook"
+
+
+CREDITS_TASK_PHASE_DURATION_SECONDS = Histogram(
+    "credits_task_phase_duration_seconds",
+    "Time taken by each phase of a credit task run",
+    ["phase"],
+    namespace=metrics_prefix,
+)
+
+for phase in CreditsTaskPhase:
+    CREDITS_TASK_PHASE_DURATION_SECONDS.labels(phase=phase.value)
+
+CREDITS_TASK_ROWS = Histogram(
+    "credits_task_rows",
+    "Number of credit rows read or written by a credit task run",
+    ["operation"],
+    buckets=[0, 1, 10, 100, 1000, 10000, 100000, float("inf")],
+    namespace=metrics_prefix,
+)
+
+for operation in ("read", "written"):
+    CREDITS_TASK_ROWS.labels(operation=operation)
+
+CREDITS_SPAWNERS_BILLED = Counter(
+    "credits_spawners_billed",
+    "Number of server bills of the credit task",
+    namespace=metrics_prefix,
+)
+
+CREDITS_SERVERS_STOPPED = Counter(
+    "credits_servers_stopped",
+    "Number of servers stopped by the credit task for insufficient credits",
+    namespace=metrics_prefix,
+)
+
+CREDITS_SSE_CONNECTIONS = Gauge(
+    "credits_sse_connections",
+    "Number of open credit event stream connections",
+    ["handler"],
+    namespace=metrics_prefix,
+)
+
+for handler in ("user", "server"):
+    CREDITS_SSE_CONNECTIONS.labels(handler=handler)
+
+
+class CreditsPhaseTimer:
+    """Durations of the phases of one credit task run.
+
+    Phases may be nested (e.g. commits while billing). The time of a
+    nested phase only counts for that phase, not for the outer one.
+    Phases entered several times (e.g. billing of each user) add up and
+    are observed once per run by observe().
+    """
+
+    def __init__(self):
+        self.durations = {}
+        self._current = None
+        self._since = None
+
+    def _charge(self):
+        now = time.perf_counter()
+        if self._current is not None:
+            self.durations[self._current] = (
+                self.durations.get(self._current, 0) + now - self._since
+            )
+        self._since = now
+
+    @contextmanager
+    def phase(self, phase):
+        self._charge()
+        outer, self._current = self._current, phase
+        try:
+            yield
+        finally:
+            self._charge()
+            self._current = outer
+
+    def observe(self):
+        for phase, duration in self.durations.items():
+            CREDITS_TASK_PHASE_DURATION_SECONDS.labels(phase=phase.value).observe(
+                duration
+            )
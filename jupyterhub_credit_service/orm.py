@@ -1,16 +1,312 @@
-from datetime import datetime
+from datetime import datetime, timedelta
 
-from sqlalchemy import JSON, Column, DateTime, ForeignKey, Integer, Unicode
+from sqlalchemy import (
+    JSON,
+    Column,
+    DateTime,
+    Float,
+    ForeignKey,
+    Index,
+    Integer,
+    Unicode,
+    and_,
+    bindparam,
+    case,
+    column,
+    func,
+    insert,
+    inspect,
+    literal,
+    select,
+    table,
+    update,
+)
+from sqlalchemy.ext.compiler import compiles
 from sqlalchemy.ext.mutable import MutableDict
-from sqlalchemy.orm import declarative_base, relationship
+from sqlalchemy.orm import declarative_base, relationship, selectinload
+from sqlalchemy.sql.expression import FunctionElement
+
+try:
+    from sqlalchemy.orm import attribute_keyed_dict
+except ImportError:
+    # SQLAlchemy < 2.0
+    from sqlalchemy.orm.collections import (
+        attribute_mapped_collection as attribute_keyed_dict,
+    )
 
 Base = declarative_base()
 
+# Dialects for which the grant accrual can be done with set-based UPDATEs
+SET_BASED_DIALECTS = {"sqlite", "postgresql", "mysql", "mariadb"}
+
+
+class elapsed_seconds(FunctionElement):
+    """Seconds between two DateTime expressions: elapsed_seconds(since, until)"""
+
+    type = Float()
+    name = "elapsed_seconds"
+    inherit_cache = True
+
+
+@compiles(elapsed_seconds, "sqlite")
+def _sqlite_elapsed_seconds(element, compiler, **kw):
+    since, until = [compiler.process(c, **kw) for c in element.clauses]
+    # julianday() is a float of days. Round to milliseconds to hide
+    # floating point noise at exact interval boundaries.
+    return f"ROUND((julianday({until}) - julianday({since})) * 86400.0, 3)"
+
+
+@compiles(elapsed_seconds, "postgresql")
+def _pg_elapsed_seconds(element, compiler, **kw):
+    since, until = [compiler.process(c, **kw) for c in element.clauses]
+    return f"EXTRACT(EPOCH FROM ({until} - {since}))"
+
+
+@compiles(elapsed_seconds, "mysql")
+@compiles(elapsed_seconds, "mariadb")
+def _mysql_elapsed_seconds(element, compiler, **kw):
+    since, until = [compiler.process(c, **kw) for c in element.clauses]
+    return f"(TIMESTAMPDIFF(MICROSECOND, {since}, {until}) / 1000000.0)"
+
+
+class add_seconds(FunctionElement):
+    """DateTime moved forward by whole seconds: add_seconds(when, seconds)"""
+
+    type = DateTime()
+    name = "add_seconds"
+    inherit_cache = True
+
+
+@compiles(add_seconds, "sqlite")
+def _sqlite_add_seconds(element, compiler, **kw):
+    when, seconds = [compiler.process(c, **kw) for c in element.clauses]
+    # strftime() only knows milliseconds. The shift is a whole number of
+    # seconds, so the stored fraction (".ffffff" from position 20) is kept.
+    return (
+        f"(strftime('%Y-%m-%d %H:%M:%S', {when}, '+' || ({seconds}) || ' seconds')"
+        f" || substr({when}, 20))"
+    )
+
+
+@compiles(add_seconds, "postgresql")
+def _pg_add_seconds(element, compiler, **kw):
+    when, seconds = [compiler.process(c, **kw) for c in element.clauses]
+    return f"({when} + make_interval(secs => {seconds}))"
+
+
+@compiles(add_seconds, "mysql")
+@compiles(add_seconds, "mariadb")
+def _mysql_add_seconds(element, compiler, **kw):
+    when, seconds = [compiler.process(c, **kw) for c in element.clauses]
+    return f"TIMESTAMPADD(MICROSECOND, ({seconds}) * 1000000, {when})"
+
+
+class whole_intervals(FunctionElement):
+    """Number of complete intervals: whole_intervals(seconds, interval)"""
+
+    type = Integer()
+    name = "whole_intervals"
+    inherit_cache = True
+
+
+@compiles(whole_intervals)
+def _whole_intervals(element, compiler, **kw):
+    seconds, interval = [compiler.process(c, **kw) for c in element.clauses]
+    return f"FLOOR(({seconds}) / ({interval}))"
+
+
+@compiles(whole_intervals, "sqlite")
+def _sqlite_whole_intervals(element, compiler, **kw):
+    # floor() is only available in sqlite builds with math functions.
+    # The elapsed time is always positive here, so truncating is the same.
+    seconds, interval = [compiler.process(c, **kw) for c in element.clauses]
+    return f"CAST(({seconds}) / ({interval}) AS INTEGER)"
+
+
+class CreditsGrantMixin:
+    """Grant accrual shared by CreditsProject and CreditsUserValues."""
+
+    # Keep moving grant_last_update forward while the balance is at its cap
+    grant_at_cap = True
+    # Grant once exactly grant_interval seconds have passed (instead of after)
+    grant_inclusive = True
+
+    @classmethod
+    def supports_set_based_grants(cls, db):
+        return db.get_bind().dialect.name in SET_BASED_DIALECTS
+
+    @classmethod
+    def grant_clauses(cls, now):
+        """SQL expressions of the grants due at `now`.
+
+        Returns the filter of the rows with due grants, and their new
+        balance and grant_last_update.
+        """
+        now = bindparam("now", now, type_=DateTime())
+        elapsed = elapsed_seconds(cls.grant_last_update, now)
+        grants = whole_intervals(elapsed, cls.grant_interval)
+        gained_balance = cls.balance + grants * cls.grant_value
+        if cls.grant_at_cap:
+            below_cap = cls.balance <= cls.cap
+        else:
+            below_cap = cls.balance < cls.cap
+        if cls.grant_inclusive:
+            due = elapsed >= cls.grant_interval
+        else:
+            due = elapsed > cls.grant_interval
+        return (
+            and_(cls.grant_interval > 0, below_cap, due),
+            case((gained_balance < cls.cap, gained_balance), else_=cls.cap),
+            add_seconds(cls.grant_last_update, grants * cls.grant_interval),
+        )
+
+    @classmethod
+    def effective_balance_clause(cls, now):
+        """SQL expression of effective_balance() at `now`"""
+        due, balance, _ = cls.grant_clauses(now)
+        return case(
+            (cls.balance > cls.cap, cls.cap),
+            (due, balance),
+            else_=cls.balance,
+        )
+
+    @classmethod
+    def grant_all(cls, db, now):
+        """Apply all due grants of this table with set-based UPDATE statements.
+
+        Balances above their cap are reduced to the cap, all others gain
+        `grant_value` for every full `grant_interval` since `grant_last_update`
+        (limited by the cap). `grant_last_update` is moved forward by the
+        granted intervals.
+
+        Objects already loaded in the session are expired, so they
+        will be reloaded with the new values on next access.
+
+        Returns the number of rows written.
+        """
+        due, balance, grant_last_update = cls.grant_clauses(now)
+
+        # balance has to be set first: MySQL evaluates SET clauses in order
+        # and the new balance depends on the old grant_last_update.
+        granted = db.execute(
+            update(cls)
+            .where(due)
+            .ordered_values(
+                (cls.balance, balance),
+                (cls.grant_last_update, grant_last_update),
+            )
+            .execution_options(synchronize_session=False)
+        ).rowcount
+        capped = db.execute(
+            update(cls)
+            .where(cls.balance > cls.cap)
+            .values(balance=cls.cap)
+            .execution_options(synchronize_session=False)
+        ).rowcount
+
+        for obj in list(db.identity_map.values()):
+            if isinstance(obj, cls):
+                db.expire(obj, ["balance", "grant_last_update"])
+        return granted + capped
+
+    @classmethod
+    def record_grants(cls, db, now):
+        """Add the grants grant_all() applies at `now` to the ledger.
+
+        Has to run right before grant_all(), with the same `now`. The
+        entries are copied with INSERT ... SELECT statements, so they don't
+        have to be loaded. Returns the number of rows written.
+        """
+        due, balance, _ = cls.grant_clauses(now)
+        now = bindparam("now", now, type_=DateTime())
+        names = cls.ledger_names()
+        columns = ["timestamp", "kind", *names.keys(), "amount", "balance"]
+        granted = select(
+            now,
+            literal("grant", Unicode),
+            *names.values(),
+            balance - cls.balance,
+            balance,
+        ).where(due, balance != cls.balance)
+        capped = select(
+            now,
+            literal("cap", Unicode),
+            *names.values(),
+            cls.cap - cls.balance,
+            cls.cap,
+        ).where(cls.balance > cls.cap)
+        rows = 0
+        for query in (granted, capped):
+            rows += db.execute(
+                insert(CreditsLedger).from_select(columns, query)
+            ).rowcount
+        return rows
+
+    @classmethod
+    def next_grant_time(cls, db):
+        """Earliest time at which grant_all() will grant credits in this table.
+
+        Returns None if there's nothing to grant.
+        """
+        if cls.grant_at_cap:
+            below_cap = cls.balance <= cls.cap
+        else:
+            below_cap = cls.balance < cls.cap
+        return (
+            db.query(func.min(add_seconds(cls.grant_last_update, cls.grant_interval)))
+            .filter(cls.grant_interval > 0, below_cap)
+            .scalar()
+        )
+
+    def effective_grant(self, now):
+        """Balance and grant_last_update with all grants due at `now` applied.
+
+        Same rules as grant_all(), computed in Python without writing
+        anything. Returns a (balance, grant_last_update) tuple.
+        """
+        balance = self.balance
+        grant_last_update = self.grant_last_update
+        if balance > self.cap:
+            return self.cap, grant_last_update
+        if not self.grant_interval or self.grant_interval <= 0:
+            return balance, grant_last_update
+        if balance == self.cap and not self.grant_at_cap:
+            return balance, grant_last_update
+        elapsed = (now - grant_last_update).total_seconds()
+        if elapsed < self.grant_interval or (
+            elapsed == self.grant_interval and not self.grant_inclusive
+        ):
+            return balance, grant_last_update
+        grants = int(elapsed // self.grant_interval)
+        balance = min(balance + grants * self.grant_value, self.cap)
+        grant_last_update += timedelta(seconds=grants * self.grant_interval)
+        return balance, grant_last_update
+
+    def effective_balance(self, now):
+        return self.effective_grant(now)[0]
 
-class CreditsProject(Base):
+    def materialize(self, now):
+        """Store the effective balance at `now`. Returns True if it changed"""
+        balance, grant_last_update = self.effective_grant(now)
+        if (balance, grant_last_update) == (self.balance, self.grant_last_update):
+            return False
+        self.balance = balance
+        self.grant_last_update = grant_last_update
+        return True
+
+
+class CreditsProject(CreditsGrantMixin, Base):
     """Table for storing per-project credits."""
 
     __tablename__ = "credits_project"
+    __table_args__ = (
+        # Listing sorted or filtered by balance
+        Index("ix_credits_project_balance", "balance", "name"),
+    )
+
+    # Projects at their cap don't move grant_last_update forward
+    grant_at_cap = False
+    grant_inclusive = False
 
     name = Column(Unicode, primary_key=True)
 
@@ -25,6 +321,10 @@ class CreditsProject(Base):
     # One project - many user values
     credits_user_values = relationship("CreditsUserValues", back_populates="project")
 
+    @classmethod
+    def ledger_names(cls):
+        return {"project_name": cls.name}
+
     @classmethod
     def get_project(cls, db, project_name):
         return db.query(cls).filter(cls.name == project_name).first()
@@ -36,23 +336,65 @@ class CreditsUser(Base):
     __tablename__ = "credits_user"
 
     name = Column(Unicode, primary_key=True)
+    # Fingerprint of the configuration stored for the user, see
+    # CreditsAuthenticator.credits_config_stored()
+    config_fingerprint = Column(Unicode, nullable=True)
 
-    spawner_bills = Column(MutableDict.as_mutable(JSON), default=dict)
-
-    # One user - many user values
+    # One user - many user values, in the order they were added. Without
+    # order_by the order would depend on the index the database uses.
     credits_user_values = relationship(
-        "CreditsUserValues", back_populates="credits_user"
+        "CreditsUserValues",
+        back_populates="credits_user",
+        order_by="CreditsUserValues.id",
+    )
+    # One user - many spawner bills, by spawner id
+    spawner_bills = relationship(
+        "CreditsSpawnerBill",
+        back_populates="credits_user",
+        collection_class=attribute_keyed_dict("spawner_id"),
+        cascade="all, delete-orphan",
     )
 
     @classmethod
-    def get_user(cls, db, user_name):
-        return db.query(cls).filter(cls.name == user_name).first()
+    def query_with_values(cls, db):
+        """Query users together with their credit values and projects.
 
+        The values of all users are loaded with one additional SELECT ... IN
+        query, their projects are joined into it. Iterating over the values
+        and projects afterwards doesn't emit further queries.
+        """
+        return db.query(cls).options(
+            selectinload(cls.credits_user_values).joinedload(CreditsUserValues.project)
+        )
 
-class CreditsUserValues(Base):
+    @classmethod
+    def get_user(cls, db, user_name, refresh=False):
+        query = cls.query_with_values(db).filter(cls.name == user_name)
+        if refresh:
+            # Overwrite already loaded objects with the current database state
+            query = query.populate_existing()
+        return query.first()
+
+    def add_spawner_bill(self, spawner_id):
+        bill = CreditsSpawnerBill(spawner_id=spawner_id)
+        self.spawner_bills[spawner_id] = bill
+        return bill
+
+
+class CreditsUserValues(CreditsGrantMixin, Base):
     """Table for storing per-user (+ per-project) credits."""
 
     __tablename__ = "credits_user_values"
+    __table_args__ = (
+        # One entry per configured name. Also serves lookups by user_name.
+        Index(
+            "uq_credits_user_values_user_name_name", "user_name", "name", unique=True
+        ),
+        # Members of a project
+        Index("ix_credits_user_values_project_name", "project_name"),
+        # Listing sorted or filtered by balance
+        Index("ix_credits_user_values_balance", "balance", "id"),
+    )
 
     id = Column(Integer, primary_key=True, autoincrement=True)
 
@@ -71,3 +413,188 @@ class CreditsUserValues(Base):
     # Relationships
     credits_user = relationship("CreditsUser", back_populates="credits_user_values")
     project = relationship("CreditsProject", back_populates="credits_user_values")
+
+    @classmethod
+    def ledger_names(cls):
+        return {"user_name": cls.user_name, "credits_name": cls.name}
+
+
+class CreditsSpawnerBill(Base):
+    """Table for storing the last bill of each running server."""
+
+    __tablename__ = "credits_spawner_bill"
+
+    # Id of the JupyterHub spawner
+    spawner_id = Column(Integer, primary_key=True, autoincrement=False)
+    user_name = Column(
+        Unicode, ForeignKey("credits_user.name"), primary_key=True, index=True
+    )
+
+    last_billed = Column(DateTime, nullable=False)
+    billing_value = Column(Integer)
+    billing_interval = Column(Integer)
+
+    credits_user = relationship("CreditsUser", back_populates="spawner_bills")
+
+
+class CreditsLedger(Base):
+    """Append-only table of all balance changes.
+
+    One entry for every grant, bill, cap and admin change of the balance
+    of a user value (`user_name`, `credits_name`) or a project
+    (`project_name`). `amount` is the change, `balance` the result.
+    """
+
+    __tablename__ = "credits_ledger"
+
+    id = Column(Integer, primary_key=True, autoincrement=True)
+    timestamp = Column(DateTime, nullable=False, index=True)
+    # grant, cap, bill or admin
+    kind = Column(Unicode, nullable=False)
+    user_name = Column(Unicode, index=True)
+    credits_name = Column(Unicode)
+    project_name = Column(Unicode, index=True)
+    spawner_id = Column(Integer)
+    spawner_name = Column(Unicode)
+    amount = Column(Integer, nullable=False)
+    balance = Column(Integer, nullable=False)
+
+
+def migrate_spawner_bills(engine):
+    """Copy bills of the former credits_user.spawner_bills JSON column.
+
+    Up to version 0.3 the last bill of each server was stored as
+    {spawner id: ISO timestamp} in a JSON column of credits_user. The
+    column is left in place but isn't used anymore.
+
+    Returns the number of copied bills.
+    """
+    columns = {c["name"] for c in inspect(engine).get_columns("credits_user")}
+    if "spawner_bills" not in columns:
+        return 0
+    credits_user = table("credits_user", column("name"), column("spawner_bills", JSON))
+    rows = []
+    with engine.begin() as connection:
+        for user_name, spawner_bills in connection.execute(
+            select(credits_user.c.name, credits_user.c.spawner_bills)
+        ):
+            for spawner_id, last_billed in (spawner_bills or {}).items():
+                rows.append(
+                    {
+                        "spawner_id": int(spawner_id),
+                        "user_name": user_name,
+                        "last_billed": datetime.fromisoformat(last_billed),
+                    }
+                )
+        if rows:
+            connection.execute(CreditsSpawnerBill.__table__.insert(), rows)
+    return len(rows)
+
+
+def create_missing_indexes(engine):
+    """Create the indexes of the credit tables that don't exist yet.
+
+    create_all() only creates indexes together with their tables, so
+    databases created by earlier versions are missing the ones added
+    later. Unique constraints are indexes as well (like
+    uq_credits_user_values_user_name_name), so they can be added to
+    existing SQLite tables. An index that can't be created, e.g. because
+    of duplicate rows, is skipped.
+
+    Returns the names of the created indexes and a dict with the errors
+    of the skipped ones.
+    """
+    inspector = inspect(engine)
+    tables = set(inspector.get_table_names())
+    created = []
+    errors = {}
+    for table_ in Base.metadata.sorted_tables:
+        if table_.name not in tables:
+            continue
+        existing = {index["name"] for index in inspector.get_indexes(table_.name)}
+        for index in sorted(table_.indexes, key=lambda index: index.name):
+            if index.name in existing:
+                continue
+            try:
+                index.create(engine)
+            except Exception as e:
+                errors[index.name] = str(e)
+            else:
+                created.append(index.name)
+    return created, errors
+
+
+def add_missing_columns(engine):
+    """Add the columns of the credit tables that don't exist yet.
+
+    Like create_missing_indexes(), for databases created by earlier
+    versions. Only for nullable columns without defaults on the database
+    side. Returns the names of the added columns, as table.column.
+    """
+    inspector = inspect(engine)
+    tables = set(inspector.get_table_names())
+    added = []
+    with engine.begin() as connection:
+        for table_ in Base.metadata.sorted_tables:
+            if table_.name not in tables:
+                continue
+            existing = {c["name"] for c in inspector.get_columns(table_.name)}
+            for column_ in table_.columns:
+                if column_.name in existing:
+                    continue
+                column_type = column_.type.compile(dialect=engine.dialect)
+                connection.exec_driver_sql(
+                    f"ALTER TABLE {table_.name} ADD COLUMN {column_.name} {column_type}"
+                )
+                added.append(f"{table_.name}.{column_.name}")
+    return added
+
+
+def upgrade_tables(engine):
+    """Create the credit tables, or upgrade those of earlier versions.
+
+    Creates the missing tables, copies the bills of the former JSON column
+    (see migrate_spawner_bills()) if credits_spawner_bill is new, and adds
+    missing columns and indexes. Returns a dict with the names of the
+    created tables, the number of migrated bills, the added columns, the
+    created indexes and the errors of the skipped ones.
+    """
+    tables = set(inspect(engine).get_table_names())
+    missing = sorted(
+        table_.name
+        for table_ in Base.metadata.sorted_tables
+        if table_.name not in tables
+    )
+    bills = 0
+    if missing:
+        Base.metadata.create_all(engine)
+        if "credits_spawner_bill" in missing and "credits_user" in tables:
+            bills = migrate_spawner_bills(engine)
+    added = add_missing_columns(engine)
+    created, errors = create_missing_indexes(engine)
+    return {
+        "tables": missing,
+        "bills": bills,
+        "columns": added,
+        "indexes": created,
+        "index_errors": errors,
+    }
+
+
+def outdated_tables(engine):
+    """Names of the credit tables that upgrade_tables() would change.
+
+    Missing tables and tables without all columns; doesn't change the
+    database.
+    """
+    inspector = inspect(engine)
+    tables = set(inspector.get_table_names())
+    outdated = []
+    for table_ in Base.metadata.sorted_tables:
+        if table_.name not in tables:
+            outdated.append(table_.name)
+            continue
+        existing = {c["name"] for c in inspector.get_columns(table_.name)}
+        if any(column_.name not in existing for column_ in table_.columns):
+            outdated.append(table_.name)
+    return outdated
@@ -0,0 +1,86 @@
+import asyncio
+import heapq
+import itertools
+
+# Key of the deadline for the grants of all projects and user values
+CREDITS_GRANTS = ("grants",)
+
+
+class DeadlineScheduler:
+    """Deadlines of the credit task, ordered in a heap.
+
+    Each key (e.g. one spawner to bill) has at most one deadline. Replaced
+    and cancelled deadlines stay in the heap until they reach its top and
+    are skipped there.
+
+    The credit task sleeps in wait() until the next deadline. Scheduling
+    a deadline earlier than all others wakes it up.
+    """
+
+    def __init__(self):
+        self._heap = []
+        self._deadlines = {}
+        self._counter = itertools.count()
+        self._wakeup = asyncio.Event()
+
+    def __len__(self):
+        return len(self._deadlines)
+
+    def __contains__(self, key):
+        return key in self._deadlines
+
+    def deadline(self, key):
+        return self._deadlines.get(key, None)
+
+    def schedule(self, key, when, keep_earlier=False):
+        """Set the deadline of key.
+
+        With keep_earlier an already scheduled earlier deadline is kept.
+        """
+        current = self._deadlines.get(key, None)
+        if keep_earlier and current is not None and current <= when:
+            return
+        next_deadline = self.next_deadline()
+        self._deadlines[key] = when
+        heapq.heappush(self._heap, (when, next(self._counter), key))
+        if len(self._heap) > 2 * len(self._deadlines) + 64:
+            self._compact()
+        if next_deadline is None or when < next_deadline:
+            self._wakeup.set()
+
+    def cancel(self, key):
+        self._deadlines.pop(key, None)
+
+    def next_deadline(self):
+        while self._heap:
+            when, _, key = self._heap[0]
+            if self._deadlines.get(key, None) == when:
+                return when
+            heapq.heappop(self._heap)
+        return None
+
+    def pop_due(self, now):
+        """Remove and return the keys of all deadlines up to now, in order"""
+        due = []
+        while self._heap and self._heap[0][0] <= now:
+            when, _, key = heapq.heappop(self._heap)
+            if self._deadlines.get(key, None) == when:
+                del self._deadlines[key]
+                due.append(key)
+        return due
+
+    async def wait(self, timeout):
+        """Sleep for timeout seconds or until an earlier deadline is scheduled"""
+        self._wakeup.clear()
+        try:
+            await asyncio.wait_for(self._wakeup.wait(), max(timeout, 0))
+        except asyncio.TimeoutError:
+            pass
+
+    def _compact(self):
+        self._heap = [
+            (when, count, key)
+            for when, count, key in self._heap
+            if self._deadlines.get(key, None) == when
+        ]
+        heapq.heapify(self._heap)
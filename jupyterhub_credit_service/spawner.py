@@ -3,11 +3,10 @@ import inspect
 import os
 
 from jupyterhub.spawner import Spawner
+from jupyterhub.utils import utcnow
 from tornado import web
 from traitlets import Any
 
-from .orm import CreditsUser
-
 
 class CreditsException(web.HTTPError):
     jupyterhub_html_message = None
@@ -145,50 +144,77 @@ class CreditsSpawner(Spawner):
             self._billing_value = await resolve_value(self.billing_value)
 
             if self._billing_value > 0:
-                credits_user = CreditsUser.get_user(
-                    self.user.authenticator.parent.db, self.user.name
-                )
-                if not credits_user or not credits_user.credits_user_values:
-                    raise CreditsException(
-                        "No credit values available. Please re-login and try again."
-                    )
-                credits_user_values = None
-                for cuv in credits_user.credits_user_values:
-                    match = self.user.authenticator.match_user_options(
-                        self.user_options, cuv.user_options or {}
-                    )
-                    self.log.debug(
-                        f"Test if spawner user_options {self.user_options} match configured user_options {cuv.user_options or {}} : {match}"
-                    )
-                    if match:
-                        credits_user_values = cuv
-                        break
-
-                if credits_user_values is None:
-                    raise CreditsException(
-                        "No matching credit values found for your selected options. Please adjust your options and try again."
-                    )
-                available_balance = credits_user_values.balance
-                proj_credits = credits_user_values.project
-                if proj_credits:
-                    available_balance += proj_credits.balance
-
-                if available_balance < self._billing_value:
-                    error_proj_msg = ""
-                    error_proj_msg_2 = ""
-                    if proj_credits:
-                        error_proj_msg = f"<br>Current project ({proj_credits.name}) credits: {proj_credits.balance} / {proj_credits.cap}."
-                        error_proj_msg_2 = f"<br>Your project ({proj_credits.name}) will receive {proj_credits.grant_value} credits every {proj_credits.grant_interval} seconds."
-                    raise CreditsException(
-                        f"Not enough credits to start server '{self._log_name}'.<br>Required credits: {self._billing_value}.<br>Current User credits: {credits_user_values.balance} / {credits_user_values.cap}.{error_proj_msg}<br>You will receive {credits_user_values.grant_value} credits every {credits_user_values.grant_interval} seconds.{error_proj_msg_2}"
-                    )
+                await self.user.authenticator.credits_run(self.credits_check_balance)
+
+            self.credits_register_billing()
 
         return result
 
+    def credits_check_balance(self):
+        """Raise a CreditsException, if the credits don't cover the first bill"""
+        credits_user = self.user.authenticator.credits_get_user(self.user.name)
+        if not credits_user or not credits_user.credits_user_values:
+            raise CreditsException(
+                "No credit values available. Please re-login and try again."
+            )
+        # Values without user_options match any user_options here
+        credits_user_values = self.user.authenticator.credits_user_values_for(
+            credits_user, self.user_options, defaults_last=False
+        )
+
+        if credits_user_values is None:
+            raise CreditsException(
+                "No matching credit values found for your selected options. Please adjust your options and try again."
+            )
+        lazy_grants = self.user.authenticator.credits_lazy_grants
+        now = utcnow(with_tz=False)
+        if lazy_grants:
+            user_balance = credits_user_values.effective_balance(now)
+        else:
+            user_balance = credits_user_values.balance
+        available_balance = user_balance
+        proj_credits = credits_user_values.project
+        if proj_credits:
+            if lazy_grants:
+                proj_balance = proj_credits.effective_balance(now)
+            else:
+                proj_balance = proj_credits.balance
+            available_balance += proj_balance
+
+        if available_balance < self._billing_value:
+            error_proj_msg = ""
+            error_proj_msg_2 = ""
+            if proj_credits:
+                error_proj_msg = f"<br>Current project ({proj_credits.name}) credits: {proj_balance} / {proj_credits.cap}."
+                error_proj_msg_2 = f"<br>Your project ({proj_credits.name}) will receive {proj_credits.grant_value} credits every {proj_credits.grant_interval} seconds."
+            raise CreditsException(
+                f"Not enough credits to start server '{self._log_name}'.<br>Required credits: {self._billing_value}.<br>Current User credits: {user_balance} / {credits_user_values.cap}.{error_proj_msg}<br>You will receive {credits_user_values.grant_value} credits every {credits_user_values.grant_interval} seconds.{error_proj_msg_2}"
+            )
+
+    @property
+    def credits_billable(self):
+        return getattr(self.user.authenticator, "credits_billable", None)
+
+    def credits_register_billing(self):
+        """Let the credit task bill this spawner, if it has to be billed"""
+        if self.credits_billable is None:
+            return
+        if not self.user.authenticator.credits_enabled:
+            return
+        if self._billing_interval and self._billing_value:
+            self.credits_billable.add(self)
+        else:
+            self.credits_billable.discard(self)
+
+    def credits_unregister_billing(self):
+        if self.credits_billable is not None:
+            self.credits_billable.discard(self)
+
     async def run_post_stop_hook(self):
         result = super().run_post_stop_hook()
         if inspect.isawaitable(result):
             result = await result
+        self.credits_unregister_billing()
         if self.user.authenticator.credits_task_event:
             self.user.authenticator.credits_task_event.set()
             await asyncio.sleep(0)
@@ -199,12 +225,19 @@ class CreditsSpawner(Spawner):
         _start = super().start()
         if inspect.isawaitable(_start):
             _start = await _start
+        self.credits_register_billing()
         return _start
 
     async def poll(self):
         _poll = super().poll()
         if inspect.isawaitable(_poll):
             _poll = await _poll
+        # Spawners restored after a Hub restart are registered by their
+        # first poll, their billing values are part of the spawner state
+        if _poll is None:
+            self.credits_register_billing()
+        else:
+            self.credits_unregister_billing()
         return _poll
 
     async def stop(self, now=False):
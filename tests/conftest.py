@@ -31,6 +31,7 @@ import copy
 import os
 import sys
 from subprocess import TimeoutExpired
+from types import SimpleNamespace
 from unittest import mock
 from warnings import warn
 
@@ -48,7 +49,7 @@ from jupyterhub.tests import mocking
 from jupyterhub.tests.mocking import MockHub, MockPAMAuthenticator, MockSpawner
 from jupyterhub.tests.test_services import mockservice_cmd
 from jupyterhub.tests.utils import add_user
-from jupyterhub.utils import random_port
+from jupyterhub.utils import random_port, utcnow
 from packaging.version import parse as parse_version
 from pytest import fixture, mark, raises
 from sqlalchemy import event
@@ -310,6 +311,37 @@ def admin_user(app, username):
     yield user
 
 
+_fake_spawner_counter = 10**6
+
+
+@fixture
+def fake_spawner():
+    """Factory for spawner stand-ins the credit task can bill.
+
+    They have what BillableSpawners.snapshot() reads. Their ids are above
+    those of real spawners in the test database.
+    """
+
+    def make(user, name, billing_value, user_options=None, billing_interval=600):
+        global _fake_spawner_counter
+        _fake_spawner_counter += 1
+        return SimpleNamespace(
+            user=SimpleNamespace(name=user.name, id=user.id),
+            name=name,
+            _log_name=f"{user.name}:{name}",
+            orm_spawner=SimpleNamespace(
+                id=_fake_spawner_counter, started=utcnow(with_tz=False)
+            ),
+            active=True,
+            ready=True,
+            _billing_interval=billing_interval,
+            _billing_value=billing_value,
+            user_options=user_options or {},
+        )
+
+    return make
+
+
 _groupname_counter = 0
 _rolename_counter = 0
 
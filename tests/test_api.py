@@ -1,14 +1,20 @@
 import copy
 import json
+from datetime import timedelta
+from unittest import mock
 
 from jupyterhub.tests.utils import (
+    add_user,
     api_request,
     async_requests,
     public_url,
 )
+from jupyterhub.utils import utcnow
 
-from jupyterhub_credit_service.orm import CreditsUser
+from jupyterhub_credit_service.orm import CreditsProject, CreditsUser, CreditsUserValues
+from jupyterhub_credit_service.scheduler import CREDITS_GRANTS
 
+from .conftest import new_username
 from .test_auth import user_credits_simple, user_credits_simple_project
 from .test_spawner import get_proj_name
 
@@ -197,3 +203,265 @@ async def test_credits_admin_proj_403(app, user):
         headers={"Authorization": "token " + token},
     )
     assert r.status_code == 403
+
+
+async def test_credits_admin_batch(app, user):
+    proj_name = get_proj_name()
+    local_user_credits_simple_project = copy.deepcopy(user_credits_simple_project)
+    local_user_credits_simple_project["project"]["name"] = proj_name
+
+    def user_credits_f(_, username, *args):
+        if username == user.name:
+            return local_user_credits_simple_project
+        return user_credits_simple
+
+    app.authenticator.credits_user = user_credits_f
+    await app.login_user(user.name)
+    db = app.authenticator.parent.db
+    credits_user = CreditsUser.get_user(db, user.name)
+    user_credits = credits_user.credits_user_values[0]
+    balance = user_credits.balance
+    project_balance = user_credits.project.balance
+
+    changes = [
+        {
+            "user_name": user.name,
+            "credit_name": user_credits.name,
+            "balance": balance - 30,
+            "project": {"balance": project_balance - 10},
+        },
+        {"project_name": proj_name, "grant_value": 7},
+    ]
+    r = await api_request(app, "credits/batch", data=json.dumps(changes), method="post")
+    assert r.status_code == 200
+    assert r.json() == {"applied": True, "results": [{"status": 200}] * 2}
+    db.refresh(user_credits)
+    db.refresh(user_credits.project)
+    assert user_credits.balance == balance - 30
+    assert user_credits.project.balance == project_balance - 10
+    assert user_credits.project.grant_value == 7
+
+    # Top-ups without "project" leave the shared project alone
+    changes = [
+        {
+            "user_name": user.name,
+            "credit_name": user_credits.name,
+            "balance": balance - 20,
+        },
+    ]
+    r = await api_request(app, "credits/batch", data=json.dumps(changes), method="post")
+    assert r.status_code == 200
+    db.refresh(user_credits)
+    assert user_credits.balance == balance - 20
+    assert user_credits.project_name == proj_name
+    project = db.query(CreditsProject).filter_by(name=proj_name).one()
+    assert project.balance == project_balance - 10
+    assert project.grant_value == 7
+
+    # One invalid change, nothing is applied
+    changes = [
+        {
+            "user_name": user.name,
+            "credit_name": user_credits.name,
+            "balance": balance - 50,
+            "project": {"balance": project_balance - 20},
+        },
+        {"project_name": "unknown", "balance": 1},
+        {"project_name": proj_name, "balance": "1"},
+        {"balance": 1},
+    ]
+    r = await api_request(app, "credits/batch", data=json.dumps(changes), method="post")
+    assert r.status_code == 400
+    resp = r.json()
+    assert resp["applied"] is False
+    assert [result["status"] for result in resp["results"]] == [424, 404, 400, 400]
+    db.refresh(user_credits)
+    assert user_credits.balance == balance - 20
+
+    app.authenticator.credits_api_batch_limit = 1
+    try:
+        r = await api_request(
+            app, "credits/batch", data=json.dumps(changes), method="post"
+        )
+        assert r.status_code == 413
+    finally:
+        app.authenticator.credits_api_batch_limit = 1000
+
+    token = user.new_api_token()
+    r = await api_request(
+        app,
+        "credits/batch",
+        data=json.dumps(changes[:1]),
+        method="post",
+        headers={"Authorization": "token " + token},
+    )
+    assert r.status_code == 403
+
+
+async def test_credits_admin_list(app, user):
+    proj_name = get_proj_name()
+    local_user_credits_simple_project = copy.deepcopy(user_credits_simple_project)
+    local_user_credits_simple_project["project"]["name"] = proj_name
+    app.authenticator.credits_user = local_user_credits_simple_project
+    user_names = sorted(
+        add_user(app.db, app, name=new_username()).name for _ in range(5)
+    )
+    db = app.authenticator.parent.db
+    for i, user_name in enumerate(user_names):
+        await app.login_user(user_name)
+        db.query(CreditsUserValues).filter(
+            CreditsUserValues.user_name == user_name
+        ).update({"balance": 100 + 10 * (i % 3)})
+    db.commit()
+
+    async def list_values(**args):
+        r = await api_request(app, "credits/values", params=args)
+        assert r.status_code == 200
+        return r.json()
+
+    # keyset pages in the order of the user names
+    listed = []
+    resp = await list_values(project=proj_name, limit=2)
+    while True:
+        assert len(resp["items"]) <= 2
+        listed += resp["items"]
+        if resp["next"] is None:
+            break
+        resp = await list_values(project=proj_name, limit=2, after=resp["next"])
+    assert [item["user_name"] for item in listed] == user_names
+    assert {item["project"] for item in listed} == {proj_name}
+
+    resp = await list_values(project=proj_name, sort="-balance", min_balance=110)
+    assert [item["balance"] for item in resp["items"]] == [120, 110, 110]
+    assert resp["next"] is None
+    resp = await list_values(project=proj_name, sort="balance", limit=3)
+    assert [item["balance"] for item in resp["items"]] == [100, 100, 110]
+    resp = await list_values(
+        project=proj_name, sort="balance", limit=3, after=resp["next"]
+    )
+    assert [item["balance"] for item in resp["items"]] == [110, 120]
+
+    # With lazy grants, filters and keysets use the balances the items show
+    db.query(CreditsUserValues).filter(
+        CreditsUserValues.user_name == user_names[0]
+    ).update({"grant_last_update": utcnow(with_tz=False) - timedelta(seconds=650)})
+    db.commit()
+    app.authenticator.credits_lazy_grants = True
+    try:
+        resp = await list_values(project=proj_name, min_balance=150)
+        assert [(item["user_name"], item["balance"]) for item in resp["items"]] == [
+            (user_names[0], 200)
+        ]
+        resp = await list_values(project=proj_name, max_balance=150)
+        assert user_names[0] not in [item["user_name"] for item in resp["items"]]
+        listed = []
+        resp = await list_values(project=proj_name, sort="-balance", limit=2)
+        while True:
+            listed += resp["items"]
+            if resp["next"] is None:
+                break
+            resp = await list_values(
+                project=proj_name, sort="-balance", limit=2, after=resp["next"]
+            )
+        assert [item["balance"] for item in listed] == [200, 120, 110, 110, 100]
+    finally:
+        app.authenticator.credits_lazy_grants = False
+
+    r = await api_request(app, "credits/projects", params={"limit": 10000})
+    assert r.status_code == 200
+    projects = {item["name"]: item for item in r.json()["items"]}
+    assert projects[proj_name]["cap"] == 1000
+
+    for args in [
+        {"sort": "cap"},
+        {"limit": 0},
+        {"min_balance": "a"},
+        {"after": "invalid"},
+    ]:
+        r = await api_request(app, "credits/values", params=args)
+        assert r.status_code == 400
+
+    token = user.new_api_token()
+    r = await api_request(
+        app, "credits/values", headers={"Authorization": "token " + token}
+    )
+    assert r.status_code == 403
+
+
+async def test_credits_etag(app, user):
+    proj_name = get_proj_name()
+    local_user_credits_simple_project = copy.deepcopy(user_credits_simple_project)
+    local_user_credits_simple_project["project"]["name"] = proj_name
+    app.authenticator.credits_user = local_user_credits_simple_project
+    await app.login_user(user.name)
+    token = user.new_api_token()
+
+    async def get_credits(etag=None):
+        headers = {"Authorization": "token " + token}
+        if etag:
+            headers["If-None-Match"] = etag
+        return await api_request(app, "credits", headers=headers)
+
+    r = await get_credits()
+    assert r.status_code == 200
+    etag = r.headers["ETag"]
+    balance = r.json()[0]["balance"]
+
+    with mock.patch(
+        "jupyterhub_credit_service.apihandlers.get_user_model"
+    ) as get_user_model:
+        r = await get_credits(etag)
+        assert r.status_code == 304
+        assert r.headers["ETag"] == etag
+        get_user_model.assert_not_called()
+
+    # Admin changes of the user's credits or projects change the ETag
+    r = await api_request(
+        app,
+        f"credits/user/{user.name}/{local_user_credits_simple_project['name']}",
+        data=json.dumps({"balance": balance - 10, "project": {"cap": 1000}}),
+        method="post",
+    )
+    assert r.status_code == 200
+    r = await get_credits(etag)
+    assert r.status_code == 200
+    assert r.json()[0]["balance"] == balance - 10
+    etag = r.headers["ETag"]
+    assert (await get_credits(etag)).status_code == 304
+
+    r = await api_request(
+        app,
+        f"credits/project/{proj_name}",
+        data=json.dumps({"balance": 500}),
+        method="post",
+    )
+    assert r.status_code == 200
+    r = await get_credits(etag)
+    assert r.status_code == 200
+    assert r.json()[0]["project"]["balance"] == 500
+
+    # Grants change all ETags
+    etag = r.headers["ETag"]
+    app.authenticator.credits_versions.touch_all()
+    assert (await get_credits(etag)).status_code == 200
+
+
+async def test_credits_metrics(app, user):
+    app.authenticator.credits_user = user_credits_simple
+    await app.login_user(user.name)
+    now = utcnow(with_tz=False)
+    app.authenticator.credits_scheduler.schedule(CREDITS_GRANTS, now)
+    await app.authenticator.credits_reconcile(now)
+
+    url = public_url(app, path="hub/metrics")
+    with mock.patch.dict(app.tornado_settings, {"authenticate_prometheus": False}):
+        r = await async_requests.get(url)
+    assert r.status_code == 200
+    for name in (
+        'jupyterhub_credits_task_phase_duration_seconds_count{phase="user_grant"}',
+        'jupyterhub_credits_task_rows_count{operation="read"}',
+        "jupyterhub_credits_spawners_billed_total",
+        "jupyterhub_credits_servers_stopped_total",
+        'jupyterhub_credits_sse_connections{handler="server"}',
+    ):
+        assert name in r.text
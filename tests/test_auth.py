@@ -2,10 +2,57 @@
 
 import asyncio
 import copy
+import json
+import threading
+import time
+from contextlib import contextmanager
+from datetime import datetime, timedelta
+from unittest import mock
 
 import pytest
+from jupyterhub.utils import utcnow
+from prometheus_client import REGISTRY
+from sqlalchemy import create_engine, event
+from sqlalchemy.orm import sessionmaker
+
+from jupyterhub_credit_service import CreditsAuthenticator
+from jupyterhub_credit_service.apihandlers import get_model, get_user_model
+from jupyterhub_credit_service.balances import CreditsBalanceCache
+from jupyterhub_credit_service.cache import TTLCache, VersionStamps
+from jupyterhub_credit_service.matching import UserOptionsIndex
+from jupyterhub_credit_service.metrics import CreditsPhaseTimer, CreditsTaskPhase
+from jupyterhub_credit_service.orm import (
+    Base,
+    CreditsLedger,
+    CreditsProject,
+    CreditsUser,
+    CreditsUserValues,
+    add_missing_columns,
+    create_missing_indexes,
+    migrate_spawner_bills,
+)
+from jupyterhub_credit_service.scheduler import CREDITS_GRANTS, DeadlineScheduler
+
+from .conftest import new_username
+
+
+@contextmanager
+def count_queries(db):
+    """Collect all SQL statements executed on the database of a session"""
+    statements = []
+
+    def before_cursor_execute(conn, cursor, statement, *args):
+        # ignore the connection ping of JupyterHub
+        if statement != "SELECT 1":
+            statements.append(statement)
+
+    engine = db.get_bind()
+    event.listen(engine, "before_cursor_execute", before_cursor_execute)
+    try:
+        yield statements
+    finally:
+        event.remove(engine, "before_cursor_execute", before_cursor_execute)
 
-from jupyterhub_credit_service.orm import CreditsUser
 
 user_credits_simple = {
     "name": "default",
@@ -565,3 +612,1185 @@ async def test_credits_task_post_hook_called(app):
     await event.wait()
 
     assert hook_called, "Post-task hook was not executed"
+
+
+def test_credits_post_hook_once_per_interval(app):
+    authenticator = app.authenticator
+    interval = authenticator.credits_task_interval
+    with mock.patch.object(authenticator, "_credits_task_notified", None):
+        assert authenticator.credits_post_hook_due(1000)
+        # Task runs at bill deadlines in between don't run the hook
+        assert not authenticator.credits_post_hook_due(1000 + interval / 2)
+        assert authenticator.credits_post_hook_due(1000 + interval)
+
+
+@pytest.mark.asyncio
+async def test_credits_grant_set_based(app, user):
+    credits_config = copy.deepcopy(user_credits_simple_project)
+    credits_config["project"]["name"] = f"{user.name}-project"
+    app.authenticator.credits_user = credits_config
+    await app.login_user(user.name)
+    db = app.authenticator.parent.db
+    user_credits = CreditsUser.get_user(db, user.name).credits_user_values[0]
+    project = user_credits.project
+
+    now = utcnow(with_tz=False)
+    user_last_update = now - timedelta(seconds=650)
+    project_last_update = now - timedelta(seconds=1300)
+    user_credits.balance = 0
+    user_credits.grant_last_update = user_last_update
+    project.balance = project.cap + 10
+    db.commit()
+
+    app.authenticator.credits_grant(now)
+    assert project.balance == project.cap
+
+    project.balance = 0
+    project.grant_last_update = project_last_update
+    db.commit()
+    app.authenticator.credits_grant(now)
+
+    # 2 user grants of 50 credits every 300 seconds
+    assert user_credits.balance == 2 * credits_config["grant_value"]
+    assert user_credits.grant_last_update == user_last_update + timedelta(seconds=600)
+    # 2 project grants of 60 credits every 600 seconds
+    assert project.balance == 2 * credits_config["project"]["grant_value"]
+    assert project.grant_last_update == project_last_update + timedelta(seconds=1200)
+
+
+@pytest.mark.asyncio
+async def test_credits_batch_commit(app, users):
+    app.authenticator.credits_user = user_credits_simple
+    db = app.authenticator.parent.db
+    for user in users:
+        await app.login_user(user.name)
+    now = utcnow(with_tz=False)
+    for user in users:
+        user_credits = CreditsUser.get_user(db, user.name).credits_user_values[0]
+        user_credits.balance = 0
+        user_credits.grant_last_update = now - timedelta(
+            seconds=user_credits.grant_interval
+        )
+    db.commit()
+
+    app.authenticator.credits_batch_commit = True
+    app.authenticator.credits_batch_commit_size = 1
+    try:
+        credit_users = [CreditsUser.get_user(db, user.name) for user in users]
+        app.authenticator.credits_scheduler.schedule(CREDITS_GRANTS, now)
+        await app.authenticator.credits_reconcile(now, credit_users)
+    finally:
+        app.authenticator.credits_batch_commit = False
+        app.authenticator.credits_batch_commit_size = 0
+
+    # one commit per user, plus the final one
+    assert len(app.authenticator.credits_flush_rows) == len(users) + 1
+    # The grants are committed with the first batch
+    assert app.authenticator.credits_flush_rows[0] >= len(users)
+    for user in users:
+        user_credits = CreditsUser.get_user(db, user.name).credits_user_values[0]
+        assert user_credits.balance == user_credits_simple["grant_value"]
+
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize("mode", ["batch", "direct", "cache"])
+async def test_credits_bill_failure_isolated(app, users, fake_spawner, mode):
+    authenticator = app.authenticator
+    authenticator.credits_user = user_credits_simple
+    db = authenticator.parent.db
+    failing, billed = users[:2]
+    spawners = []
+    for user in (failing, billed):
+        await app.login_user(user.name)
+        spawners.append(fake_spawner(user, "isolated", 7))
+
+    def stored(user):
+        db.expire_all()
+        return CreditsUser.get_user(db, user.name)
+
+    balances = {
+        user.name: stored(user).credits_user_values[0].balance for user in users[:2]
+    }
+    bill_user = authenticator.credits_bill_user
+
+    def credits_bill_user(credit_user, *args):
+        # Fails after the balance and the bill were changed
+        bill_user(credit_user, *args)
+        if credit_user.name == failing.name:
+            raise RuntimeError("bill failed")
+
+    if mode == "cache":
+        authenticator.credits_balances = CreditsBalanceCache()
+        authenticator.credits_balances.load(db)
+    authenticator.credits_batch_commit = mode == "batch"
+    try:
+        for spawner in spawners:
+            authenticator.credits_billable.add(spawner)
+        with mock.patch.object(authenticator, "credits_bill_user", credits_bill_user):
+            await authenticator.credits_reconcile(utcnow(with_tz=False))
+        if mode == "batch":
+            # Both users are in one batch
+            assert len(authenticator.credits_flush_rows) == 1
+        if mode == "cache":
+            cached = authenticator.credits_get_user(failing.name)
+            assert cached.credits_user_values[0].balance == balances[failing.name]
+            assert cached.spawner_bills == {}
+            authenticator.credits_balances_flush()
+    finally:
+        authenticator.credits_balances = None
+        authenticator.credits_batch_commit = False
+        for spawner in spawners:
+            authenticator.credits_billable.discard(spawner)
+
+    if mode == "direct":
+        # Each bill is committed right away, before the failure
+        assert stored(failing).credits_user_values[0].balance == (
+            balances[failing.name] - 7
+        )
+    else:
+        assert stored(failing).credits_user_values[0].balance == balances[failing.name]
+        assert stored(failing).spawner_bills == {}
+    assert stored(billed).credits_user_values[0].balance == balances[billed.name] - 7
+    assert list(stored(billed).spawner_bills) == [spawners[1].orm_spawner.id]
+
+
+@pytest.mark.asyncio
+async def test_credits_lazy_grants(app, user):
+    credits_config = copy.deepcopy(user_credits_simple_project)
+    credits_config["project"]["name"] = f"{user.name}-project"
+    app.authenticator.credits_user = credits_config
+    await app.login_user(user.name)
+    db = app.authenticator.parent.db
+    app.authenticator.credits_lazy_grants = True
+    try:
+        user_credits = CreditsUser.get_user(db, user.name).credits_user_values[0]
+        project = user_credits.project
+        now = utcnow(with_tz=False)
+        user_last_update = now - timedelta(seconds=650)
+        project_last_update = now - timedelta(seconds=1300)
+        user_credits.balance = 0
+        user_credits.grant_last_update = user_last_update
+        project.balance = 0
+        project.grant_last_update = project_last_update
+        db.commit()
+
+        # Grant-only runs don't write anything
+        with count_queries(db) as statements:
+            await app.authenticator.credits_reconcile(now)
+        assert not [x for x in statements if x.startswith("UPDATE")], statements
+        assert user_credits.balance == 0
+        assert project.balance == 0
+
+        # The effective balance is computed on read
+        model = get_model(CreditsUser.get_user(db, user.name), now)
+        assert model[0]["balance"] == 2 * credits_config["grant_value"]
+        assert model[0]["grant_last_update"] == (
+            (user_last_update + timedelta(seconds=600)).isoformat()
+        )
+        assert model[0]["project"]["balance"] == (
+            2 * credits_config["project"]["grant_value"]
+        )
+
+        # A changed configuration stores the credits granted so far
+        credits_config["grant_value"] += 10
+        credits_config["project"]["grant_value"] += 10
+        await app.login_user(user.name)
+        user_credits = CreditsUser.get_user(
+            db, user.name, refresh=True
+        ).credits_user_values[0]
+        assert user_credits.balance == 2 * (credits_config["grant_value"] - 10)
+        assert user_credits.grant_last_update == user_last_update + timedelta(
+            seconds=600
+        )
+        assert user_credits.project.balance == 2 * (
+            credits_config["project"]["grant_value"] - 10
+        )
+        assert not user_credits.materialize(now)
+    finally:
+        app.authenticator.credits_lazy_grants = False
+
+
+@pytest.mark.asyncio
+async def test_deadline_scheduler():
+    scheduler = DeadlineScheduler()
+    now = utcnow(with_tz=False)
+    scheduler.schedule("a", now + timedelta(seconds=20))
+    scheduler.schedule("b", now + timedelta(seconds=10))
+    scheduler.schedule("c", now + timedelta(seconds=30))
+    scheduler.schedule("a", now + timedelta(seconds=5))
+    scheduler.schedule("b", now + timedelta(seconds=15), keep_earlier=True)
+    scheduler.cancel("c")
+    assert len(scheduler) == 2
+    assert scheduler.next_deadline() == now + timedelta(seconds=5)
+    assert scheduler.pop_due(now) == []
+    assert scheduler.pop_due(now + timedelta(seconds=60)) == ["a", "b"]
+    assert scheduler.next_deadline() is None
+
+    # An earlier deadline wakes up the waiting task
+    waiter = asyncio.create_task(scheduler.wait(60))
+    await asyncio.sleep(0)
+    scheduler.schedule("d", now)
+    await asyncio.wait_for(waiter, 1)
+
+
+@pytest.mark.asyncio
+async def test_credits_grants_scheduled(app, user):
+    credits_config = copy.deepcopy(user_credits_simple_project)
+    credits_config["project"]["name"] = f"{user.name}-project"
+    app.authenticator.credits_user = credits_config
+    await app.login_user(user.name)
+    db = app.authenticator.parent.db
+    user_credits = CreditsUser.get_user(db, user.name).credits_user_values[0]
+    project = user_credits.project
+
+    now = utcnow(with_tz=False)
+    for credits in CreditsUser.query_with_values(db).all():
+        for cuv in credits.credits_user_values:
+            cuv.grant_last_update = now
+            if cuv.project:
+                cuv.project.balance = cuv.project.cap
+    user_credits.balance = 0
+    user_credits.grant_last_update = now - timedelta(seconds=200)
+    project.balance = 0
+    project.grant_last_update = now - timedelta(seconds=100)
+    db.commit()
+
+    # The next grant is the one of the user credits in 100 seconds
+    await app.authenticator.credits_schedule_grants(now)
+    deadline = app.authenticator.credits_scheduler.deadline(CREDITS_GRANTS)
+    assert deadline == now + timedelta(seconds=100)
+
+    # Nothing is due before it
+    with count_queries(db) as statements:
+        await app.authenticator.credits_reconcile(now + timedelta(seconds=99))
+    assert not [x for x in statements if x.startswith("UPDATE")], statements
+
+    await app.authenticator.credits_reconcile(deadline)
+    assert user_credits.balance == credits_config["grant_value"]
+    assert project.balance == 0
+    assert app.authenticator.credits_scheduler.deadline(CREDITS_GRANTS) > deadline
+
+
+@pytest.mark.asyncio
+async def test_credits_db_threads(app, user):
+    app.authenticator.credits_user = user_credits_simple
+    app.authenticator.credits_db_threads = 1
+    db = app.authenticator.parent.db
+    try:
+        # The credits of the user are stored by the credit database thread
+        await app.login_user(user.name)
+        threads = []
+
+        def get_cap():
+            threads.append(threading.current_thread().name)
+            credits_user = CreditsUser.get_user(app.authenticator.credits_db, user.name)
+            return credits_user.credits_user_values[0].cap
+
+        assert (
+            await app.authenticator.credits_run(get_cap) == user_credits_simple["cap"]
+        )
+        assert threads[0].startswith("credits-db")
+
+        now = utcnow(with_tz=False)
+        user_credits = CreditsUser.get_user(db, user.name).credits_user_values[0]
+        user_credits.balance = 0
+        user_credits.grant_last_update = now - timedelta(
+            seconds=user_credits.grant_interval
+        )
+        db.commit()
+        app.authenticator.credits_scheduler.schedule(CREDITS_GRANTS, now)
+        await app.authenticator.credits_reconcile(now)
+        user_credits = CreditsUser.get_user(
+            db, user.name, refresh=True
+        ).credits_user_values[0]
+        assert user_credits.balance == user_credits_simple["grant_value"]
+    finally:
+        app.authenticator.credits_db_threads = 0
+
+
+@pytest.mark.asyncio
+async def test_credits_db_url(tmp_path):
+    authenticator = CreditsAuthenticator(
+        credits_enabled=False,
+        credits_db_url=f"sqlite:///{tmp_path / 'credits.sqlite'}",
+        credits_db_kwargs={"pool_size": 3},
+        credits_db_sqlite_wal=True,
+    )
+    assert authenticator.credits_own_sessions
+    engine = authenticator.credits_engine
+    assert engine is authenticator.credits_engine
+    assert engine.pool.size() == 3
+    with engine.connect() as connection:
+        assert connection.exec_driver_sql("PRAGMA journal_mode").scalar() == "wal"
+    Base.metadata.create_all(engine)
+    # Functions that don't use credits_db don't create a session
+    assert await authenticator.credits_run(len, "abc") == 3
+
+    def add_user():
+        authenticator.credits_db.add(CreditsUser(name="credits-db-url"))
+        authenticator.credits_db.commit()
+        return authenticator.credits_db
+
+    # Runs on the event loop, with a session that's removed afterwards
+    session = await authenticator.credits_run(add_user)
+    assert session is not authenticator.credits_db
+    assert await authenticator.credits_run(authenticator.credits_user_names) == [
+        "credits-db-url"
+    ]
+    engine.dispose()
+
+
+@pytest.mark.asyncio
+async def test_credits_eager_loading_query_count(app, users):
+    db = app.authenticator.parent.db
+    app.authenticator.credits_user = user_credits_multiple_w_default
+    for user in users:
+        await app.login_user(user.name)
+
+    with count_queries(db) as statements:
+        credits_user = CreditsUser.get_user(db, users[0].name, refresh=True)
+        model = get_model(credits_user)
+    assert model[0]["project"]["name"] == "systemA"
+    assert len(statements) == 2, statements
+
+    with count_queries(db) as statements:
+        for credits_user in CreditsUser.query_with_values(db).populate_existing().all():
+            get_model(credits_user)
+    assert len(statements) == 2, statements
+
+    # The number of queries of a credit task run doesn't grow with the users
+    now = utcnow(with_tz=False)
+    app.authenticator.credits_scheduler.schedule(CREDITS_GRANTS, now)
+    with count_queries(db) as statements:
+        await app.authenticator.credits_reconcile(now)
+    queries_before = len(statements)
+    await app.login_user(new_username())
+    now = utcnow(with_tz=False)
+    app.authenticator.credits_scheduler.schedule(CREDITS_GRANTS, now)
+    with count_queries(db) as statements:
+        await app.authenticator.credits_reconcile(now)
+    assert len(statements) == queries_before, statements
+
+
+def test_credits_config_fingerprint(app):
+    fingerprint = app.authenticator.credits_config_fingerprint
+    config = {
+        "a": {
+            "name": "a",
+            "cap": 100,
+            "grant_value": 5,
+            "grant_interval": 60,
+            "user_options": {"image": "gpu", "size": ["s", "m"]},
+            "project": {"name": "p", "cap": 1000},
+        },
+        "b": {"name": "b", "cap": 10},
+    }
+    reordered = {
+        "b": {"cap": 10, "name": "b"},
+        "a": {
+            "project": {"cap": 1000, "name": "p"},
+            "user_options": {"size": ["s", "m"], "image": "gpu"},
+            "grant_interval": 60,
+            "grant_value": 5,
+            "cap": 100,
+            "name": "a",
+        },
+    }
+    assert fingerprint(reordered) == fingerprint(config)
+
+    changed = copy.deepcopy(config)
+    changed["a"]["user_options"]["image"] = "cpu"
+    assert fingerprint(changed) != fingerprint(config)
+    changed = copy.deepcopy(config)
+    changed["a"]["project"]["cap"] = 1000.0
+    assert fingerprint(changed) != fingerprint(config)
+
+
+@pytest.mark.asyncio
+async def test_update_user_credit_fingerprint(app, user):
+    authenticator = app.authenticator
+    db = authenticator.parent.db
+    authenticator.credits_user = copy.deepcopy(user_credits_multiple_w_default)
+    auth_model = {"name": user.name, "groups": [], "admin": False}
+    await authenticator.update_user_credit(auth_model)
+
+    # The same configuration again only reads the fingerprint
+    with count_queries(db) as statements:
+        await authenticator.update_user_credit(auth_model)
+    assert len(statements) == 1, statements
+    assert statements[0].startswith("SELECT credits_user.config_fingerprint")
+
+    # A changed configuration writes only what changed
+    authenticator.credits_user[1]["cap"] += 1
+    with count_queries(db) as statements:
+        await authenticator.update_user_credit(auth_model)
+    writes = [s for s in statements if not s.startswith("SELECT")]
+    assert [s.split()[0] for s in writes] == ["UPDATE", "UPDATE"], writes
+    credits_user = CreditsUser.get_user(db, user.name, refresh=True)
+    assert (
+        credits_user.credits_user_values[1].cap == authenticator.credits_user[1]["cap"]
+    )
+
+    # Without a fingerprint, e.g. after changes by admins, it is applied again
+    credits_user.credits_user_values[1].cap = 1
+    credits_user.config_fingerprint = None
+    db.commit()
+    await authenticator.update_user_credit(auth_model)
+    credits_user = CreditsUser.get_user(db, user.name, refresh=True)
+    assert (
+        credits_user.credits_user_values[1].cap == authenticator.credits_user[1]["cap"]
+    )
+
+
+@pytest.mark.asyncio
+async def test_credits_refresh_users(app):
+    authenticator = app.authenticator
+    authenticator.credits_user = user_credits_simple
+    names = [new_username() for _ in range(5)]
+    for name in names:
+        await app.login_user(name)
+        authenticator.credits_append_user(app.users[name])
+    slow_name = names[0]
+
+    running = set()
+    max_running = []
+
+    async def refresh_user(user, handler=None):
+        running.add(user.name)
+        max_running.append(len(running))
+        try:
+            if user.name == slow_name:
+                # Identity provider never answers for this user
+                await asyncio.sleep(60)
+            await asyncio.sleep(0.05)
+            return True
+        finally:
+            running.discard(user.name)
+
+    authenticator.refresh_user = refresh_user
+    authenticator.credits_refresh_concurrency = 2
+    authenticator.credits_refresh_timeout = 1
+    try:
+        for name in names:
+            app.users[name]._auth_refreshed = None
+        await asyncio.wait_for(authenticator.credits_refresh_users(), 5)
+        assert max(max_running) == 2
+        assert not app.users[slow_name]._auth_refreshed
+        for name in names[1:]:
+            assert app.users[name]._auth_refreshed
+
+        # Only the user that timed out is due again within auth_refresh_age
+        max_running.clear()
+        authenticator.credits_refresh_timeout = 0
+        slow_name = None
+        await authenticator.credits_refresh_users()
+        assert max_running == [1]
+        assert app.users[names[0]]._auth_refreshed
+
+        # New auth_state is stored, expired auth requires a new login
+        results = {
+            names[1]: {"name": names[1], "auth_state": {"token": "new"}},
+            names[2]: False,
+        }
+
+        async def refresh_user(user, handler=None):
+            return results[user.name]
+
+        authenticator.refresh_user = refresh_user
+        for name in results:
+            app.users[name]._auth_refreshed = None
+        user = app.users[names[1]]
+        with mock.patch.object(user, "save_auth_state") as save_auth_state:
+            await authenticator.credits_refresh_users()
+        save_auth_state.assert_called_once_with({"token": "new"})
+        assert app.users[names[1]]._auth_refreshed
+        assert not app.users[names[2]]._auth_refreshed
+    finally:
+        del authenticator.refresh_user
+        authenticator.credits_refresh_concurrency = 10
+        authenticator.credits_refresh_timeout = 30
+
+
+@pytest.mark.asyncio
+async def test_credits_task_metrics(app, user):
+    app.authenticator.credits_user = user_credits_simple
+    await app.login_user(user.name)
+
+    def sample(name, **labels):
+        return REGISTRY.get_sample_value(f"jupyterhub_{name}", labels) or 0
+
+    phase_count = sample(
+        "credits_task_phase_duration_seconds_count", phase="user_grant"
+    )
+    written_sum = sample("credits_task_rows_sum", operation="written")
+
+    db = app.authenticator.parent.db
+    user_credits = CreditsUser.get_user(db, user.name).credits_user_values[0]
+    user_credits.balance = 0
+    now = utcnow(with_tz=False)
+    user_credits.grant_last_update = now - timedelta(
+        seconds=user_credits.grant_interval
+    )
+    db.commit()
+    app.authenticator.credits_scheduler.schedule(CREDITS_GRANTS, now)
+    await app.authenticator.credits_reconcile(now)
+
+    assert (
+        sample("credits_task_phase_duration_seconds_count", phase="user_grant")
+        == phase_count + 1
+    )
+    assert sample("credits_task_rows_sum", operation="written") >= written_sum + 1
+
+
+def test_credits_phase_timer():
+    timer = CreditsPhaseTimer()
+    with timer.phase(CreditsTaskPhase.billing):
+        time.sleep(0.02)
+        with timer.phase(CreditsTaskPhase.commit):
+            time.sleep(0.05)
+    with timer.phase(CreditsTaskPhase.billing):
+        time.sleep(0.02)
+    # Nested commits don't count as billing time
+    assert 0.04 <= timer.durations[CreditsTaskPhase.billing] < 0.07
+    assert timer.durations[CreditsTaskPhase.commit] >= 0.05
+
+
+@pytest.mark.asyncio
+async def test_credits_grant_per_row_project_once(app, users):
+    credits_config = copy.deepcopy(user_credits_simple_project)
+    credits_config["project"]["name"] = f"{users[0].name}-shared"
+    app.authenticator.credits_user = credits_config
+    for user in users:
+        await app.login_user(user.name)
+    db = app.authenticator.parent.db
+    project = CreditsProject.get_project(db, credits_config["project"]["name"])
+    project_last_update = utcnow(with_tz=False) - timedelta(seconds=1300)
+    project.balance = 0
+    project.grant_last_update = project_last_update
+    db.commit()
+
+    granted = []
+    grant_project = app.authenticator.credits_grant_project
+
+    def count_grant_project(project, now):
+        granted.append(project.name)
+        return grant_project(project, now)
+
+    now = utcnow(with_tz=False)
+    app.authenticator.credits_scheduler.schedule(CREDITS_GRANTS, now)
+    with (
+        mock.patch.object(
+            CreditsUserValues, "supports_set_based_grants", lambda db: False
+        ),
+        mock.patch.object(
+            app.authenticator, "credits_grant_project", count_grant_project
+        ),
+    ):
+        await app.authenticator.credits_reconcile(now)
+
+    # The project is shared by both users, but granted once
+    assert granted.count(credits_config["project"]["name"]) == 1
+    db.refresh(project)
+    assert project.balance == 2 * credits_config["project"]["grant_value"]
+    assert project.grant_last_update == project_last_update + timedelta(seconds=1200)
+
+
+@pytest.mark.parametrize(
+    "configured, user_options, expected",
+    [
+        ({}, {"system": "A"}, True),
+        ({"system": "A"}, {"system": "A"}, True),
+        ({"system": "A"}, {"system": ["A"]}, True),
+        ({"system": "A"}, {"system": "B"}, False),
+        ({"system": "A"}, {}, False),
+        ({"system": "jureca-.*"}, {"system": "jureca-dc"}, True),
+        # Valid regular expressions aren't used as glob patterns
+        ({"system": "jureca*"}, {"system": "jurecadc"}, False),
+        ({"system": "*-dc"}, {"system": "jureca-dc"}, True),
+        ({"system": ["A", "B"]}, {"system": "B"}, True),
+        ({"system": ["A", "B"]}, {"system": "C"}, False),
+        ({"gpus": 1}, {"gpus": 1}, True),
+        ({"gpus": 1}, {"gpus": "1"}, False),
+        ({"gpus": "[0-4]"}, {"gpus": 3}, True),
+        ({"lab": {"version": "4.*"}}, {"lab": {"version": "4.2"}}, True),
+        ({"lab": {"version": "4.*"}}, {"lab": {"version": "3.6"}}, False),
+        ({"lab": {"version": "4.*"}}, {"lab": "4.2"}, False),
+        ({"lab": {}}, {"lab": "4.2"}, True),
+        ({"system": "A", "gpus": 1}, {"system": "A", "gpus": 2}, False),
+    ],
+)
+def test_match_user_options(app, configured, user_options, expected):
+    assert app.authenticator.match_user_options(user_options, configured) is expected
+
+
+def test_match_user_options_cached(app):
+    authenticator = app.authenticator
+    configured = {"system": "jureca-.*", "gpus": [1, 2]}
+    matcher = authenticator.user_options_matcher(configured)
+    assert authenticator.user_options_matcher(copy.deepcopy(configured)) is matcher
+    # Equal values of other types are configured differently
+    assert authenticator.user_options_matcher({"gpus": 1}) is not (
+        authenticator.user_options_matcher({"gpus": True})
+    )
+    assert not authenticator.match_user_options({"gpus": 1}, {"gpus": "2"})
+
+
+def test_user_options_index_first_match(app):
+    authenticator = app.authenticator
+    configured = [
+        {"system": "A", "partition": "batch"},
+        None,
+        {"system": ["A", "B"]},
+        {"system": "B.*"},
+        {"gpus": 4},
+        {},
+        {"system": "*-dc"},
+        {"system": "A"},
+    ]
+    index = UserOptionsIndex(configured, authenticator.user_options_matcher)
+    spawner_options = [
+        {},
+        {"system": "A"},
+        {"system": ["A"], "partition": "batch"},
+        {"system": "B"},
+        {"system": "Booster"},
+        {"system": "jureca-dc"},
+        {"system": "C", "gpus": 4},
+        {"system": "C", "gpus": 4.0},
+        {"system": "C", "gpus": "4"},
+        {"system": ["A", "B"]},
+    ]
+
+    def linear(user_options, defaults_last):
+        default = None
+        for position, user_options_configured in enumerate(configured):
+            if not user_options_configured:
+                if not defaults_last:
+                    return position
+                default = position
+            elif authenticator.match_user_options(
+                user_options, user_options_configured
+            ):
+                return position
+        return default
+
+    for user_options in spawner_options:
+        for defaults_last in (True, False):
+            assert index.resolve(user_options, defaults_last) == linear(
+                user_options, defaults_last
+            ), (user_options, defaults_last)
+    # Only the bucket of the spawner value and the patterns are matched
+    assert index.candidates({"system": "A"}) == [0, 2, 3, 6, 7]
+    assert index.candidates({"gpus": 4}) == [3, 4, 6]
+
+
+@pytest.mark.asyncio
+async def test_credits_user_values_index_invalidated(app, user):
+    authenticator = app.authenticator
+    authenticator.credits_user = user_credits_multiple_w_default
+    await app.login_user(user.name)
+    db = authenticator.parent.db
+
+    def resolve(user_options):
+        credits_user = CreditsUser.get_user(db, user.name, refresh=True)
+        return authenticator.credits_user_values_for(credits_user, user_options).name
+
+    assert resolve({"system": "A"}) == "systemA"
+    assert resolve({"system": "B"}) == "default"
+    index = authenticator._credits_indexes[user.name][1]
+    assert resolve({"system": "C"}) == "default"
+    assert authenticator._credits_indexes[user.name][1] is index
+
+    # Changed user_options of the same values are used after the next login
+    credits_config = copy.deepcopy(user_credits_multiple_w_default)
+    credits_config[0]["user_options"] = {"system": "B"}
+    authenticator.credits_user = credits_config
+    await app.login_user(user.name)
+    assert resolve({"system": "A"}) == "default"
+    assert resolve({"system": "B"}) == "systemA"
+
+
+@pytest.mark.asyncio
+async def test_credits_billing_values_id_cached(app, user, fake_spawner):
+    authenticator = app.authenticator
+    authenticator.credits_user = user_credits_multiple_w_default
+    await app.login_user(user.name)
+    db = authenticator.parent.db
+    billable = authenticator.credits_billable
+
+    now = utcnow(with_tz=False)
+    spawner = fake_spawner(user, "cached", 1, {"system": "A"})
+
+    def values_by_name():
+        credits_user = CreditsUser.get_user(db, user.name, refresh=True)
+        return {cuv.name: cuv for cuv in credits_user.credits_user_values}
+
+    def paid():
+        values = values_by_name()["systemA"]
+        return -(values.balance + values.project.balance)
+
+    paid_before = paid()
+    resolve = mock.Mock(wraps=authenticator.credits_user_values_for)
+    try:
+        with mock.patch.object(authenticator, "credits_user_values_for", resolve):
+            billable.add(spawner)
+            now = utcnow(with_tz=False)
+            await authenticator.credits_reconcile(now)
+            assert resolve.call_count == 1
+            assert billable.values_id(spawner) == values_by_name()["systemA"].id
+
+            # The next bill uses the resolved values
+            now += timedelta(seconds=600)
+            billable.schedule(spawner, now)
+            await authenticator.credits_reconcile(now)
+            assert resolve.call_count == 1
+            assert paid() == paid_before + 2
+
+            # Logins without changes keep them
+            await app.login_user(user.name)
+            assert billable.values_id(spawner) is not None
+
+            # Changed user_options of the values drop them
+            credits_config = copy.deepcopy(user_credits_multiple_w_default)
+            credits_config[0]["user_options"] = {"system": "B"}
+            authenticator.credits_user = credits_config
+            await app.login_user(user.name)
+            assert billable.values_id(spawner) is None
+            now += timedelta(seconds=600)
+            billable.schedule(spawner, now)
+            await authenticator.credits_reconcile(now)
+            assert resolve.call_count == 2
+            assert billable.values_id(spawner) == values_by_name()["default"].id
+    finally:
+        billable.discard(spawner)
+
+
+def test_migrate_spawner_bills(tmp_path):
+    engine = create_engine(f"sqlite:///{tmp_path / 'credits.sqlite'}")
+    last_billed = datetime(2025, 3, 1, 12, 30, 15, 123456)
+    with engine.begin() as connection:
+        # credits_user of version 0.3
+        connection.exec_driver_sql(
+            "CREATE TABLE credits_user (name VARCHAR PRIMARY KEY, spawner_bills JSON)"
+        )
+        connection.exec_driver_sql(
+            "INSERT INTO credits_user VALUES (?, ?)",
+            ("user1", json.dumps({"3": last_billed.isoformat()})),
+        )
+        connection.exec_driver_sql(
+            "INSERT INTO credits_user VALUES (?, ?)", ("user2", None)
+        )
+    Base.metadata.create_all(engine)
+    assert migrate_spawner_bills(engine) == 1
+    assert add_missing_columns(engine) == ["credits_user.config_fingerprint"]
+    assert add_missing_columns(engine) == []
+
+    db = sessionmaker(bind=engine)()
+    bills = CreditsUser.get_user(db, "user1").spawner_bills
+    assert list(bills) == [3]
+    assert bills[3].last_billed == last_billed
+    assert CreditsUser.get_user(db, "user2").spawner_bills == {}
+    db.close()
+    engine.dispose()
+
+
+def test_create_missing_indexes(tmp_path):
+    engine = create_engine(f"sqlite:///{tmp_path / 'credits.sqlite'}")
+    Base.metadata.create_all(engine)
+    with engine.begin() as connection:
+        # credits_user_values of earlier versions
+        connection.exec_driver_sql("DROP INDEX uq_credits_user_values_user_name_name")
+        connection.exec_driver_sql("DROP INDEX ix_credits_user_values_project_name")
+        connection.exec_driver_sql("INSERT INTO credits_user (name) VALUES ('user1')")
+        for _ in range(2):
+            connection.exec_driver_sql(
+                "INSERT INTO credits_user_values (name, user_name) VALUES ('default', 'user1')"
+            )
+    created, errors = create_missing_indexes(engine)
+    assert created == ["ix_credits_user_values_project_name"]
+    assert list(errors) == ["uq_credits_user_values_user_name_name"]
+
+    with engine.begin() as connection:
+        connection.exec_driver_sql("DELETE FROM credits_user_values WHERE id = 2")
+    assert create_missing_indexes(engine) == (
+        ["uq_credits_user_values_user_name_name"],
+        {},
+    )
+    assert create_missing_indexes(engine) == ([], {})
+    engine.dispose()
+
+
+@pytest.mark.asyncio
+async def test_credits_insufficient_stop_rescheduled(app, user, fake_spawner):
+    authenticator = app.authenticator
+    authenticator.credits_user = user_credits_simple
+    await app.login_user(user.name)
+    billable = authenticator.credits_billable
+
+    spawner = fake_spawner(user, "expensive", 10**6)
+    spawner.user.stop = mock.AsyncMock()
+    # Running for a while, the last bill is long ago
+    now = utcnow(with_tz=False)
+    spawner.orm_spawner.started = now - timedelta(hours=2)
+    db = authenticator.parent.db
+    credits_user = CreditsUser.get_user(db, user.name)
+    bill = credits_user.add_spawner_bill(spawner.orm_spawner.id)
+    bill.last_billed = now - timedelta(hours=1)
+    db.commit()
+    try:
+        billable.add(spawner)
+        now = utcnow(with_tz=False)
+        await authenticator.credits_reconcile(now)
+        await asyncio.sleep(0)
+        spawner.user.stop.assert_called_once_with("expensive")
+        # Checked again after the stop, not right away
+        key = billable.key(user.name, "expensive")
+        assert authenticator.credits_scheduler.deadline(key) >= now + timedelta(
+            seconds=authenticator.credits_task_interval
+        )
+        await authenticator.credits_reconcile(now + timedelta(seconds=0.5))
+        await asyncio.sleep(0)
+        spawner.user.stop.assert_called_once()
+    finally:
+        billable.discard(spawner)
+
+
+@pytest.mark.asyncio
+async def test_credits_ledger(app, user, fake_spawner):
+    authenticator = app.authenticator
+    authenticator.credits_user = user_credits_simple
+    await app.login_user(user.name)
+    db = authenticator.parent.db
+
+    def ledger():
+        db.expire_all()
+        return (
+            db.query(CreditsLedger)
+            .filter(CreditsLedger.user_name == user.name)
+            .order_by(CreditsLedger.id)
+            .all()
+        )
+
+    user_credits = CreditsUser.get_user(db, user.name).credits_user_values[0]
+    user_credits.balance = 0
+    now = utcnow(with_tz=False)
+    user_credits.grant_last_update = now - timedelta(
+        seconds=2 * user_credits.grant_interval
+    )
+    db.commit()
+
+    spawner = fake_spawner(user, "ledger", 7)
+    authenticator.credits_ledger = True
+    try:
+        authenticator.credits_billable.add(spawner)
+        now = utcnow(with_tz=False)
+        authenticator.credits_scheduler.schedule(CREDITS_GRANTS, now)
+        await authenticator.credits_reconcile(now)
+
+        grant, bill = ledger()
+        assert (grant.kind, grant.credits_name) == ("grant", "default")
+        assert grant.amount == 2 * user_credits_simple["grant_value"]
+        assert grant.balance == grant.amount
+        assert (bill.kind, bill.spawner_name) == ("bill", "ledger")
+        assert bill.spawner_id == spawner.orm_spawner.id
+        assert bill.amount == -7
+        assert bill.balance == grant.balance - 7
+        assert len(authenticator.credits_ledger_buffer) == 0
+
+        # Per-row grants are recorded the same way
+        user_credits = CreditsUser.get_user(db, user.name).credits_user_values[0]
+        user_credits.grant_last_update = now - timedelta(
+            seconds=user_credits.grant_interval
+        )
+        db.commit()
+        authenticator.credits_scheduler.schedule(CREDITS_GRANTS, now)
+        with mock.patch.object(
+            CreditsUserValues, "supports_set_based_grants", lambda db: False
+        ):
+            await authenticator.credits_reconcile(now)
+        grant = ledger()[-1]
+        assert grant.kind == "grant"
+        assert grant.amount == user_credits_simple["grant_value"]
+        assert grant.balance == bill.balance + grant.amount
+    finally:
+        authenticator.credits_ledger = False
+        authenticator.credits_billable.discard(spawner)
+
+
+@pytest.mark.asyncio
+async def test_credits_ledger_failed_bill(app, users, fake_spawner):
+    authenticator = app.authenticator
+    authenticator.credits_user = user_credits_simple
+    db = authenticator.parent.db
+    failing, billed = users[:2]
+    spawners = []
+    for user in (failing, billed):
+        await app.login_user(user.name)
+        spawners.append(fake_spawner(user, "ledger", 7))
+    bill_user = authenticator.credits_bill_user
+
+    def credits_bill_user(credit_user, *args):
+        bill_user(credit_user, *args)
+        if credit_user.name == failing.name:
+            raise RuntimeError("bill failed")
+
+    def ledger(user_name):
+        db.expire_all()
+        return db.query(CreditsLedger).filter_by(user_name=user_name).all()
+
+    authenticator.credits_ledger = True
+    authenticator.credits_batch_commit = True
+    try:
+        for spawner in spawners:
+            authenticator.credits_billable.add(spawner)
+        with mock.patch.object(authenticator, "credits_bill_user", credits_bill_user):
+            await authenticator.credits_reconcile(utcnow(with_tz=False))
+        # The bill of the failing user was rolled back, and so its entry
+        assert ledger(failing.name) == []
+        assert [entry.kind for entry in ledger(billed.name)] == ["bill"]
+    finally:
+        authenticator.credits_ledger = False
+        authenticator.credits_batch_commit = False
+        for spawner in spawners:
+            authenticator.credits_billable.discard(spawner)
+
+
+@pytest.mark.asyncio
+async def test_credits_balance_cache(app, user, fake_spawner):
+    authenticator = app.authenticator
+    authenticator.credits_user = user_credits_simple
+    await app.login_user(user.name)
+    db = authenticator.parent.db
+
+    def stored():
+        db.expire_all()
+        return CreditsUser.get_user(db, user.name)
+
+    balance = stored().credits_user_values[0].balance
+    spawner = fake_spawner(user, "cached", 3)
+    cache = CreditsBalanceCache()
+    cache.load(db)
+    authenticator.credits_balances = cache
+    try:
+        authenticator.credits_billable.add(spawner)
+        await authenticator.credits_reconcile(utcnow(with_tz=False))
+
+        # Billed in memory only
+        cached = authenticator.credits_get_user(user.name)
+        # A copy, which credit task runs in other threads don't change
+        assert cached is not cache.users[user.name]
+        assert cached.credits_user_values[0].balance == balance - 3
+        assert get_user_model(authenticator, user.name)[0]["balance"] == balance - 3
+        assert stored().credits_user_values[0].balance == balance
+        assert not stored().spawner_bills
+        assert cache.dirty
+
+        # Written before other changes, which are loaded afterwards
+        def set_cap(cap):
+            stored().credits_user_values[0].cap = cap
+            db.commit()
+
+        authenticator.credits_write(user.name, None, set_cap, balance + 10)
+        assert not cache.dirty
+        credit_user = stored()
+        assert credit_user.credits_user_values[0].balance == balance - 3
+        assert credit_user.spawner_bills[spawner.orm_spawner.id].billing_value == 3
+        assert cache.users[user.name].credits_user_values[0].cap == balance + 10
+
+        # Written right away once there are too many changes
+        authenticator.credits_balance_cache_max_changes = 1
+        bill = cache.users[user.name].spawner_bills[spawner.orm_spawner.id]
+        bill.last_billed -= timedelta(seconds=600)
+        authenticator.credits_billable.schedule(spawner, bill.last_billed)
+        await authenticator.credits_reconcile(utcnow(with_tz=False))
+        assert not cache.dirty
+        assert stored().credits_user_values[0].balance == balance - 6
+    finally:
+        authenticator.credits_balances = None
+        authenticator.credits_balance_cache_max_changes = 10000
+        authenticator.credits_billable.discard(spawner)
+
+
+@pytest.mark.asyncio
+async def test_credits_balance_cache_shutdown(app, user, caplog):
+    authenticator = app.authenticator
+    authenticator.credits_user = user_credits_simple
+    await app.login_user(user.name)
+    db = authenticator.parent.db
+
+    def stored_balance():
+        db.expire_all()
+        return CreditsUser.get_user(db, user.name).credits_user_values[0].balance
+
+    balance = stored_balance()
+    cache = CreditsBalanceCache()
+    cache.load(db)
+    authenticator.credits_balances = cache
+
+    def change_balance(amount):
+        credit_user = cache.users[user.name]
+        credit_user.credits_user_values[0].balance += amount
+        cache.touch_user(credit_user)
+
+    async def credit_reconciliation_run():
+        await asyncio.sleep(3600)
+
+    try:
+        # Written when the Hub cancels the credit task at shutdown
+        change_balance(-5)
+        with mock.patch.object(
+            authenticator, "credit_reconciliation_run", credit_reconciliation_run
+        ):
+            task = asyncio.create_task(authenticator.credit_reconciliation_task())
+            await asyncio.sleep(0)
+            task.cancel()
+            with pytest.raises(asyncio.CancelledError):
+                await task
+        assert not cache.dirty
+        assert stored_balance() == balance - 5
+
+        # The fallback at exit logs lost changes
+        change_balance(-5)
+        with mock.patch.object(
+            authenticator, "credits_balances_flush", side_effect=RuntimeError
+        ):
+            authenticator.credits_balances_atexit()
+        assert "are lost" in caplog.text
+        assert stored_balance() == balance - 5
+    finally:
+        authenticator.credits_balances = None
+
+
+def test_ttl_cache():
+    cache = TTLCache(ttl=10, size=2)
+    value = {"cap": 1}
+    cache.set("a", value)
+    value["cap"] = 2
+    assert cache.get("a") == {"cap": 1}
+    cache.get("a")["cap"] = 3
+    assert cache.get("a") == {"cap": 1}
+
+    # Least recently used entries are dropped first
+    cache.set("b", 2)
+    cache.get("a")
+    cache.set("c", 3)
+    assert cache.get("b") is None
+    assert cache.get("a") == {"cap": 1}
+
+    with mock.patch(
+        "jupyterhub_credit_service.cache.time.monotonic",
+        return_value=time.monotonic() + 10,
+    ):
+        assert cache.get("a", "expired") == "expired"
+    assert len(cache) == 1
+    assert cache.invalidate() == 1
+
+
+def test_version_stamps():
+    versions = VersionStamps()
+    now = datetime(2025, 1, 1)
+    stamp = versions.stamp()
+    etag = versions.etag(stamp)
+    # Unknown until a response was remembered
+    assert versions.unchanged("user1", etag, now) is None
+    versions.remember("user1", ["p1"])
+    assert versions.unchanged("user1", etag, now) == etag
+    assert versions.unchanged("user1", f'"other", W/{etag}', now) == etag
+    assert versions.unchanged("user1", '"invalid"', now) is None
+    assert VersionStamps().unchanged("user1", etag, now) is None
+
+    versions.touch_user("user2")
+    versions.touch_project("p2")
+    assert versions.unchanged("user1", etag, now) == etag
+    versions.touch_project("p1")
+    assert versions.unchanged("user1", etag, now) is None
+
+    etag = versions.etag(versions.stamp(), expires=now + timedelta(seconds=60))
+    assert versions.unchanged("user1", etag, now) == etag
+    assert versions.unchanged("user1", etag, now + timedelta(seconds=60)) is None
+    versions.touch_all()
+    assert versions.unchanged("user1", etag, now) is None
+
+    stamp = versions.stamp()
+    assert not versions.changed_since("user1", ["project1"], stamp)
+    versions.touch_project("project2")
+    assert not versions.changed_since("user1", ["project1"], stamp)
+    versions.touch_project("project1")
+    assert versions.changed_since("user1", ["project1"], stamp)
+
+
+@pytest.mark.asyncio
+async def test_credits_user_cache(app, user):
+    authenticator = app.authenticator
+    calls = []
+
+    async def credits_user(authenticator, user_name, groups, is_admin, auth_state):
+        calls.append((user_name, groups))
+        return dict(user_credits_simple)
+
+    authenticator.credits_user = credits_user
+    authenticator.credits_user_cache_ttl = 60
+    auth_model = {"name": user.name, "groups": ["a"], "admin": False}
+    try:
+        await authenticator.update_user_credit(auth_model)
+        await authenticator.update_user_credit(auth_model)
+        assert len(calls) == 1
+
+        # Other groups or auth_state are other keys
+        await authenticator.update_user_credit({**auth_model, "groups": ["b"]})
+        await authenticator.update_user_credit({**auth_model, "auth_state": {"x": 1}})
+        assert len(calls) == 3
+
+        assert authenticator.credits_user_cache_invalidate(user.name) == 3
+        await authenticator.update_user_credit(auth_model)
+        assert len(calls) == 4
+    finally:
+        authenticator.credits_user_cache_ttl = 0
+        authenticator.credits_user_cache_invalidate()
+
+
+@pytest.mark.asyncio
+async def test_update_user_credit_single_flight(app, user):
+    authenticator = app.authenticator
+    calls = []
+    release = asyncio.Event()
+
+    async def credits_user(authenticator, user_name, groups, is_admin, auth_state):
+        calls.append(groups)
+        await release.wait()
+        return dict(user_credits_simple)
+
+    authenticator.credits_user = credits_user
+    auth_model = {"name": user.name, "groups": ["a"], "admin": False}
+    updates = [
+        asyncio.ensure_future(authenticator.update_user_credit(auth_model))
+        for _ in range(3)
+    ]
+    # Different groups may resolve to other credits, this one runs after
+    other = asyncio.ensure_future(
+        authenticator.update_user_credit({**auth_model, "groups": ["b"]})
+    )
+    await asyncio.sleep(0.01)
+    assert calls == [["a"]]
+    release.set()
+    await asyncio.gather(*updates, other)
+    assert calls == [["a"], ["b"]]
+    assert user.name not in authenticator._credits_user_updates
+
+    # A cancelled caller (e.g. an aborted login) doesn't end the update
+    # for the others
+    calls.clear()
+    release.clear()
+    auth_model = {**auth_model, "groups": ["c"]}
+    first = asyncio.ensure_future(authenticator.update_user_credit(auth_model))
+    await asyncio.sleep(0.01)
+    first.cancel()
+    await asyncio.sleep(0.01)
+    second = asyncio.ensure_future(authenticator.update_user_credit(auth_model))
+    await asyncio.sleep(0.01)
+    assert calls == [["c"]]
+    release.set()
+    await second
+    assert calls == [["c"]]
+    await asyncio.sleep(0)
+    assert user.name not in authenticator._credits_user_updates
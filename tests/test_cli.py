@@ -0,0 +1,200 @@
+"""Tests for the jupyterhub-credit-service command"""
+
+import json
+from datetime import datetime
+
+import pytest
+from sqlalchemy import create_engine, inspect
+
+from jupyterhub_credit_service.cli import main as cli_main
+from jupyterhub_credit_service.orm import (
+    CreditsLedger,
+    CreditsSpawnerBill,
+    CreditsUserValues,
+)
+
+
+def test_cli_import_export(tmp_path, capsys):
+    db_url = f"sqlite:///{tmp_path / 'credits.sqlite'}"
+    projects = tmp_path / "projects.jsonl"
+    projects.write_text(
+        json.dumps(
+            {"name": "p1", "cap": 1000, "grant_value": 10, "grant_interval": 600}
+        )
+        + "\n"
+    )
+    values = tmp_path / "values.csv"
+    rows = ["user_name,name,balance,cap,grant_value,grant_interval,project_name"]
+    rows += [f"user{i},default,{i},100,5,300,p1" for i in range(25)]
+    values.write_text("\n".join(rows) + "\n")
+
+    args = ["--db-url", db_url, "--chunk-size", "10"]
+    assert cli_main(args + ["import", "projects", str(projects)]) == 0
+    assert cli_main(args + ["import", "values", str(values)]) == 0
+    assert "25 inserted, 0 updated" in capsys.readouterr().err
+
+    # existing values are updated, not duplicated
+    values.write_text(rows[0] + "\nuser3,default,50,100,5,300,\n")
+    assert cli_main(args + ["import", "values", str(values)]) == 0
+    assert "0 inserted, 1 updated" in capsys.readouterr().err
+
+    exported = tmp_path / "values.jsonl"
+    assert cli_main(args + ["export", "values", "-o", str(exported)]) == 0
+    lines = [json.loads(line) for line in exported.read_text().splitlines()]
+    assert len(lines) == 25
+    assert lines[3]["user_name"] == "user3"
+    assert lines[3]["balance"] == 50
+    assert lines[3]["project_name"] is None
+    assert lines[4]["project_name"] == "p1"
+
+    # invalid rows are reported, nothing of their chunk is written
+    values.write_text(rows[0] + "\nuser99,default,50,,5,300,\n")
+    assert cli_main(args + ["import", "values", str(values)]) == 1
+    assert "Missing cap" in capsys.readouterr().err
+
+    assert cli_main(args + ["stats"]) == 0
+    stats = json.loads(capsys.readouterr().out)
+    assert stats["users"] == 25
+    assert stats["values"]["rows"] == 25
+    assert stats["values"]["balance"] == sum(range(25)) - 3 + 50
+    assert stats["values"]["empty"] == 1
+    assert stats["projects"]["rows"] == 1
+    assert stats["projects"]["at_cap"] == 1
+
+
+def test_cli_reset(tmp_path, capsys):
+    db_url = f"sqlite:///{tmp_path / 'credits.sqlite'}"
+    values = tmp_path / "values.jsonl"
+    values.write_text(
+        "".join(
+            json.dumps(
+                {
+                    "user_name": f"user{i}",
+                    "name": "default",
+                    "balance": 0,
+                    "cap": 100,
+                    "grant_value": 5,
+                    "grant_interval": 300,
+                }
+            )
+            + "\n"
+            for i in range(3)
+        )
+    )
+    args = ["--db-url", db_url]
+    assert cli_main(args + ["import", "values", str(values)]) == 0
+    assert cli_main(args + ["reset", "--name", "user0", "--balance", "500"]) == 0
+    assert cli_main(args + ["reset", "--name", "user1", "--balance", "20"]) == 0
+    assert "Reset 1 values" in capsys.readouterr().err
+
+    engine = create_engine(db_url)
+    with engine.connect() as connection:
+        balances = dict(
+            connection.execute(
+                CreditsUserValues.__table__.select().with_only_columns(
+                    CreditsUserValues.user_name, CreditsUserValues.balance
+                )
+            ).all()
+        )
+    engine.dispose()
+    assert balances == {"user0": 100, "user1": 20, "user2": 0}
+
+
+def test_cli_ledger(tmp_path, monkeypatch):
+    monkeypatch.delenv("JUPYTERHUB_CREDITS_LEDGER", raising=False)
+    db_url = f"sqlite:///{tmp_path / 'credits.sqlite'}"
+    projects = tmp_path / "projects.jsonl"
+    values = tmp_path / "values.jsonl"
+
+    def write(path, **row):
+        path.write_text(json.dumps(row) + "\n")
+
+    def ledger():
+        engine = create_engine(db_url)
+        with engine.connect() as connection:
+            rows = connection.execute(
+                CreditsLedger.__table__.select().order_by(CreditsLedger.id)
+            ).all()
+        engine.dispose()
+        return [
+            (row.kind, row.user_name, row.credits_name, row.project_name)
+            + (row.amount, row.balance)
+            for row in rows
+        ]
+
+    args = ["--db-url", db_url, "--ledger"]
+    write(projects, name="p1", balance=10, cap=100, grant_value=5, grant_interval=60)
+    write(
+        values,
+        user_name="user1",
+        name="default",
+        balance=30,
+        cap=100,
+        grant_value=5,
+        grant_interval=60,
+    )
+    # New rows aren't changes
+    assert cli_main(args + ["import", "projects", str(projects)]) == 0
+    assert cli_main(args + ["import", "values", str(values)]) == 0
+    assert ledger() == []
+
+    write(projects, name="p1", balance=40, cap=100, grant_value=5, grant_interval=60)
+    assert cli_main(args + ["import", "projects", str(projects)]) == 0
+    assert cli_main(args + ["reset", "--balance", "50"]) == 0
+    # Unchanged balances aren't recorded
+    assert cli_main(args + ["reset", "--balance", "50"]) == 0
+    assert ledger() == [
+        ("admin", None, None, "p1", 30, 40),
+        ("admin", "user1", "default", None, 20, 50),
+    ]
+
+    assert cli_main(["--db-url", db_url, "reset", "--kind", "projects"]) == 0
+    assert len(ledger()) == 2
+
+
+def test_cli_upgrade(tmp_path, capsys):
+    db_url = f"sqlite:///{tmp_path / 'credits.sqlite'}"
+    engine = create_engine(db_url)
+    last_billed = datetime(2025, 3, 1, 12, 30, 15)
+    with engine.begin() as connection:
+        # credits_user of version 0.3, bills in a JSON column
+        connection.exec_driver_sql(
+            "CREATE TABLE credits_user (name VARCHAR PRIMARY KEY, spawner_bills JSON)"
+        )
+        connection.exec_driver_sql(
+            "INSERT INTO credits_user VALUES (?, ?)",
+            ("user1", json.dumps({"3": last_billed.isoformat()})),
+        )
+    args = ["--db-url", db_url]
+
+    # Read-only commands don't upgrade the tables
+    assert cli_main(args + ["stats"]) == 1
+    assert "earlier version" in capsys.readouterr().err
+    assert inspect(engine).get_table_names() == ["credits_user"]
+
+    assert cli_main(args + ["reset"]) == 0
+    assert "Migrated 1 spawner bills" in capsys.readouterr().err
+    with engine.connect() as connection:
+        bills = connection.execute(CreditsSpawnerBill.__table__.select()).all()
+    engine.dispose()
+    assert [(bill.spawner_id, bill.user_name) for bill in bills] == [(3, "user1")]
+    assert bills[0].last_billed == last_billed
+
+    assert cli_main(args + ["stats"]) == 0
+    stats = json.loads(capsys.readouterr().out)
+    assert stats["users"] == 1
+    assert stats["billed_servers"] == 1
+
+
+def test_cli_no_tables(tmp_path, capsys):
+    db_url = f"sqlite:///{tmp_path / 'typo.sqlite'}"
+    for command in (["stats"], ["export", "values"], ["reset"]):
+        assert cli_main(["--db-url", db_url] + command) == 1
+        assert "No credit tables" in capsys.readouterr().err
+    engine = create_engine(db_url)
+    assert inspect(engine).get_table_names() == []
+    engine.dispose()
+
+    with pytest.raises(SystemExit):
+        cli_main(["--db-url", db_url, "reset", "--kind", "projects", "--project", "p1"])
+    assert "--project only selects values" in capsys.readouterr().err
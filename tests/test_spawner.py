@@ -4,7 +4,7 @@ import asyncio
 import copy
 import random
 import string
-from datetime import datetime, timedelta
+from datetime import timedelta
 
 import pytest
 from jupyterhub.tests.test_spawner import wait_for_spawner
@@ -230,8 +230,8 @@ async def test_spawner_second_bill(db, app, user):
 
     # Wait until the spawner must be billed again
     app.authenticator.parent.db.refresh(credits_user)
-    last_spawner_bill = credits_user.spawner_bills[str(spawner.orm_spawner.id)]
-    next_spawner_bill = datetime.fromisoformat(last_spawner_bill) + timedelta(
+    last_spawner_bill = credits_user.spawner_bills[spawner.orm_spawner.id]
+    next_spawner_bill = last_spawner_bill.last_billed + timedelta(
         seconds=spawner._billing_interval
     )
     now = utcnow(with_tz=False)
@@ -318,8 +318,8 @@ async def test_spawner_proj_billed(db, app, user):
 
     # Wait until the spawner must be billed again
     app.authenticator.parent.db.refresh(credits_user)
-    last_spawner_bill = credits_user.spawner_bills[str(spawner.orm_spawner.id)]
-    next_spawner_bill = datetime.fromisoformat(last_spawner_bill) + timedelta(
+    last_spawner_bill = credits_user.spawner_bills[spawner.orm_spawner.id]
+    next_spawner_bill = last_spawner_bill.last_billed + timedelta(
         seconds=spawner._billing_interval
     )
     now = utcnow(with_tz=False)
@@ -465,8 +465,8 @@ async def test_spawner_proj_billed_start_stop_start(db, app, user):
 
     # Wait until the spawner must be billed again
     app.authenticator.parent.db.refresh(credits_user)
-    last_spawner_bill = credits_user.spawner_bills[str(spawner.orm_spawner.id)]
-    next_spawner_bill = datetime.fromisoformat(last_spawner_bill) + timedelta(
+    last_spawner_bill = credits_user.spawner_bills[spawner.orm_spawner.id]
+    next_spawner_bill = last_spawner_bill.last_billed + timedelta(
         seconds=spawner._billing_interval
     )
     now = utcnow(with_tz=False)
@@ -545,8 +545,8 @@ async def test_spawner_proj_billed_start_stop_start(db, app, user):
 
     # Wait until the spawner must be billed again
     app.authenticator.parent.db.refresh(credits_user)
-    last_spawner_bill = credits_user.spawner_bills[str(spawner.orm_spawner.id)]
-    next_spawner_bill = datetime.fromisoformat(last_spawner_bill) + timedelta(
+    last_spawner_bill = credits_user.spawner_bills[spawner.orm_spawner.id]
+    next_spawner_bill = last_spawner_bill.last_billed + timedelta(
         seconds=spawner._billing_interval
     )
     now = utcnow(with_tz=False)
@@ -781,3 +781,89 @@ async def test_spawner_stopped_when_no_credits_left(db, app, user):
     # Check if it's no longer running
     status = await spawner.poll()
     assert status == 0
+
+
+async def test_spawner_billing_registry(db, app, user):
+    event = asyncio.Event()
+
+    async def post_hook():
+        event.set()
+        await asyncio.sleep(0)
+        event.clear()
+
+    app.authenticator.credits_user = user_credits_simple
+    app.authenticator.credits_task_post_hook = post_hook
+    app.authenticator.credits_task_interval = 1
+    billable = app.authenticator.credits_billable
+
+    await app.login_user(user.name)
+    spawner = user.spawner
+    assert spawner not in billable
+
+    spawner.cmd = ["jupyterhub-singleuser"]
+    await user.spawn()
+    await wait_for_spawner(spawner)
+    assert spawner in billable
+    assert user.name in billable.user_names()
+
+    await event.wait()
+    credits_user = CreditsUser.get_user(
+        app.authenticator.parent.db, user.name, refresh=True
+    )
+    assert spawner.orm_spawner.id in credits_user.spawner_bills
+
+    # Stopped spawners are unregistered, their bill is removed in the next run
+    await user.stop()
+    assert spawner not in billable
+    await event.wait()
+    credits_user = CreditsUser.get_user(
+        app.authenticator.parent.db, user.name, refresh=True
+    )
+    assert spawner.orm_spawner.id not in credits_user.spawner_bills
+    assert user.name not in billable.user_names()
+
+
+async def test_spawner_lazy_grants_billed(db, app, user):
+    event = asyncio.Event()
+
+    async def post_hook():
+        event.set()
+        await asyncio.sleep(0)
+        event.clear()
+
+    app.authenticator.credits_user = user_credits_simple
+    app.authenticator.credits_task_post_hook = post_hook
+    app.authenticator.credits_task_interval = 1
+
+    await app.login_user(user.name)
+    app.authenticator.credits_lazy_grants = True
+    try:
+        user_credits = CreditsUser.get_user(
+            app.authenticator.parent.db, user.name
+        ).credits_user_values[0]
+        # Nothing stored, but two grants are due
+        last_update = utcnow(with_tz=False) - timedelta(
+            seconds=2 * user_credits.grant_interval + 50
+        )
+        user_credits.balance = 0
+        user_credits.grant_last_update = last_update
+        app.authenticator.parent.db.commit()
+
+        spawner = user.spawner
+        spawner.cmd = ["jupyterhub-singleuser"]
+        await user.spawn()
+        await wait_for_spawner(spawner)
+        await event.wait()
+
+        app.authenticator.parent.db.refresh(user_credits)
+        assert (
+            user_credits.balance
+            == 2 * user_credits_simple["grant_value"] - spawner._billing_value
+        ), f"Credits value: {user_credits.balance}"
+        assert user_credits.grant_last_update == last_update + timedelta(
+            seconds=2 * user_credits.grant_interval
+        )
+
+        await user.stop()
+    finally:
+        app.authenticator.credits_lazy_grants = False